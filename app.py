@@ -1,13 +1,22 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field, AliasChoices, EmailStr
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional, List, Dict, Any
-import concurrent.futures
+import asyncio
+import math
 import os
 import json
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from uuid import uuid4
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 from jose import JWTError, jwt
 
 # Reuse existing project logic
@@ -18,9 +27,26 @@ from reporte6_BernardoBojalil import (
     interpretar_offline,
     _memoria_json_compacta,
     _crear_sesion,
+    _crear_sesiones,
     _buscar_sesion,
     _agregar_followup,
+    _actualizar_sesion,
+    _eliminar_sesion,
     _resumen_ultimas_sesiones,
+    _invalidar_memoria,
+    _generacion_memoria,
+    _memoria_cache_get,
+    _memoria_cache_set,
+    _ajustar_memoria,
+    _estimar_tokens,
+    _presupuesto_memoria,
+    _followups_recientes,
+    _followups_por_resumir,
+    _payload_resumen,
+    _campos_resumen,
+    _clave_api_actual,
+    _llm_timeout_secs,
+    construir_cadena_resumen,
 )
 
 app = FastAPI(title="MoonBound API", version="1.0.0", description="Dream interpretation and visualization API powered by Gemini AI")
@@ -30,7 +56,7 @@ SECRET_KEY = os.getenv("SECRET_KEY", "tu-secret-key-super-segura-cambiala-en-pro
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "10080"))  # 7 días por defecto
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_PWD_CONTEXT = None  # CryptContext de passlib, creado en el primer uso (ver _pwd_context)
 security = HTTPBearer()
 
 from fastapi.middleware.cors import CORSMiddleware
@@ -43,6 +69,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _env_int(nombre: str, defecto: int) -> int:
+    try:
+        return int(os.getenv(nombre, str(defecto)))
+    except ValueError:
+        return defecto
+
+
 # --- Auth Models ---
 class UserCreate(BaseModel):
     email: EmailStr
@@ -78,6 +111,22 @@ class InterpretTextRequest(BaseModel):
         description="Nombre base del archivo del sueño para nombrar la salida (solo si save=True)",
     )
     offline: Optional[bool] = Field(False, description="Si true, fuerza modo offline sin LLM")
+    cache: bool = Field(True, description="Si false, no usa ni guarda la caché de interpretaciones")
+
+    model_config = {
+        "populate_by_name": True,
+        "str_strip_whitespace": True,
+    }
+
+
+class InterpretBatchItem(BaseModel):
+    texto_sueno: str = Field(
+        ...,
+        description="Descripción del sueño en texto plano",
+        validation_alias=AliasChoices("texto_sueno", "texto_sueño"),
+    )
+    contexto_emocional: Optional[str] = Field("", description="Contexto emocional opcional")
+    filename: Optional[str] = Field(None, description="Nombre del archivo de origen (se guarda en la sesión)")
 
     model_config = {
         "populate_by_name": True,
@@ -85,6 +134,12 @@ class InterpretTextRequest(BaseModel):
     }
 
 
+class InterpretBatchRequest(BaseModel):
+    items: List[InterpretBatchItem] = Field(..., description="Sueños a interpretar")
+    offline: Optional[bool] = Field(False, description="Si true, fuerza modo offline sin LLM")
+    cache: bool = Field(True, description="Si false, no usa ni guarda la caché de interpretaciones")
+
+
 class InterpretFileRequest(BaseModel):
     ruta: str = Field(..., description="Ruta del archivo con el sueño (UTF-8)")
     contexto_emocional: Optional[str] = Field("", description="Contexto emocional opcional")
@@ -105,28 +160,273 @@ class GenerateTitleRequest(BaseModel):
     descripcion_sueno: str = Field(..., description="Descripción del sueño para generar el título")
 
 
+# --- Métricas (Prometheus) y tiempos por etapa ---
+# Sin dependencias extra: histogramas y contadores en memoria del proceso, expuestos en
+# /metrics con el formato de texto de Prometheus. Cada petición lleva un request id
+# (X-Request-ID) y acumula el tiempo de sus etapas (`_etapa`), que se registra al final
+# como una línea JSON (LOG_REQUESTS=0 la desactiva).
+_BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _etiquetas_prom(nombres: tuple, valores: tuple) -> str:
+    pares = []
+    for n, v in zip(nombres, valores):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pares.append(f'{n}="{v}"')
+    return ",".join(pares)
+
+
+class _Contador:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._valores: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def incrementar(self, n: float = 1, **etiquetas: str) -> None:
+        clave = tuple(etiquetas.get(e, "") for e in self.etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + n
+
+    def exponer(self) -> List[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            for clave, valor in sorted(self._valores.items()):
+                lineas.append(f"{self.nombre}{{{_etiquetas_prom(self.etiquetas, clave)}}} {valor:g}")
+        return lineas
+
+
+class _Histograma:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = _BUCKETS_SEGUNDOS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}  # clave -> [conteos por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valor: float, **etiquetas: str) -> None:
+        clave = tuple(etiquetas.get(e, "") for e in self.etiquetas)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [0] * len(self.buckets) + [0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[i] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def exponer(self) -> List[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            for clave, serie in sorted(self._series.items()):
+                base = _etiquetas_prom(self.etiquetas, clave)
+                sep = "," if base else ""
+                for limite, conteo in zip(self.buckets, serie):
+                    lineas.append(f'{self.nombre}_bucket{{{base}{sep}le="{limite:g}"}} {conteo}')
+                lineas.append(f'{self.nombre}_bucket{{{base}{sep}le="+Inf"}} {serie[-1]}')
+                lineas.append(f"{self.nombre}_sum{{{base}}} {serie[-2]:.6f}")
+                lineas.append(f"{self.nombre}_count{{{base}}} {serie[-1]}")
+        return lineas
+
+
+_M_HTTP = _Histograma("moonbound_http_request_duration_seconds", "Duración de las peticiones HTTP.", ("method", "route", "status"))
+_M_ETAPAS = _Histograma("moonbound_stage_duration_seconds", "Duración de cada etapa dentro de una petición.", ("stage",))
+_M_LLM = _Histograma("moonbound_llm_call_duration_seconds", "Duración de las llamadas a Gemini por modelo y tipo.", ("model", "kind", "outcome"))
+_M_LLM_TIMEOUTS = _Contador("moonbound_llm_timeouts_total", "Llamadas a Gemini que agotaron LLM_TIMEOUT_SECS.", ("kind",))
+_M_FALLBACKS = _Contador("moonbound_llm_fallbacks_total", "Respuestas degradadas (interpretación offline, título por defecto, resumen extractivo).", ("kind", "reason"))
+_M_MONGO = _Histograma("moonbound_mongo_command_duration_seconds", "Latencia de los comandos de MongoDB.", ("command", "outcome"))
+_M_ADMISION = _Histograma("moonbound_admission_wait_seconds", "Espera en la cola de admisión antes de llamar a Gemini.", ("class",))
+_METRICAS = [_M_HTTP, _M_ETAPAS, _M_LLM, _M_LLM_TIMEOUTS, _M_FALLBACKS, _M_MONGO, _M_ADMISION]
+
+_TRAZA: ContextVar[Optional[Dict[str, Any]]] = ContextVar("traza_peticion", default=None)
+
+
+def _registrar_etapa(nombre: str, segundos: float) -> None:
+    _M_ETAPAS.observar(segundos, stage=nombre)
+    traza = _TRAZA.get()
+    if traza is not None:
+        etapas = traza["stages"]
+        etapas[nombre] = round(etapas.get(nombre, 0.0) + 1000 * segundos, 1)
+
+
+@contextmanager
+def _etapa(nombre: str):
+    """Mide una etapa de la petición en curso (sirve también alrededor de un `await`)."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registrar_etapa(nombre, time.perf_counter() - inicio)
+
+
+@contextmanager
+def _medir_llm(tipo: str, modelo: str):
+    """Etapa `llm_<tipo>` más el histograma por modelo y resultado (ok, error, timeout)."""
+    inicio = time.perf_counter()
+    resultado = "cancelled"
+    try:
+        yield
+        resultado = "ok"
+    except asyncio.TimeoutError:
+        resultado = "timeout"
+        _M_LLM_TIMEOUTS.incrementar(kind=tipo)
+        raise
+    except Exception:
+        resultado = "error"
+        raise
+    finally:
+        segundos = time.perf_counter() - inicio
+        _M_LLM.observar(segundos, model=modelo, kind=tipo, outcome=resultado)
+        _registrar_etapa(f"llm_{tipo}", segundos)
+
+
+def _fallback(tipo: str, motivo: str) -> None:
+    _M_FALLBACKS.incrementar(kind=tipo, reason=motivo)
+    traza = _TRAZA.get()
+    if traza is not None:
+        traza.setdefault("fallbacks", []).append(f"{tipo}:{motivo}")
+
+
+def _modelo_texto_actual() -> str:
+    from reporte6_BernardoBojalil import _modelo_texto
+
+    return _modelo_texto()
+
+
+def _id_peticion(scope) -> str:
+    for k, v in scope.get("headers", []):
+        if k == b"x-request-id":
+            valor = v.decode("latin-1").strip()
+            if 0 < len(valor) <= 64 and valor.isprintable():
+                return valor
+    return uuid4().hex[:16]
+
+
+def _plantilla_ruta(scope) -> str:
+    """Ruta declarada (p. ej. /sessions/{sesion_id}) para no crear una serie por id."""
+    from starlette.routing import Match
+
+    for ruta in app.router.routes:
+        coincide, _ = ruta.matches(scope)
+        if coincide == Match.FULL:
+            return getattr(ruta, "path", "(sin ruta)")
+    return "(sin ruta)"
+
+
+_RUTAS_SIN_LOG = {"/metrics", "/health"}
+
+
+class _MetricasMiddleware:
+    """Asigna el request id, mide la petición completa (incluido el cuerpo en streaming)
+    y escribe una línea JSON con los tiempos por etapa."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = _id_peticion(scope)
+        traza: Dict[str, Any] = {"request_id": request_id, "stages": {}}
+        token = _TRAZA.set(traza)
+        estado = {"status": 500}
+        inicio = time.perf_counter()
+
+        async def send_con_id(message):
+            if message["type"] == "http.response.start":
+                estado["status"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_con_id)
+        finally:
+            _TRAZA.reset(token)
+            duracion = time.perf_counter() - inicio
+            ruta = _plantilla_ruta(scope)
+            _M_HTTP.observar(duracion, method=scope["method"], route=ruta, status=str(estado["status"]))
+            if os.getenv("LOG_REQUESTS", "1") != "0" and ruta not in _RUTAS_SIN_LOG:
+                registro = {
+                    "event": "request",
+                    "request_id": request_id,
+                    "method": scope["method"],
+                    "route": ruta,
+                    "status": estado["status"],
+                    "duration_ms": round(1000 * duracion, 1),
+                    **{k: v for k, v in traza.items() if k != "request_id"},
+                }
+                print(json.dumps(registro, ensure_ascii=False))
+
+
+app.add_middleware(_MetricasMiddleware)
+
+
 # --- MongoDB (opcional) ---
-_MONGO_OK = False
+# pymongo se importa la primera vez que se necesita un cliente (_cargar_pymongo): sin
+# MONGODB_URI no se importa nunca. Hasta entonces las excepciones son sustitutos locales.
+_MONGO_OK: Optional[bool] = None  # None = pymongo aún no importado
 _MONGO_CLIENT = None
-try:
-    from pymongo import MongoClient
+MongoClient = None
+_MongoMetricas = None
+ASCENDING, DESCENDING = 1, -1
+
+
+class DuplicateKeyError(Exception):
+    pass
+
+
+class BulkWriteError(Exception):
+    details: Dict[str, Any] = {}
+
+
+def _cargar_pymongo() -> bool:
+    """Importa pymongo (una vez) y publica MongoClient, sus excepciones y el listener de métricas."""
+    global _MONGO_OK, MongoClient, BulkWriteError, DuplicateKeyError, _MongoMetricas
+    if _MONGO_OK is not None:
+        return _MONGO_OK
+    try:
+        from pymongo import MongoClient as _Cliente, monitoring
+        from pymongo.errors import BulkWriteError as _BulkWriteError, DuplicateKeyError as _DuplicateKeyError
+    except Exception:
+        _MONGO_OK = False
+        return False
+
+    class _Metricas(monitoring.CommandListener):
+        """Alimenta moonbound_mongo_command_duration_seconds y suma el tiempo en Mongo a la
+        etapa `mongo` de la petición en curso."""
+
+        def started(self, event) -> None:
+            pass
+
+        def succeeded(self, event) -> None:
+            _M_MONGO.observar(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+            _registrar_etapa("mongo", event.duration_micros / 1e6)
+
+        def failed(self, event) -> None:
+            _M_MONGO.observar(event.duration_micros / 1e6, command=event.command_name, outcome="error")
+            _registrar_etapa("mongo", event.duration_micros / 1e6)
+
+    MongoClient, BulkWriteError, DuplicateKeyError, _MongoMetricas = _Cliente, _BulkWriteError, _DuplicateKeyError, _Metricas
     _MONGO_OK = True
-except Exception:
-    _MONGO_OK = False
+    return True
 
 
 def _get_mongo_client():
     """Devuelve el cliente de Mongo si está disponible; si no, None."""
     global _MONGO_CLIENT
-    if not _MONGO_OK:
-        return None
     if _MONGO_CLIENT is not None:
+        # Cliente inyectado (p. ej. mongomock): las excepciones deben ser las de pymongo
+        _cargar_pymongo()
         return _MONGO_CLIENT
     uri = os.getenv("MONGODB_URI")
-    if not uri:
+    if not uri or not _cargar_pymongo():
         return None
     try:
-        _MONGO_CLIENT = MongoClient(uri, serverSelectionTimeoutMS=3000)
+        _MONGO_CLIENT = MongoClient(uri, serverSelectionTimeoutMS=3000, event_listeners=[_MongoMetricas()])
         return _MONGO_CLIENT
     except Exception:
         return None
@@ -158,11 +458,155 @@ def _get_users_collection():
     return db.get_collection("users")
 
 
-def _mongo_create_session(ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: Optional[str], user_id: Optional[str] = None, titulo: Optional[str] = None):
-    col = _get_mongo_collection()
-    if col is None:
-        return None
-    ses_id = str(uuid4())
+# Índices requeridos: (colección, nombre, claves, unique, opciones extra)
+_MONGO_INDICES_REQUERIDOS = [
+    ("sessions", "id_unique", [("id", 1)], True, {}),
+    ("sessions", "user_id_created_at", [("user_id", 1), ("created_at", -1)], False, {}),
+    ("users", "email_unique", [("email", 1)], True, {}),
+    ("users", "id_unique", [("id", 1)], True, {}),
+    ("idempotency_keys", "expire_at_ttl", [("expire_at", 1)], False, {"expireAfterSeconds": 0}),
+]
+# Solo si la caché compartida de interpretaciones está activa (ver _cache_compartida)
+_MONGO_INDICES_CACHE = [
+    ("interpretation_cache", "expire_at_ttl", [("expire_at", 1)], False, {"expireAfterSeconds": 0}),
+]
+# Solo si el rate limit compartido está activo (ver _rate_limit_compartido)
+_MONGO_INDICES_RATE = [
+    ("rate_limits", "expire_at_ttl", [("expire_at", 1)], False, {"expireAfterSeconds": 0}),
+]
+_MONGO_INDICES_ESTADO: Dict[str, Any] = {"status": "pending"}
+
+
+def _indice_equivalente(indices: Dict[str, Any], claves: List[tuple], unique: bool, opciones: Dict[str, Any]) -> Optional[str]:
+    """Nombre de un índice existente con las mismas claves y opciones (aunque se llame
+    distinto), o None. Evita el IndexOptionsConflict (código 85) de create_index."""
+    esperado = [(k, 1 if d > 0 else -1) for k, d in claves]
+    for nombre, info in (indices or {}).items():
+        try:
+            actual = [(k, 1 if float(d) > 0 else -1) for k, d in info.get("key", [])]
+        except (TypeError, ValueError):
+            continue  # índices de texto/hashed
+        if actual != esperado or bool(info.get("unique", False)) != unique:
+            continue
+        if any(info.get(k) != v for k, v in opciones.items()):
+            continue
+        return nombre
+    return None
+
+
+def _asegurar_indices_mongo() -> Dict[str, Any]:
+    """Crea (si faltan) y verifica los índices de sesiones y usuarios.
+    Devuelve y guarda el estado que reporta /health.
+    """
+    global _MONGO_INDICES_ESTADO
+    colecciones = {
+        "sessions": _get_mongo_collection(),
+        "users": _get_users_collection(),
+        "idempotency_keys": _idempotencia_col(),
+        "interpretation_cache": _cache_compartida(),
+        "rate_limits": _rate_limit_compartido(),
+    }
+    if colecciones["sessions"] is None:
+        _MONGO_INDICES_ESTADO = {"status": "disabled"}
+        return _MONGO_INDICES_ESTADO
+    requeridos = list(_MONGO_INDICES_REQUERIDOS)
+    if colecciones["interpretation_cache"] is not None:
+        requeridos += _MONGO_INDICES_CACHE
+    if colecciones["rate_limits"] is not None:
+        requeridos += _MONGO_INDICES_RATE
+    estado: Dict[str, Any] = {"status": "ok", "indexes": {}}
+    for coll_key, nombre, claves, unique, opciones in requeridos:
+        col = colecciones[coll_key]
+        etiqueta = f"{coll_key}.{nombre}"
+        try:
+            # Un índice equivalente con otro nombre (creado a mano o por otra versión) cuenta como presente
+            ok = _indice_equivalente(col.index_information(), claves, unique, opciones) is not None
+            if not ok:
+                col.create_index([(k, ASCENDING if d > 0 else DESCENDING) for k, d in claves], name=nombre, unique=unique, **opciones)
+                ok = _indice_equivalente(col.index_information(), claves, unique, opciones) is not None
+            estado["indexes"][etiqueta] = "ok" if ok else "missing"
+        except Exception as e:
+            # p. ej. duplicados existentes impiden crear un índice unique
+            ok = False
+            estado["indexes"][etiqueta] = f"error: {e}"
+        if not ok:
+            estado["status"] = "degraded"
+    _MONGO_INDICES_ESTADO = estado
+    if estado["status"] != "ok":
+        print(f"Aviso: índices de MongoDB incompletos: {estado['indexes']}")
+    return estado
+
+
+def _indice_email_unico_ok() -> bool:
+    return _MONGO_INDICES_ESTADO.get("indexes", {}).get("users.email_unique") == "ok"
+
+
+@app.on_event("startup")
+async def _startup_indices_mongo() -> None:
+    await run_in_threadpool(_asegurar_indices_mongo)
+
+
+# --- Warm-up en segundo plano ---
+# Los SDK pesados (LangChain/Gemini, passlib/bcrypt, pymongo) y la memoria JSON se cargan
+# en el primer uso. Con WARMUP=1 (por defecto) un hilo los precarga justo después del
+# arranque, sin retrasar el momento en que el worker empieza a aceptar peticiones.
+_WARMUP_ESTADO: Dict[str, Any] = {"status": "disabled"}
+
+
+def _precargar_llm() -> None:
+    from reporte6_BernardoBojalil import _chat_disponible
+
+    # Importa LangChain aunque todavía no haya API key; con clave, deja las cadenas construidas
+    if _chat_disponible():
+        construir_cadena_interprete()
+        construir_cadena_followup()
+        construir_cadena_resumen()
+
+
+def _precargar_passlib() -> None:
+    _pwd_context().handler("bcrypt").get_backend()
+
+
+def _precargar_memoria() -> None:
+    from reporte6_BernardoBojalil import _memoria
+
+    _memoria()
+
+
+def _precargar_genai() -> None:
+    if _backend_imagen() in ("gemini", "record"):
+        from google import genai  # noqa: F401
+
+
+def _warmup() -> None:
+    inicio = time.perf_counter()
+    _WARMUP_ESTADO.update(status="running")
+    pasos: Dict[str, Any] = {}
+    for nombre, paso in (
+        ("llm", _precargar_llm),
+        ("passlib", _precargar_passlib),
+        ("memory", _precargar_memoria),
+        ("mongo", _get_mongo_client),
+        ("image_client", _precargar_genai),
+    ):
+        t0 = time.perf_counter()
+        try:
+            paso()
+            pasos[nombre] = round(1000 * (time.perf_counter() - t0), 1)
+        except Exception as e:
+            pasos[nombre] = f"error: {e}"
+    _WARMUP_ESTADO.update(status="done", ms=round(1000 * (time.perf_counter() - inicio), 1), steps_ms=pasos)
+
+
+@app.on_event("startup")
+async def _startup_warmup() -> None:
+    if os.getenv("WARMUP", "1") == "0":
+        return
+    _WARMUP_ESTADO.update(status="pending")
+    threading.Thread(target=_warmup, name="warmup", daemon=True).start()
+
+
+def _doc_sesion_mongo(ses_id: str, ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: Optional[str], user_id: Optional[str] = None, titulo: Optional[str] = None) -> Dict[str, Any]:
     # obtener resumen como en el archivo original
     try:
         from reporte6_BernardoBojalil import extraer_bloque_por_titulo, resumen_corto
@@ -170,7 +614,7 @@ def _mongo_create_session(ruta_sueno: str, texto_sueno: str, contexto: str, inte
         resumen_interpretacion = extraer_bloque_por_titulo(interpretacion, "Interpretación general") or resumen_corto(interpretacion, 240)
     except Exception:
         resumen_interpretacion = None
-    doc = {
+    return {
         "id": ses_id,
         "user_id": user_id,
         "created_at": __import__("datetime").datetime.now().isoformat(timespec="seconds"),
@@ -184,13 +628,43 @@ def _mongo_create_session(ruta_sueno: str, texto_sueno: str, contexto: str, inte
         "interpretacion_resumen": (resumen_interpretacion or "").strip(),
         "followups": [],
     }
+
+
+def _mongo_create_session(ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: Optional[str], user_id: Optional[str] = None, titulo: Optional[str] = None):
+    col = _get_mongo_collection()
+    if col is None:
+        return None
+    ses_id = str(uuid4())
+    doc = _doc_sesion_mongo(ses_id, ruta_sueno, texto_sueno, contexto, interpretacion, ruta_salida, user_id, titulo)
     try:
         col.insert_one(doc)
+        _invalidar_memoria(user_id)
         return ses_id
     except Exception:
         return None
 
 
+def _mongo_create_sessions(docs: List[Dict[str, Any]]) -> List[int]:
+    """Inserta varias sesiones con un solo insert_many (ordered=False).
+    Devuelve los índices de los documentos que NO se guardaron."""
+    col = _get_mongo_collection()
+    if col is None:
+        return list(range(len(docs)))
+    if not docs:
+        return []
+    try:
+        col.insert_many(docs, ordered=False)
+        return []
+    except BulkWriteError as e:
+        return sorted({w.get("index") for w in (e.details or {}).get("writeErrors", [])})
+    except Exception as e:
+        print(f"Error guardando lote de sesiones en Mongo: {e}")
+        return list(range(len(docs)))
+    finally:
+        for user_id in {d.get("user_id") for d in docs}:
+            _invalidar_memoria(user_id)
+
+
 def _mongo_get_session(sesion_id: str, user_id: Optional[str] = None):
     col = _get_mongo_collection()
     if col is None:
@@ -213,7 +687,7 @@ def _mongo_list_sessions(limit: int = 5, user_id: Optional[str] = None):
         query = {}
         if user_id:
             query["user_id"] = user_id
-        cur = col.find(query, {"_id": 0, "id": 1, "created_at": 1, "archivo": 1, "interpretacion_resumen": 1, "output_file": 1, "title": 1, "titulo": 1}).sort("created_at", -1).limit(max(1, limit))
+        cur = col.find(query, {"_id": 0, "id": 1, "created_at": 1, "archivo": 1, "interpretacion_resumen": 1, "output_file": 1, "title": 1, "titulo": 1, "thumbnail_url": 1}).sort("created_at", -1).limit(max(1, limit))
         return list(cur)
     except Exception:
         return None
@@ -233,16 +707,26 @@ def _mongo_add_followup(sesion_id: str, pregunta: str, respuesta: str):
                 }
             }
         }
-        res = col.update_one({"id": sesion_id}, update)
-        return res.modified_count > 0
+        previo = col.find_one_and_update({"id": sesion_id}, update, projection={"_id": 0, "user_id": 1})
+        if previo is None:
+            return False
+        _invalidar_memoria(previo.get("user_id"))
+        return True
     except Exception:
         return False
 
 
-def _memoria_json_compacta_user(user_id: str, max_sessions: int = 5, max_followups: int = 3, max_chars: int = 20000) -> str:
-    """Devuelve un JSON compacto con las últimas sesiones del usuario para usar como contexto.
-    Similar a _memoria_json_compacta pero filtra por user_id.
+def _memoria_json_compacta_user(user_id: str, max_sessions: int = 5, max_followups: int = 3, max_tokens: int = 1500) -> str:
+    """Devuelve un JSON compacto con las últimas sesiones del usuario para usar como contexto,
+    ajustado a un presupuesto de tokens (sesiones y follow-ups completos, nunca texto cortado).
+    Similar a _memoria_json_compacta pero filtra por user_id. El resultado se cachea por
+    usuario y se invalida al crear/borrar sesiones o agregar follow-ups.
     """
+    clave = (user_id, max_sessions, max_followups, max_tokens)
+    cacheado = _memoria_cache_get(clave)
+    if cacheado is not None:
+        return cacheado
+    gen = _generacion_memoria(user_id)
     try:
         # Intentar obtener de MongoDB primero
         col = _get_mongo_collection()
@@ -255,47 +739,37 @@ def _memoria_json_compacta_user(user_id: str, max_sessions: int = 5, max_followu
                 sesiones = list(cur)
             except Exception:
                 sesiones = []
+                gen = None  # no cachear una memoria vacía por un fallo de Mongo
         else:
-            # Fallback a memoria JSON local
-            from reporte6_BernardoBojalil import MEM
-            todas = MEM.get("sessions", [])
-            # Filtrar por user_id si existe
-            sesiones = [s for s in todas if s.get("user_id") == user_id]
-            sesiones = sorted(sesiones, key=lambda x: x.get("created_at", ""), reverse=True)[:max_sessions]
-        
-        recortadas = []
-        for s in sesiones:
-            fu = s.get("followups", []) or []
-            if max_followups > 0:
-                fu = fu[-max_followups:]
-            recortadas.append({
-                "id": s.get("id"),
-                "created_at": s.get("created_at"),
-                "archivo": s.get("archivo"),
-                "contexto_emocional": s.get("contexto_emocional"),
-                "interpretacion_resumen": s.get("interpretacion_resumen"),
-                "followups": fu,
-            })
-        data = {"sessions": recortadas}
-        texto = json.dumps(data, ensure_ascii=False, indent=2)
-        if len(texto) > max_chars:
-            # Compactar y, si aún es largo, truncar con marca
-            texto_comp = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
-            if len(texto_comp) > max_chars:
-                return texto_comp[: max_chars - 1].rstrip() + "…"
-            return texto_comp
+            # Fallback a memoria JSON local (índice por usuario, ya ordenado)
+            from reporte6_BernardoBojalil import _ultimas_sesiones
+            sesiones = _ultimas_sesiones(max_sessions, user_id)
+
+        texto, _ = _ajustar_memoria(sesiones, max_followups, max_tokens)
+        if gen is not None:
+            _memoria_cache_set(clave, gen, texto)
         return texto
     except Exception as e:
         return f"{{\"error\": \"no se pudo construir memoria json: {str(e)}\"}}"
 
 
 # --- Auth Functions ---
+def _pwd_context():
+    """passlib + bcrypt se importan en el primer login/registro (o en el warm-up)."""
+    global _PWD_CONTEXT
+    if _PWD_CONTEXT is None:
+        from passlib.context import CryptContext
+
+        _PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _PWD_CONTEXT
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return _pwd_context().verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _pwd_context().hash(password)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -317,6 +791,9 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido")
+        traza = _TRAZA.get()
+        if traza is not None:
+            traza["user_id"] = user_id
         return {"user_id": user_id, "email": payload.get("email")}
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token inválido o expirado")
@@ -336,12 +813,14 @@ def _create_user_mongo(email: str, hashed_password: str, nombre: Optional[str] =
         "created_at": datetime.utcnow().isoformat(timespec="seconds"),
     }
     try:
-        # Verificar si el email ya existe
-        existing = col.find_one({"email": email})
-        if existing:
+        # El índice unique sobre email resuelve duplicados de forma atómica;
+        # solo si no se pudo verificar se consulta antes de insertar.
+        if not _indice_email_unico_ok() and col.find_one({"email": email}, {"_id": 1}):
             return None
         col.insert_one(doc)
         return user_id
+    except DuplicateKeyError:
+        return None
     except Exception:
         return None
 
@@ -403,302 +882,1755 @@ def get_me(current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str
     }
 
 
-# --- Image Generation ---
-def _generate_dream_image(descripcion: str, estilo: str = "surrealista y onírico", size: str = "1024x1024") -> tuple[Optional[str], Optional[str]]:
-    """Genera una imagen usando Gemini 2.5 Flash Image. Retorna (data_url, error_msg)."""
-    # Usar GEMINI_IMAGE_API_KEY si existe, sino usar GEMINI_API_KEY
-    gemini_key = os.getenv("GEMINI_IMAGE_API_KEY") or os.getenv("GEMINI_API_KEY")
-    if not gemini_key:
-        return None, "GEMINI_IMAGE_API_KEY o GEMINI_API_KEY no configurada"
+# --- Single-flight (coalescencia de peticiones idénticas en vuelo) ---
+# Si un cliente reintenta mientras la primera llamada sigue en curso, el duplicado se
+# engancha al mismo trabajo en vez de pagar Gemini dos veces y crear dos sesiones.
+# El trabajo corre como tarea propia: si el cliente original se desconecta, los
+# duplicados siguen recibiendo el resultado.
+_EN_VUELO: Dict[str, "asyncio.Task"] = {}
+_EN_VUELO_HUELLA: Dict[str, Optional[str]] = {}
+_SINGLE_FLIGHT_STATS = {"leaders": 0, "coalesced": 0}
+
+
+class HuellaDistinta(Exception):
+    """La clave ya está en vuelo con otra huella (mismo Idempotency-Key, otro cuerpo)."""
 
+
+async def _single_flight(clave: str, fabrica, huella: Optional[str] = None) -> Any:
+    """Ejecuta `fabrica()` una sola vez por clave mientras esté en vuelo y comparte el resultado.
+    Si se da `huella`, solo se une quien llega con la misma; si no, lanza HuellaDistinta."""
+    tarea = _EN_VUELO.get(clave)
+    if tarea is not None:
+        if _EN_VUELO_HUELLA.get(clave) != huella:
+            raise HuellaDistinta(clave)
+        _SINGLE_FLIGHT_STATS["coalesced"] += 1
+    else:
+        _SINGLE_FLIGHT_STATS["leaders"] += 1
+        tarea = asyncio.ensure_future(fabrica())
+        _EN_VUELO[clave] = tarea
+        _EN_VUELO_HUELLA[clave] = huella
+
+        def _terminar(_t) -> None:
+            _EN_VUELO.pop(clave, None)
+            _EN_VUELO_HUELLA.pop(clave, None)
+
+        tarea.add_done_callback(_terminar)
+    res = await asyncio.shield(tarea)
+    # Cada petición recibe su propia copia del resultado
+    return dict(res) if isinstance(res, dict) else res
+
+
+# --- Admission control (concurrencia acotada hacia Gemini) ---
+# Cada clase de llamada (interpretación, follow-up, título, imagen) tiene un máximo de
+# llamadas simultáneas y una cola de espera acotada. Con la cola llena, o si la espera
+# supera LLM_QUEUE_TIMEOUT_SECS, se responde 503 de inmediato con Retry-After en vez de
+# acumular peticiones que terminarían todas en timeout.
+class ServicioSaturado(Exception):
+    def __init__(self, clase: str, retry_after: int):
+        super().__init__(f"Servicio saturado ({clase})")
+        self.clase = clase
+        self.retry_after = retry_after
+
+
+async def _adquirir_con_timeout(sem: asyncio.Semaphore, espera: float) -> bool:
+    """Adquiere `sem` con límite de espera. Devuelve False si vence; nunca pierde un
+    permiso aunque el acquire termine justo cuando vence el tiempo o se cancela la petición
+    (asyncio.wait_for en Python < 3.12 podía descartar un acquire ya completado)."""
+    if hasattr(asyncio, "timeout"):
+        adquirido = False
+        try:
+            async with asyncio.timeout(espera):
+                await sem.acquire()
+                adquirido = True
+        except TimeoutError:
+            if adquirido:
+                sem.release()
+            return False
+        return True
+    # Python 3.10: esperar una tarea protegida y devolver el permiso si llegó tarde
+    tarea = asyncio.ensure_future(sem.acquire())
     try:
-        from google import genai
-        import base64
-        from io import BytesIO
+        await asyncio.wait_for(asyncio.shield(tarea), espera)
+        return True
+    except BaseException as e:
+        if tarea.done() and not tarea.cancelled():
+            sem.release()
+        else:
+            tarea.cancel()
+        if isinstance(e, asyncio.TimeoutError):
+            return False
+        raise
 
-        # Configurar cliente
-        client = genai.Client(api_key=gemini_key)
 
-        # Construir prompt
-        prompt = f"Create a dream illustration with {estilo} style: {descripcion}. Concept art, dreamlike atmosphere, vibrant colors, high quality, detailed"
+class _LimiteConcurrencia:
+    def __init__(self, clase: str, max_concurrentes: int, max_cola: int):
+        self.clase = clase
+        self.max_concurrentes = max(1, max_concurrentes)
+        self.max_cola = max(0, max_cola)
+        self.reiniciar()
+        self.rechazadas = 0
+        self.esperas = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+        self.servicio_ewma = 1.0  # segundos por llamada (media móvil)
+
+    def reiniciar(self) -> None:
+        """Semáforo nuevo para el event loop actual (asyncio.Semaphore queda ligado al
+        primer loop que lo usa); se llama en el arranque de la app."""
+        self._sem = asyncio.Semaphore(self.max_concurrentes)
+        self.en_curso = 0
+        self.en_cola = 0
+
+    def retry_after(self) -> int:
+        return min(60, max(1, math.ceil(self.servicio_ewma * (self.en_cola + 1) / self.max_concurrentes)))
+
+    def saturado(self) -> bool:
+        return self.en_curso >= self.max_concurrentes and self.en_cola >= self.max_cola
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.saturado():
+            self.rechazadas += 1
+            raise ServicioSaturado(self.clase, self.retry_after())
+        self.en_cola += 1
+        t0 = time.monotonic()
+        try:
+            if not await _adquirir_con_timeout(self._sem, _env_int("LLM_QUEUE_TIMEOUT_SECS", 10)):
+                self.rechazadas += 1
+                raise ServicioSaturado(self.clase, self.retry_after())
+        finally:
+            self.en_cola -= 1
+            espera = time.monotonic() - t0
+            self.esperas += 1
+            self.espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+            _M_ADMISION.observar(espera, **{"class": self.clase})
+        self.en_curso += 1
+        t1 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.en_curso -= 1
+            self._sem.release()
+            self.servicio_ewma = 0.8 * self.servicio_ewma + 0.2 * (time.monotonic() - t1)
 
-        if len(prompt) > 2000:
-            prompt = prompt[:1997] + "..."
+    def metricas(self) -> Dict[str, Any]:
+        return {
+            "limit": self.max_concurrentes,
+            "in_flight": self.en_curso,
+            "queued": self.en_cola,
+            "max_queue": self.max_cola,
+            "rejected": self.rechazadas,
+            "wait_avg_ms": round(1000 * self.espera_total / self.esperas, 1) if self.esperas else 0.0,
+            "wait_max_ms": round(1000 * self.espera_max, 1),
+        }
 
-        # Generar imagen con Gemini 2.5 Flash Image
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-image",
-            contents=[prompt],
-        )
 
-        # Extraer la imagen de la respuesta
-        # La respuesta contiene candidates con parts
-        if hasattr(response, 'candidates') and response.candidates:
-            for candidate in response.candidates:
-                if hasattr(candidate, 'content') and candidate.content:
-                    for part in candidate.content.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data is not None:
-                            # inline_data contiene mime_type y data (bytes)
-                            image_bytes = part.inline_data.data
-                            img_b64 = base64.b64encode(image_bytes).decode()
-                            
-                            # Determinar el tipo de imagen del mime_type
-                            mime_type = part.inline_data.mime_type or "image/png"
-                            if "jpeg" in mime_type or "jpg" in mime_type:
-                                image_url = f"data:image/jpeg;base64,{img_b64}"
-                            else:
-                                image_url = f"data:image/png;base64,{img_b64}"
-                            
-                            return image_url, None
-        
-        return None, "No se generó ninguna imagen en la respuesta"
+def _crear_limite(clase: str, env: str, max_defecto: int, cola_defecto: int) -> _LimiteConcurrencia:
+    return _LimiteConcurrencia(clase, _env_int(f"LLM_MAX_CONCURRENCY_{env}", max_defecto), _env_int(f"LLM_MAX_QUEUE_{env}", cola_defecto))
 
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error generando imagen: {error_msg}")
-        return None, error_msg
 
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error generando imagen: {error_msg}")
-        return None, error_msg
+_LIMITES: Dict[str, _LimiteConcurrencia] = {
+    "interpretacion": _crear_limite("interpretacion", "INTERPRETE", 16, 64),
+    "followup": _crear_limite("followup", "FOLLOWUP", 16, 64),
+    "titulo": _crear_limite("titulo", "TITULO", 16, 64),
+    "imagen": _crear_limite("imagen", "IMAGEN", 4, 16),
+}
 
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error generando imagen: {error_msg}")
-        return None, error_msg
 
+@app.on_event("startup")
+async def _startup_limites() -> None:
+    for limite in _LIMITES.values():
+        limite.reiniciar()
 
-@app.post("/generate-image")
-def generate_image(req: GenerateImageRequest, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
-    """Genera una imagen del sueño usando Gemini 2.5 Flash Image."""
-    if not os.getenv("GEMINI_API_KEY"):
-        raise HTTPException(status_code=503, detail="GEMINI_API_KEY no configurada. Añádela a las variables de entorno.")
-    
-    descripcion = (req.descripcion_sueno or "").strip()
-    if not descripcion:
-        raise HTTPException(status_code=400, detail="descripcion_sueno requerida")
-    
-    # Generar imagen
-    image_url, error_msg = _generate_dream_image(descripcion, req.estilo or "surrealista y onírico", req.size or "1024x1024")
-    
-    if not image_url:
-        detail_msg = f"No se pudo generar la imagen: {error_msg}" if error_msg else "No se pudo generar la imagen. Revisa tu API key de OpenAI."
-        raise HTTPException(status_code=502, detail=detail_msg)
-    
-    # Si hay sesion_id, actualizar la sesión en Mongo con la URL de la imagen
-    if req.sesion_id and _get_mongo_collection() is not None:
+
+@app.exception_handler(ServicioSaturado)
+async def _servicio_saturado_handler(request: Request, exc: ServicioSaturado) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Servicio saturado ({exc.clase}); reintenta en {exc.retry_after} s"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+def _rechazar_si_saturado(clase: str) -> None:
+    """Chequeo rápido previo (p. ej. antes de abrir un stream SSE)."""
+    limite = _LIMITES[clase]
+    if limite.saturado():
+        limite.rechazadas += 1
+        raise ServicioSaturado(clase, limite.retry_after())
+
+
+# --- Circuit breaker (Gemini texto) ---
+# Registra el resultado de las últimas llamadas a las cadenas de texto. Si la proporción de
+# errores/timeouts supera CB_FAILURE_RATIO, el circuito se abre durante CB_OPEN_SECS: las
+# interpretaciones pasan directo al fallback offline y el follow-up responde 503. Después
+# se deja pasar una sola llamada de prueba (half-open) que decide si se cierra o se reabre.
+class CircuitoAbierto(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Gemini no disponible temporalmente (circuito abierto)")
+        self.retry_after = retry_after
+
+
+class _CircuitBreaker:
+    def __init__(self, ventana: int, min_llamadas: int, ratio_fallo: float, segundos_abierto: float):
+        self.ventana = max(1, ventana)
+        self.min_llamadas = max(1, min_llamadas)
+        self.ratio_fallo = ratio_fallo
+        self.segundos_abierto = segundos_abierto
+        self.estado = "closed"
+        self._resultados: List[bool] = []
+        self._abierto_hasta = 0.0
+        self._sonda_en_curso = False
+        self.aperturas = 0
+        self.rechazadas = 0
+        self._lock = threading.Lock()
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._abierto_hasta - time.monotonic()))
+
+    def rechazar_si_abierto(self) -> None:
+        """Chequeo rápido sin consumir la llamada de prueba."""
+        with self._lock:
+            if self.estado == "open" and time.monotonic() < self._abierto_hasta:
+                self.rechazadas += 1
+                raise CircuitoAbierto(self._retry_after())
+
+    def _admitir(self) -> bool:
+        with self._lock:
+            if self.estado == "open":
+                if time.monotonic() < self._abierto_hasta:
+                    self.rechazadas += 1
+                    raise CircuitoAbierto(self._retry_after())
+                self.estado = "half_open"
+            if self.estado == "half_open":
+                if self._sonda_en_curso:
+                    self.rechazadas += 1
+                    raise CircuitoAbierto(1)
+                self._sonda_en_curso = True
+                return True
+            return False
+
+    def _registrar(self, exito: Optional[bool], sonda: bool) -> None:
+        with self._lock:
+            if sonda:
+                self._sonda_en_curso = False
+            if exito is None:
+                return
+            if sonda or self.estado == "half_open":
+                if exito:
+                    self.estado = "closed"
+                    self._resultados = []
+                else:
+                    self._abrir()
+                return
+            self._resultados.append(exito)
+            if len(self._resultados) > self.ventana:
+                del self._resultados[0]
+            fallos = self._resultados.count(False)
+            if len(self._resultados) >= self.min_llamadas and fallos / len(self._resultados) >= self.ratio_fallo:
+                self._abrir()
+
+    def _abrir(self) -> None:
+        self.estado = "open"
+        self._abierto_hasta = time.monotonic() + self.segundos_abierto
+        self._resultados = []
+        self.aperturas += 1
+        print(f"[WARN] Circuit breaker de Gemini abierto durante {self.segundos_abierto:g} s")
+
+    @asynccontextmanager
+    async def llamada(self):
+        """Envuelve una llamada a Gemini; errores y timeouts cuentan como fallo.
+        La saturación local (ServicioSaturado) y las cancelaciones no cuentan.
+        """
+        sonda = self._admitir()
+        exito: Optional[bool] = None
         try:
-            col = _get_mongo_collection()
-            user_id = current_user["user_id"]
-            col.update_one(
-                {"id": req.sesion_id, "user_id": user_id},
-                {"$set": {"image_url": image_url, "image_generated_at": datetime.utcnow().isoformat(timespec="seconds")}}
-            )
+            yield
+            exito = True
+        except ServicioSaturado:
+            raise
         except Exception:
-            pass
-    
-    return {
-        "image_url": image_url,
-        "descripcion": descripcion,
-        "estilo": req.estilo,
-        "size": req.size,
-    }
+            exito = False
+            raise
+        finally:
+            self._registrar(exito, sonda)
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            estado = self.estado
+            if estado == "open" and time.monotonic() >= self._abierto_hasta:
+                estado = "half_open"
+            return {
+                "state": estado,
+                "window_calls": len(self._resultados),
+                "window_failures": self._resultados.count(False),
+                "opened": self.aperturas,
+                "rejected": self.rechazadas,
+                "retry_after": self._retry_after() if estado == "open" else 0,
+            }
 
 
-# --- Title Generation ---
-def _generate_dream_title(descripcion: str) -> tuple[Optional[str], Optional[str]]:
-    """Genera un título breve del sueño usando Gemini. Retorna (title, error_msg)."""
-    # Usar GEMINI_TEXT_API_KEY si existe, sino usar GEMINI_API_KEY
-    gemini_key = os.getenv("GEMINI_TEXT_API_KEY") or os.getenv("GEMINI_API_KEY")
-    if not gemini_key:
-        return None, "GEMINI_TEXT_API_KEY o GEMINI_API_KEY no configurada"
-    
+def _crear_breaker() -> _CircuitBreaker:
     try:
-        from reporte6_BernardoBojalil import ChatGoogleGenerativeAI, LANGCHAIN_OK
-        
-        if not LANGCHAIN_OK or ChatGoogleGenerativeAI is None:
-            return None, "LangChain o ChatGoogleGenerativeAI no disponible"
-        
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=gemini_key,
-            temperature=0.7,
-        )
-        
-        # Prompt para generar título corto y descriptivo
-        prompt = f"""Genera un título muy breve y descriptivo (máximo 6 palabras) para este sueño. 
-Solo devuelve el título, sin explicaciones adicionales.
+        ratio = float(os.getenv("CB_FAILURE_RATIO", "0.5"))
+    except ValueError:
+        ratio = 0.5
+    try:
+        segundos = float(os.getenv("CB_OPEN_SECS", "30"))
+    except ValueError:
+        segundos = 30.0
+    return _CircuitBreaker(_env_int("CB_WINDOW", 20), _env_int("CB_MIN_CALLS", 5), ratio, segundos)
 
-Sueño: {descripcion[:500]}
 
-Título:"""
-        
-        response = llm.invoke(prompt)
-        title = response.content.strip().strip('"').strip("'")
-        
-        # Limitar a 60 caracteres máximo
-        if len(title) > 60:
-            title = title[:57] + "..."
-        
-        return title, None
-        
-    except Exception as e:
-        error_msg = str(e)
-        print(f"Error generando título: {error_msg}")
-        return None, error_msg
+_BREAKER_GEMINI = _crear_breaker()
 
 
-@app.post("/generate-title")
-def generate_title(req: GenerateTitleRequest, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
-    """Genera un título breve del sueño usando Gemini."""
-    if not os.getenv("GEMINI_API_KEY"):
-        raise HTTPException(status_code=503, detail="GEMINI_API_KEY no configurada.")
-    
-    descripcion = (req.descripcion_sueno or "").strip()
-    if not descripcion:
-        raise HTTPException(status_code=400, detail="descripcion_sueno requerida")
-    
-    # Generar título
-    title, error_msg = _generate_dream_title(descripcion)
-    
-    if not title:
-        detail_msg = f"No se pudo generar el título: {error_msg}" if error_msg else "No se pudo generar el título."
-        raise HTTPException(status_code=502, detail=detail_msg)
-    
-    return {
-        "title": title,
-        "titulo": title,
-    }
+@app.exception_handler(CircuitoAbierto)
+async def _circuito_abierto_handler(request: Request, exc: CircuitoAbierto) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"{exc}; reintenta en {exc.retry_after} s"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 
-@app.get("/health")
-def health() -> Dict[str, Any]:
-    try:
-        ok_interprete = construir_cadena_interprete() is not None
-    except Exception:
-        ok_interprete = False
-    mongo_enabled = _get_mongo_collection() is not None
-    return {"status": "ok", "llm_available": ok_interprete, "mongo": mongo_enabled}
+# --- Rate limiting por usuario ---
+# Token bucket por (user_id, clase de endpoint) en memoria del proceso, más una cuota diaria
+# (día UTC). Con RATE_LIMIT_SHARED=1 y Mongo disponible, los contadores se comparten entre
+# workers en la colección rate_limits (ventana fija de 60 s + contador diario, con índice TTL).
+# Las cabeceras X-RateLimit-* y X-Quota-* se añaden a todas las respuestas de esos endpoints
+# (las que no cobran muestran el estado consultado sin consumir).
+# clase -> (peticiones por minuto, ráfaga, cuota diaria; 0 = sin cuota)
+_RATE_DEFECTOS: Dict[str, tuple[int, int, int]] = {
+    "interpretacion": (10, 20, 500),
+    "followup": (20, 40, 1000),
+    "titulo": (20, 40, 1000),
+    "imagen": (2, 5, 50),
+    "batch": (2, 5, 20),
+}
+_BUCKETS: Dict[tuple[str, str], List[float]] = {}  # (user_id, clase) -> [tokens, ts]
+_CUOTAS: Dict[tuple[str, str], List[Any]] = {}  # (user_id, clase) -> [día, usados]
+_RATE_LOCK = threading.Lock()
+_RATE_MAX_ENTRADAS = 10000
+
+
+def _rate_limit_habilitado() -> bool:
+    return os.getenv("RATE_LIMIT", "1") != "0"
+
+
+def _config_rate(clase: str) -> tuple[int, int, int]:
+    por_min, rafaga, diario = _RATE_DEFECTOS[clase]
+    env = clase.upper()
+    return (
+        max(1, _env_int(f"RATE_{env}_PER_MIN", por_min)),
+        max(1, _env_int(f"RATE_{env}_BURST", rafaga)),
+        max(0, _env_int(f"QUOTA_{env}_DAILY", diario)),
+    )
 
 
-@app.post("/interpret-text")
-def interpret_text(req: InterpretTextRequest, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
-    texto = (req.texto_sueno or "").strip()
-    if not texto:
-        raise HTTPException(status_code=400, detail="texto_sueno requerido")
+def _rate_limit_compartido():
+    """Colección Mongo de contadores compartidos, o None si no está activa."""
+    if os.getenv("RATE_LIMIT_SHARED", "0") != "1":
+        return None
+    db = _get_mongo_db()
+    if db is None:
+        return None
+    return db["rate_limits"]
+
+
+def _segundos_hasta_medianoche() -> int:
+    ahora = datetime.utcnow()
+    manana = (ahora + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(1, int((manana - ahora).total_seconds()))
+
+
+def _podar_rate_local(ahora: float, hoy: str) -> None:
+    """Evita que los diccionarios crezcan sin límite: descarta buckets ya llenos
+    (equivalen a uno nuevo) y cuotas de días anteriores. Se llama con _RATE_LOCK tomado."""
+    if len(_BUCKETS) > _RATE_MAX_ENTRADAS:
+        for k in [k for k, (tokens, ts) in _BUCKETS.items() if tokens + (ahora - ts) * _config_rate(k[1])[0] / 60.0 >= _config_rate(k[1])[1]]:
+            del _BUCKETS[k]
+    if len(_CUOTAS) > _RATE_MAX_ENTRADAS:
+        for k in [k for k, (dia, _) in _CUOTAS.items() if dia != hoy]:
+            del _CUOTAS[k]
+
+
+def _consumir_local(user_id: str, clase: str, unidades: int = 1) -> Dict[str, Any]:
+    """Descuenta `unidades` del bucket y de la cuota diaria. Basta con un token disponible
+    para empezar: un lote deja el bucket en negativo (deuda que se repone a la tasa normal),
+    pero la cuota diaria nunca se supera. Con unidades=0 solo consulta el estado."""
+    por_min, rafaga, diario = _config_rate(clase)
+    tasa = por_min / 60.0
+    ahora = time.monotonic()
+    hoy = datetime.utcnow().strftime("%Y-%m-%d")
+    with _RATE_LOCK:
+        _podar_rate_local(ahora, hoy)
+        tokens, ts = _BUCKETS.get((user_id, clase), [float(rafaga), ahora])
+        tokens = min(float(rafaga), tokens + (ahora - ts) * tasa)
+        dia, usados = _CUOTAS.get((user_id, clase), [hoy, 0])
+        if dia != hoy:
+            dia, usados = hoy, 0
+        sin_cuota = diario > 0 and usados + unidades > diario
+        permitido = tokens >= 1.0 and not sin_cuota
+        if permitido:
+            tokens -= unidades
+            usados += unidades
+        _BUCKETS[(user_id, clase)] = [tokens, ahora]
+        _CUOTAS[(user_id, clase)] = [dia, usados]
+    return {
+        "permitido": permitido,
+        "sin_cuota": sin_cuota,
+        "limite": rafaga,
+        "restantes": max(0, int(tokens)),
+        "reset": max(0, math.ceil((rafaga - tokens) / tasa)),
+        "espera": 0 if tokens >= 1.0 else math.ceil((1.0 - tokens) / tasa),
+        "cuota": diario,
+        "cuota_usada": usados,
+    }
 
-    user_id = current_user["user_id"]
 
-    # Modo offline forzado si se solicita o por env
-    if bool(req.offline) or os.getenv("FORCE_OFFLINE", "0") == "1":
-        interpretacion = interpretar_offline(texto, req.contexto_emocional or "")
-        ruta_salida: Optional[str] = None
-        if req.save:
-            base = req.filename if (req.filename and req.filename.strip()) else "sueño_api.txt"
-            try:
-                from reporte6_BernardoBojalil import guardar_interpretacion
-                ruta_salida = guardar_interpretacion(base, interpretacion)
-            except Exception:
-                ruta_salida = None
-        sesion_id = None
-        if _get_mongo_collection() is not None:
-            sesion_id = _mongo_create_session(req.filename or "(API)", texto, req.contexto_emocional or "", interpretacion, ruta_salida, user_id)
-        if not sesion_id:
-            try:
-                sesion_id = _crear_sesion(req.filename or "(API)", texto, req.contexto_emocional or "", interpretacion, ruta_salida)
-            except Exception:
-                sesion_id = None
-        return {"interpretacion": interpretacion, "ruta_salida": ruta_salida, "sesion_id": sesion_id}
+def _consumir_mongo(col, user_id: str, clase: str, unidades: int = 1) -> Dict[str, Any]:
+    from pymongo import ReturnDocument
 
-    chain = construir_cadena_interprete()
-    interpretacion = ""
-    if chain is not None:
+    por_min, _, diario = _config_rate(clase)
+    ahora = datetime.utcnow()
+    ventana = int(time.time() // 60)
+    espera = 60 - int(time.time() % 60)
+    doc = col.find_one_and_update(
+        {"_id": f"{user_id}:{clase}:m:{ventana}"},
+        {"$inc": {"n": unidades}, "$setOnInsert": {"expire_at": ahora + timedelta(seconds=120)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    n = int(doc.get("n", unidades))
+    permitido = n - unidades < por_min  # había hueco en la ventana al empezar
+    id_dia = f"{user_id}:{clase}:d:{ahora.strftime('%Y-%m-%d')}"
+    sin_cuota = bool(diario) and unidades > diario
+    if permitido and not sin_cuota:
+        # Con cuota, solo se incrementa si cabe completo (sin pasarse del límite)
+        filtro: Dict[str, Any] = {"_id": id_dia}
+        if diario:
+            filtro["n"] = {"$lte": diario - unidades}
         try:
-            # Construir memoria previa según utilidades existentes
-            from os import getenv
+            doc = col.find_one_and_update(
+                filtro,
+                {"$inc": {"n": unidades}, "$setOnInsert": {"expire_at": ahora + timedelta(days=2)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            usados = int(doc.get("n", unidades))
+        except DuplicateKeyError:
+            # El documento del día existe pero no cumple el filtro: cuota insuficiente
+            sin_cuota = True
+    permitido = permitido and not sin_cuota
+    if not permitido:
+        usados = int((col.find_one({"_id": id_dia}) or {}).get("n", 0))
+    return {
+        "permitido": permitido,
+        "sin_cuota": sin_cuota,
+        "limite": por_min,
+        "restantes": max(0, por_min - n),
+        "reset": espera,
+        "espera": 0 if n <= por_min else espera,
+        "cuota": diario,
+        "cuota_usada": min(usados, diario) if diario else usados,
+    }
 
+
+def _consultar_mongo(col, user_id: str, clase: str) -> Dict[str, Any]:
+    """Estado de la ventana y del contador diario compartidos, sin consumir."""
+    por_min, _, diario = _config_rate(clase)
+    ahora = datetime.utcnow()
+    espera = 60 - int(time.time() % 60)
+    n = int((col.find_one({"_id": f"{user_id}:{clase}:m:{int(time.time() // 60)}"}) or {}).get("n", 0))
+    usados = int((col.find_one({"_id": f"{user_id}:{clase}:d:{ahora.strftime('%Y-%m-%d')}"}) or {}).get("n", 0))
+    sin_cuota = bool(diario) and usados >= diario
+    return {
+        "permitido": n < por_min and not sin_cuota,
+        "sin_cuota": sin_cuota,
+        "limite": por_min,
+        "restantes": max(0, por_min - n),
+        "reset": espera,
+        "espera": 0 if n < por_min else espera,
+        "cuota": diario,
+        "cuota_usada": min(usados, diario) if diario else usados,
+    }
+
+
+def _headers_uso(uso: Dict[str, Any], sufijo: str = "") -> Dict[str, str]:
+    headers = {
+        "X-RateLimit-Limit" + sufijo: str(uso["limite"]),
+        "X-RateLimit-Remaining" + sufijo: str(uso["restantes"]),
+        "X-RateLimit-Reset" + sufijo: str(uso["reset"]),
+    }
+    if uso["cuota"]:
+        headers["X-Quota-Limit" + sufijo] = str(uso["cuota"])
+        headers["X-Quota-Remaining" + sufijo] = str(max(0, uso["cuota"] - uso["cuota_usada"]))
+        headers["X-Quota-Reset" + sufijo] = str(_segundos_hasta_medianoche())
+    return headers
+
+
+async def _medir_uso(user_id: str, clase: str, unidades: int) -> Dict[str, Any]:
+    """Consume (o con unidades=0 solo consulta) en Mongo si está compartido; si no, o si
+    Mongo falla, en los contadores locales."""
+    col = _rate_limit_compartido()
+    if col is not None:
+        try:
+            if unidades:
+                return await run_in_threadpool(_consumir_mongo, col, user_id, clase, unidades)
+            return await run_in_threadpool(_consultar_mongo, col, user_id, clase)
+        except Exception as e:
+            print(f"Aviso: rate limit compartido no disponible, usando memoria local: {e}")
+    return _consumir_local(user_id, clase, unidades)
+
+
+def _anotar_headers_uso(request: Request, clase: str, uso: Dict[str, Any]) -> None:
+    """Guarda las cabeceras de uso para _UsoHeadersMiddleware. Las de la clase del endpoint
+    van sin sufijo; las de otra clase cobrada en la misma petición (el lote también cobra
+    interpretaciones) llevan la clase como sufijo, p. ej. X-Quota-Remaining-Interpretacion."""
+    sufijo = "" if clase == getattr(request.state, "clase_uso", None) else "-" + clase.capitalize()
+    request.state.uso_headers = {**(getattr(request.state, "uso_headers", None) or {}), **_headers_uso(uso, sufijo)}
+
+
+def _limite_uso(clase: str):
+    """Dependencia que autentica (get_current_user) y anota la clase de endpoint. No cobra:
+    FastAPI resuelve las dependencias antes de validar el cuerpo, así que el endpoint llama
+    a _cobrar_uso después de validar (un 400/422 no consume cuota) y fuera de los replays
+    de Idempotency-Key. Sí consulta el estado, para que las respuestas que no cobran
+    (errores de validación, replays) también lleven las cabeceras de uso."""
+
+    async def dependencia(request: Request, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
+        request.state.clase_uso = clase
+        if _rate_limit_habilitado():
+            _anotar_headers_uso(request, clase, await _medir_uso(current_user["user_id"], clase, 0))
+        return current_user
+
+    return dependencia
+
+
+async def _cobrar_uso(request: Request, current_user: Dict[str, Any], clase: Optional[str] = None, unidades: int = 1) -> None:
+    """Consume `unidades` del presupuesto del usuario para la clase del endpoint (la de
+    _limite_uso por defecto); responde 429 con Retry-After si se agotó o si la cuota
+    diaria restante no alcanza."""
+    if not _rate_limit_habilitado():
+        return
+    clase = clase or request.state.clase_uso
+    uso = await _medir_uso(current_user["user_id"], clase, unidades)
+    _anotar_headers_uso(request, clase, uso)
+    if not uso["permitido"]:
+        if uso["sin_cuota"]:
+            restante = max(0, uso["cuota"] - uso["cuota_usada"])
+            raise HTTPException(
+                status_code=429,
+                detail="Cuota diaria agotada para este tipo de petición" if unidades == 1 or not restante else f"Cuota diaria insuficiente: quedan {restante} y se piden {unidades}",
+                headers={"Retry-After": str(_segundos_hasta_medianoche())},
+            )
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas peticiones; intenta más tarde",
+            headers={"Retry-After": str(max(1, uso["espera"]))},
+        )
+
+
+class _UsoHeadersMiddleware:
+    """Añade las cabeceras de uso (guardadas en request.state por _cobrar_uso) a la
+    respuesta final, incluidas las de error y las de streaming."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_con_uso(message):
+            if message["type"] == "http.response.start":
+                extra = scope.get("state", {}).get("uso_headers")
+                if extra:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in extra.items()
+                    ]
+            await send(message)
+
+        await self.app(scope, receive, send_con_uso)
+
+
+app.add_middleware(_UsoHeadersMiddleware)
+
+
+# --- Idempotency-Key ---
+# Los clientes móviles reintentan POST /interpret-text e /interpret-file en redes
+# inestables. Con el header Idempotency-Key, la primera respuesta se guarda con TTL
+# (colección `idempotency_keys` junto a las sesiones, o en la memoria JSON local) y
+# los reintentos la reciben sin recalcular. Un reintento concurrente espera a que
+# termine la primera petición (en el mismo proceso vía single-flight; entre workers
+# consultando el registro "pending" en Mongo).
+IDEMPOTENCY_TTL_SECS = _env_int("IDEMPOTENCY_TTL_SECS", 86400)
+
+
+def _idempotencia_col():
+    db = _get_mongo_db()
+    if db is None:
+        return None
+    return db["idempotency_keys"]
+
+
+def _idem_lease_secs() -> int:
+    """Vigencia del reclamo "pending". El dueño lo renueva cada tercio de este tiempo
+    mientras la petición sigue viva (cola de admisión, título y persistencia incluidos),
+    así que solo vence si el worker se cayó."""
+    return max(5, _env_int("IDEMPOTENCY_LEASE_SECS", 30))
+
+
+def _idem_reclamar_mongo(col, id_: str, huella: str, dueno: str) -> Optional[Dict[str, Any]]:
+    """Intenta reclamar la clave (registro "pending"). Devuelve None si se reclamó,
+    o el registro existente si otra petición ya la tiene."""
+    vence = datetime.utcnow() + timedelta(seconds=_idem_lease_secs())
+    try:
+        col.insert_one({"_id": id_, "status": "pending", "fingerprint": huella, "owner": dueno, "expire_at": vence})
+        return None
+    except DuplicateKeyError:
+        existente = col.find_one({"_id": id_})
+        if existente is not None and existente.get("status") == "pending" and existente.get("expire_at") and existente["expire_at"] < datetime.utcnow():
+            # Reclamo abandonado (worker caído, sin renovaciones): tomarlo. Solo si sigue
+            # siendo el mismo registro vencido, no uno renovado o reclamado mientras tanto.
+            col.delete_one({"_id": id_, "status": "pending", "expire_at": existente["expire_at"]})
+            return _idem_reclamar_mongo(col, id_, huella, dueno)
+        return existente or {"status": "pending", "fingerprint": huella}
+
+
+async def _idem_renovar_reclamo(col, id_: str, dueno: str) -> None:
+    """Latido del reclamo mientras la petición se ejecuta; se cancela al terminar."""
+    while True:
+        await asyncio.sleep(_idem_lease_secs() / 3)
+        vence = datetime.utcnow() + timedelta(seconds=_idem_lease_secs())
+        try:
+            await run_in_threadpool(col.update_one, {"_id": id_, "status": "pending", "owner": dueno}, {"$set": {"expire_at": vence}})
+        except Exception as e:
+            print(f"Aviso: no se pudo renovar el reclamo de Idempotency-Key: {e}")
+
+
+def _idem_verificar_huella(reg: Dict[str, Any], huella: str) -> None:
+    if reg.get("fingerprint") != huella:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con un cuerpo distinto")
+
+
+async def _ejecutar_idempotente(id_: str, huella: str, fabrica) -> tuple[Any, bool]:
+    """Devuelve (respuesta, es_replay)."""
+    col = _idempotencia_col()
+    if col is None:
+        from reporte6_BernardoBojalil import _buscar_idempotencia, _guardar_idempotencia
+
+        reg = _buscar_idempotencia(id_)
+        if reg is not None:
+            _idem_verificar_huella(reg, huella)
+            return reg["response"], True
+        res = await fabrica()
+        await run_in_threadpool(_guardar_idempotencia, id_, {"fingerprint": huella, "response": res, "expire_at": time.time() + IDEMPOTENCY_TTL_SECS})
+        return res, False
+
+    espera_max = _llm_timeout_secs() + _env_int("IDEMPOTENCY_WAIT_EXTRA_SECS", 10)
+    inicio = time.monotonic()
+    dueno = uuid4().hex
+    reg = await run_in_threadpool(_idem_reclamar_mongo, col, id_, huella, dueno)
+    while reg is not None and reg.get("status") == "pending":
+        # Otro worker procesa la misma clave: esperar su respuesta
+        _idem_verificar_huella(reg, huella)
+        if time.monotonic() - inicio > espera_max:
+            raise HTTPException(status_code=409, detail="Petición con esta Idempotency-Key aún en curso")
+        await asyncio.sleep(0.25)
+        reg = await run_in_threadpool(col.find_one, {"_id": id_})
+        if reg is None:
+            # El primero falló y liberó la clave: reclamarla
+            reg = await run_in_threadpool(_idem_reclamar_mongo, col, id_, huella, dueno)
+    if reg is not None:
+        _idem_verificar_huella(reg, huella)
+        return reg.get("response"), True
+
+    latido = asyncio.ensure_future(_idem_renovar_reclamo(col, id_, dueno))
+    try:
+        res = await fabrica()
+    except BaseException:
+        # Liberar la clave para que un reintento pueda volver a intentarlo
+        await run_in_threadpool(col.delete_one, {"_id": id_, "status": "pending", "owner": dueno})
+        raise
+    finally:
+        latido.cancel()
+    vence = datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL_SECS)
+    await run_in_threadpool(col.update_one, {"_id": id_}, {"$set": {"status": "done", "response": res, "expire_at": vence}})
+    return res, False
+
+
+async def _con_idempotencia(clave_cliente: Optional[str], user_id: str, endpoint: str, huella: str, response: Response, fabrica) -> Any:
+    """Aplica Idempotency-Key (si viene) alrededor de `fabrica()`; sin header ejecuta directo."""
+    if not clave_cliente:
+        return await fabrica()
+    if len(clave_cliente) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado larga (máx. 255)")
+    id_ = _hash_hex("idempotency", user_id, endpoint, clave_cliente)
+    clave = "idem:" + id_
+    # Quien se une a la petición en vuelo recibe una respuesta que no generó: también es replay
+    unido = clave in _EN_VUELO
+    try:
+        res, replay = await _single_flight(clave, lambda: _ejecutar_idempotente(id_, huella, fabrica), huella=huella)
+    except HuellaDistinta:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con un cuerpo distinto")
+    if replay or unido:
+        response.headers["Idempotent-Replayed"] = "true"
+    return dict(res) if isinstance(res, dict) else res
+
+
+# --- Image Store (content-addressed) ---
+# Las imágenes se guardan una sola vez, identificadas por el sha256 de su contenido,
+# en GridFS (si hay Mongo) o en un directorio local. Las sesiones guardan solo la
+# referencia (`image_id` / `image_url`) y las imágenes se sirven desde GET /images/{id}.
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "imagenes")
+_EXT_POR_MIME = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+_MIME_POR_EXT = {v: k for k, v in _EXT_POR_MIME.items()}
+
+
+def _image_store_backend() -> str:
+    """"gridfs" o "local" según IMAGE_STORE (auto por defecto: GridFS si hay Mongo)."""
+    modo = os.getenv("IMAGE_STORE", "auto").lower()
+    if modo == "local":
+        return "local"
+    if _get_mongo_db() is not None and modo in ("auto", "gridfs"):
+        return "gridfs"
+    return "local"
+
+
+def _gridfs():
+    import gridfs
+
+    return gridfs.GridFS(_get_mongo_db(), collection="images")
+
+
+def _ruta_blob_local(blob_id: str, ext: str) -> str:
+    return os.path.join(IMAGE_STORE_DIR, blob_id[:2], blob_id + ext)
+
+
+def _guardar_blob(data: bytes, mime_type: str) -> str:
+    """Guarda el contenido si no existe todavía y devuelve su id (sha256 hex)."""
+    import hashlib
+
+    blob_id = hashlib.sha256(data).hexdigest()
+    if _image_store_backend() == "gridfs":
+        fs = _gridfs()
+        if not fs.exists({"filename": blob_id}):
+            fs.put(data, filename=blob_id, metadata={"contentType": mime_type})
+        return blob_id
+    ruta = _ruta_blob_local(blob_id, _EXT_POR_MIME.get(mime_type, ".bin"))
+    if not os.path.exists(ruta):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = f"{ruta}.{uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, ruta)
+    return blob_id
+
+
+def _leer_blob(blob_id: str) -> Optional[tuple[bytes, str]]:
+    """Devuelve (bytes, mime_type) del blob o None si no existe."""
+    if _image_store_backend() == "gridfs":
+        try:
+            out = _gridfs().find_one({"filename": blob_id})
+        except Exception:
+            out = None
+        if out is not None:
+            return out.read(), (out.metadata or {}).get("contentType", "application/octet-stream")
+    carpeta = os.path.join(IMAGE_STORE_DIR, blob_id[:2])
+    for ext, mime in list(_MIME_POR_EXT.items()) + [(".bin", "application/octet-stream")]:
+        ruta = os.path.join(carpeta, blob_id + ext)
+        if os.path.exists(ruta):
+            with open(ruta, "rb") as f:
+                return f.read(), mime
+    return None
+
+
+def _url_imagen(blob_id: str) -> str:
+    base = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+    return f"{base}/images/{blob_id}"
+
+
+def _parse_range(valor: str, total: int) -> Optional[tuple[int, int]]:
+    """Interpreta un header `Range: bytes=a-b` (un solo rango). Devuelve (inicio, fin) inclusivo."""
+    if not valor.startswith("bytes=") or "," in valor:
+        return None
+    inicio_txt, _, fin_txt = valor[len("bytes="):].strip().partition("-")
+    try:
+        if inicio_txt == "":
+            # Sufijo: últimos N bytes
+            n = int(fin_txt)
+            if n <= 0:
+                return None
+            return max(0, total - n), total - 1
+        inicio = int(inicio_txt)
+        fin = int(fin_txt) if fin_txt else total - 1
+    except ValueError:
+        return None
+    if inicio >= total or fin < inicio:
+        return None
+    return inicio, min(fin, total - 1)
+
+
+@app.get("/images/{blob_id}")
+def get_image(blob_id: str, request: Request) -> Response:
+    """Sirve una imagen del store. Es inmutable (id = hash del contenido), así que se
+    cachea indefinidamente; soporta If-None-Match y peticiones Range.
+
+    No pide token: la URL se abre directo en el navegador (o en un <img>), que no envía el
+    header Authorization. El id (sha256) funciona como URL de capacidad, así que la caché
+    es `private`: solo el navegador la guarda, no los proxies ni CDNs compartidos.
+    """
+    if len(blob_id) != 64 or any(ch not in "0123456789abcdef" for ch in blob_id):
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    etag = f'"{blob_id}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    blob = _leer_blob(blob_id)
+    if blob is None:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    data, mime_type = blob
+    rango = request.headers.get("range")
+    if rango:
+        limites = _parse_range(rango, len(data))
+        if limites is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        inicio, fin = limites
+        headers["Content-Range"] = f"bytes {inicio}-{fin}/{len(data)}"
+        return Response(content=data[inicio:fin + 1], status_code=206, media_type=mime_type, headers=headers)
+    return Response(content=data, media_type=mime_type, headers=headers)
+
+
+# --- Image Variants (Pillow) ---
+# Gemini devuelve un PNG de tamaño fijo; aquí se produce la variante del tamaño pedido
+# y una miniatura, comprimidas en WebP (o JPEG). La codificación es CPU-bound, así que
+# corre en un pool de procesos fuera del event loop. Las variantes quedan en el store
+# (direccionado por contenido), así que repetir el mismo original no duplica blobs.
+IMAGE_SIZES_PERMITIDOS = {"1024x1024", "1792x1024", "1024x1792"}
+_IMAGE_POOL = None
+
+
+def _parse_size(size: Optional[str]) -> tuple[int, int]:
+    size = (size or "1024x1024").lower().strip()
+    if size not in IMAGE_SIZES_PERMITIDOS:
+        raise HTTPException(status_code=400, detail=f"size no soportado; usa uno de: {', '.join(sorted(IMAGE_SIZES_PERMITIDOS))}")
+    ancho, alto = size.split("x")
+    return int(ancho), int(alto)
+
+
+def _formato_imagen() -> tuple[str, str]:
+    """(formato Pillow, mime) según IMAGE_FORMAT; WebP por defecto si Pillow lo soporta."""
+    from PIL import features
+
+    if os.getenv("IMAGE_FORMAT", "webp").lower() == "webp" and features.check("webp"):
+        return "WEBP", "image/webp"
+    return "JPEG", "image/jpeg"
+
+
+def _procesar_variantes(data: bytes, ancho: int, alto: int, thumb: int) -> Dict[str, tuple[bytes, str]]:
+    """Decodifica la imagen original y devuelve {"main": (bytes, mime), "thumb": (bytes, mime)}.
+    Se ejecuta en un proceso del pool: solo recibe y devuelve bytes.
+    """
+    from io import BytesIO
+    from PIL import Image, ImageOps
+
+    formato, mime = _formato_imagen()
+    calidad = int(os.getenv("IMAGE_QUALITY", "82"))
+    with Image.open(BytesIO(data)) as img:
+        img = img.convert("RGB")
+        principal = ImageOps.fit(img, (ancho, alto), Image.Resampling.LANCZOS)
+        miniatura = principal.copy()
+        miniatura.thumbnail((thumb, thumb), Image.Resampling.LANCZOS)
+    res = {}
+    for nombre, imagen in (("main", principal), ("thumb", miniatura)):
+        buf = BytesIO()
+        if formato == "WEBP":
+            imagen.save(buf, formato, quality=calidad, method=4)
+        else:
+            imagen.save(buf, formato, quality=calidad, optimize=True, progressive=True)
+        res[nombre] = (buf.getvalue(), mime)
+    return res
+
+
+def _image_pool():
+    """Pool de procesos para codificar imágenes (IMAGE_WORKERS, por defecto 2).
+    Con IMAGE_WORKERS=0 se usa el threadpool de Starlette.
+    """
+    global _IMAGE_POOL
+    if _IMAGE_POOL is None:
+        try:
+            workers = int(os.getenv("IMAGE_WORKERS", "2"))
+        except ValueError:
+            workers = 2
+        if workers <= 0:
+            return None
+        import concurrent.futures
+
+        _IMAGE_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return _IMAGE_POOL
+
+
+@app.on_event("shutdown")
+def _shutdown_image_pool() -> None:
+    if _IMAGE_POOL is not None:
+        _IMAGE_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+async def _guardar_variantes(data: bytes, mime_type: str, ancho: int, alto: int) -> Dict[str, Any]:
+    """Guarda el original y sus variantes en el store. Devuelve los ids/urls a vincular.
+    Si Pillow no está disponible o falla la decodificación, se guarda solo el original.
+    """
+    original_id = await run_in_threadpool(_guardar_blob, data, mime_type)
+    try:
+        thumb = int(os.getenv("IMAGE_THUMB_SIZE", "256"))
+    except ValueError:
+        thumb = 256
+    refs: Dict[str, Any] = {"image_original_id": original_id, "image_id": original_id, "thumbnail_id": None}
+    try:
+        pool = _image_pool()
+        if pool is not None:
+            variantes = await asyncio.get_running_loop().run_in_executor(pool, _procesar_variantes, data, ancho, alto, thumb)
+        else:
+            variantes = await run_in_threadpool(_procesar_variantes, data, ancho, alto, thumb)
+        refs["image_id"] = await run_in_threadpool(_guardar_blob, *variantes["main"])
+        refs["thumbnail_id"] = await run_in_threadpool(_guardar_blob, *variantes["thumb"])
+    except Exception as e:
+        print(f"Aviso: no se pudieron generar variantes de la imagen: {e}")
+    refs["image_url"] = _url_imagen(refs["image_id"])
+    refs["thumbnail_url"] = _url_imagen(refs["thumbnail_id"]) if refs["thumbnail_id"] else None
+    return refs
+
+
+# --- Image Generation ---
+def _backend_imagen() -> str:
+    """"gemini", "fake", "record" o "replay" (IMAGE_BACKEND; por defecto el mismo valor que LLM_BACKEND)."""
+    return (os.getenv("IMAGE_BACKEND") or os.getenv("LLM_BACKEND") or "gemini").strip().lower()
+
+
+def _generate_dream_image(descripcion: str, estilo: str = "surrealista y onírico", size: str = "1024x1024") -> tuple[Optional[bytes], Optional[str], Optional[str]]:
+    """Genera una imagen usando Gemini 2.5 Flash Image. Retorna (image_bytes, mime_type, error_msg)."""
+    # Usar GEMINI_IMAGE_API_KEY si existe, sino usar GEMINI_API_KEY
+    gemini_key = os.getenv("GEMINI_IMAGE_API_KEY") or os.getenv("GEMINI_API_KEY")
+    backend = _backend_imagen()
+    if not gemini_key and backend not in ("fake", "replay"):
+        return None, None, "GEMINI_IMAGE_API_KEY o GEMINI_API_KEY no configurada"
+
+    try:
+        # Configurar cliente
+        if backend == "fake":
+            from llm_fake import FakeGenaiClient
+
+            client = FakeGenaiClient(api_key=gemini_key)
+        elif backend == "replay":
+            from llm_cassette import ReplayGenaiClient
+
+            client = ReplayGenaiClient(api_key=gemini_key)
+        elif backend == "record":
+            from llm_cassette import RecordingGenaiClient
+
+            client = RecordingGenaiClient(api_key=gemini_key)
+        else:
+            from google import genai
+
+            client = genai.Client(api_key=gemini_key)
+
+        # Construir prompt
+        prompt = f"Create a dream illustration with {estilo} style: {descripcion}. Concept art, dreamlike atmosphere, vibrant colors, high quality, detailed"
+
+        if len(prompt) > 2000:
+            prompt = prompt[:1997] + "..."
+
+        # Generar imagen con Gemini 2.5 Flash Image
+        with _medir_llm("imagen", "gemini-2.5-flash-image"):
+            response = client.models.generate_content(
+                model="gemini-2.5-flash-image",
+                contents=[prompt],
+            )
+
+        # Extraer la imagen de la respuesta
+        # La respuesta contiene candidates con parts
+        if hasattr(response, 'candidates') and response.candidates:
+            for candidate in response.candidates:
+                if hasattr(candidate, 'content') and candidate.content:
+                    for part in candidate.content.parts:
+                        if hasattr(part, 'inline_data') and part.inline_data is not None:
+                            # inline_data contiene mime_type y data (bytes)
+                            mime_type = part.inline_data.mime_type or "image/png"
+                            if "jpeg" in mime_type or "jpg" in mime_type:
+                                mime_type = "image/jpeg"
+                            else:
+                                mime_type = "image/png"
+                            return part.inline_data.data, mime_type, None
+        
+        return None, None, "No se generó ninguna imagen en la respuesta"
+
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Error generando imagen: {error_msg}")
+        return None, None, error_msg
+
+
+def _vincular_imagen_sesion(sesion_id: str, user_id: str, campos: Dict[str, Any]) -> None:
+    """Guarda la referencia de la imagen en la sesión (Mongo o memoria JSON local)."""
+    if _get_mongo_collection() is not None:
+        try:
+            col = _get_mongo_collection()
+            col.update_one({"id": sesion_id, "user_id": user_id}, {"$set": campos})
+        except Exception:
+            pass
+        return
+    s = _buscar_sesion(sesion_id)
+    if s and (not s.get("user_id") or s.get("user_id") == user_id):
+        try:
+            _actualizar_sesion(sesion_id, campos)
+        except Exception:
+            pass
+
+
+@app.post("/generate-image")
+async def generate_image(req: GenerateImageRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("imagen"))) -> Dict[str, Any]:
+    """Genera una imagen del sueño usando Gemini 2.5 Flash Image."""
+    if not os.getenv("GEMINI_API_KEY") and _backend_imagen() not in ("fake", "replay"):
+        raise HTTPException(status_code=503, detail="GEMINI_API_KEY no configurada. Añádela a las variables de entorno.")
+    
+    descripcion = (req.descripcion_sueno or "").strip()
+    if not descripcion:
+        raise HTTPException(status_code=400, detail="descripcion_sueno requerida")
+    ancho, alto = _parse_size(req.size)
+    await _cobrar_uso(request, current_user)
+    user_id = current_user["user_id"]
+    clave = _hash_hex("generate-image", user_id, _normalizar_texto(descripcion), req.estilo or "", f"{ancho}x{alto}", req.sesion_id or "")
+    return await _single_flight(clave, lambda: _generar_imagen(req, descripcion, ancho, alto, user_id))
+
+
+async def _generar_imagen(req: GenerateImageRequest, descripcion: str, ancho: int, alto: int, user_id: str) -> Dict[str, Any]:
+    # Generar imagen
+    async with _LIMITES["imagen"].slot():
+        image_bytes, mime_type, error_msg = await run_in_threadpool(_generate_dream_image, descripcion, req.estilo or "surrealista y onírico", req.size or "1024x1024")
+    
+    if not image_bytes:
+        detail_msg = f"No se pudo generar la imagen: {error_msg}" if error_msg else "No se pudo generar la imagen. Revisa tu API key de Gemini."
+        raise HTTPException(status_code=502, detail=detail_msg)
+
+    try:
+        with _etapa("guardar_imagen"):
+            refs = await _guardar_variantes(image_bytes, mime_type, ancho, alto)
+    except Exception as e:
+        print(f"Error guardando imagen: {e}")
+        raise HTTPException(status_code=500, detail="No se pudo guardar la imagen generada")
+    
+    # Si hay sesion_id, guardar en la sesión solo las referencias a la imagen
+    if req.sesion_id:
+        await run_in_threadpool(_vincular_imagen_sesion, req.sesion_id, user_id, {
+            **refs,
+            "image_generated_at": datetime.utcnow().isoformat(timespec="seconds"),
+        })
+    
+    return {
+        **refs,
+        "descripcion": descripcion,
+        "estilo": req.estilo,
+        "size": f"{ancho}x{alto}",
+    }
+
+
+# --- Title Generation ---
+TITULO_POR_DEFECTO = "Sueño interpretado"
+
+
+def _llm_titulo():
+    """Devuelve (llm, error_msg) para títulos; el LLM se reutiliza entre peticiones."""
+    # Usar GEMINI_TEXT_API_KEY si existe, sino usar GEMINI_API_KEY
+    from reporte6_BernardoBojalil import construir_llm_titulo
+
+    gemini_key = os.getenv("GEMINI_TEXT_API_KEY") or os.getenv("GEMINI_API_KEY") or _clave_api_actual()
+    if not gemini_key:
+        return None, "GEMINI_TEXT_API_KEY o GEMINI_API_KEY no configurada"
+
+    llm = construir_llm_titulo(gemini_key)
+    if llm is None:
+        return None, "LangChain o ChatGoogleGenerativeAI no disponible"
+    return llm, None
+
+
+def _prompt_titulo(descripcion: str) -> str:
+    # Prompt para generar título corto y descriptivo
+    return f"""Genera un título muy breve y descriptivo (máximo 6 palabras) para este sueño. 
+Solo devuelve el título, sin explicaciones adicionales.
+
+Sueño: {descripcion[:500]}
+
+Título:"""
+
+
+def _limpiar_titulo(texto: str) -> str:
+    title = texto.strip().strip('"').strip("'")
+    # Limitar a 60 caracteres máximo
+    if len(title) > 60:
+        title = title[:57] + "..."
+    return title
+
+
+async def _agenerar_titulo(descripcion: str) -> tuple[Optional[str], Optional[str]]:
+    """Genera un título breve del sueño usando Gemini. Retorna (title, error_msg).
+    Nunca lanza, para poder ejecutarse en paralelo con la interpretación vía asyncio.gather.
+    """
+    try:
+        llm, error_msg = _llm_titulo()
+        if llm is None:
+            return None, error_msg
+        async with _BREAKER_GEMINI.llamada(), _LIMITES["titulo"].slot():
+            with _medir_llm("titulo", _modelo_texto_actual()):
+                response = await asyncio.wait_for(llm.ainvoke(_prompt_titulo(descripcion)), timeout=_llm_timeout_secs())
+        return _limpiar_titulo(response.content), None
+    except asyncio.TimeoutError:
+        _fallback("titulo", "timeout")
+        return None, "Tiempo de espera agotado para el título"
+    except (ServicioSaturado, CircuitoAbierto) as e:
+        _fallback("titulo", "circuit_open" if isinstance(e, CircuitoAbierto) else "saturated")
+        return None, str(e)
+    except Exception as e:
+        _fallback("titulo", "error")
+        error_msg = str(e)
+        print(f"Error generando título: {error_msg}")
+        return None, error_msg
+
+
+@app.post("/generate-title")
+async def generate_title(req: GenerateTitleRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("titulo"))) -> Dict[str, Any]:
+    """Genera un título breve del sueño usando Gemini."""
+    if not _clave_api_actual():
+        raise HTTPException(status_code=503, detail="GEMINI_API_KEY no configurada.")
+    
+    descripcion = (req.descripcion_sueno or "").strip()
+    if not descripcion:
+        raise HTTPException(status_code=400, detail="descripcion_sueno requerida")
+    await _cobrar_uso(request, current_user)
+    
+    # Generar título (duplicados en vuelo comparten la misma llamada)
+    clave = _hash_hex("generate-title", current_user["user_id"], _normalizar_texto(descripcion))
+    title, error_msg = await _single_flight(clave, lambda: _agenerar_titulo(descripcion))
+    
+    if not title:
+        detail_msg = f"No se pudo generar el título: {error_msg}" if error_msg else "No se pudo generar el título."
+        raise HTTPException(status_code=502, detail=detail_msg)
+    
+    return {
+        "title": title,
+        "titulo": title,
+    }
+
+
+@app.get("/health")
+def health() -> Dict[str, Any]:
+    try:
+        ok_interprete = construir_cadena_interprete() is not None
+    except Exception:
+        ok_interprete = False
+    mongo_enabled = _get_mongo_collection() is not None
+    return {
+        "status": "ok",
+        "llm_available": ok_interprete,
+        "mongo": mongo_enabled,
+        "mongo_indexes": _MONGO_INDICES_ESTADO,
+        "interpretation_cache": _estado_cache_interpretacion(),
+        "single_flight": {"in_flight": len(_EN_VUELO), **_SINGLE_FLIGHT_STATS},
+        "admission": {clase: limite.metricas() for clase, limite in _LIMITES.items()},
+        "circuit_breaker": _BREAKER_GEMINI.metricas(),
+        "warmup": _WARMUP_ESTADO,
+    }
+
+
+def _lineas_estado() -> List[str]:
+    """Valores instantáneos (admisión, circuit breaker, cachés, single-flight) en formato Prometheus."""
+    lineas: List[str] = []
+
+    def serie(nombre: str, tipo: str, ayuda: str, valores: List[tuple]) -> None:
+        lineas.extend([f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"])
+        for etiquetas, valor in valores:
+            sufijo = "{" + _etiquetas_prom(tuple(etiquetas), tuple(etiquetas.values())) + "}" if etiquetas else ""
+            lineas.append(f"{nombre}{sufijo} {valor:g}")
+
+    admision = {clase: limite.metricas() for clase, limite in _LIMITES.items()}
+    serie("moonbound_admission_limit", "gauge", "Llamadas simultáneas permitidas hacia Gemini.", [({"class": c}, m["limit"]) for c, m in admision.items()])
+    serie("moonbound_admission_in_flight", "gauge", "Llamadas a Gemini en curso.", [({"class": c}, m["in_flight"]) for c, m in admision.items()])
+    serie("moonbound_admission_queued", "gauge", "Peticiones esperando turno.", [({"class": c}, m["queued"]) for c, m in admision.items()])
+    serie("moonbound_admission_rejected_total", "counter", "Peticiones rechazadas con 503 por saturación.", [({"class": c}, m["rejected"]) for c, m in admision.items()])
+
+    cb = _BREAKER_GEMINI.metricas()
+    serie("moonbound_circuit_breaker_state", "gauge", "Estado del circuit breaker (1 = estado actual).", [({"state": e}, int(cb["state"] == e)) for e in ("closed", "open", "half_open")])
+    serie("moonbound_circuit_breaker_opened_total", "counter", "Veces que se abrió el circuito.", [({}, cb["opened"])])
+    serie("moonbound_circuit_breaker_rejected_total", "counter", "Llamadas rechazadas con el circuito abierto.", [({}, cb["rejected"])])
+
+    serie("moonbound_interpretation_cache_entries", "gauge", "Entradas en la caché de interpretaciones.", [({}, len(_INTERP_CACHE))])
+    ic = _estadisticas_cache()
+    serie(
+        "moonbound_interpretation_cache_requests_total", "counter", "Consultas a la caché de interpretaciones por resultado.",
+        [({"result": "hit"}, ic["hits"]), ({"result": "shared_hit"}, ic["shared_hits"]), ({"result": "miss"}, ic["misses"])],
+    )
+    serie("moonbound_single_flight_in_flight", "gauge", "Trabajos coalescidos en vuelo.", [({}, len(_EN_VUELO))])
+    serie(
+        "moonbound_single_flight_requests_total", "counter", "Peticiones por rol en single-flight.",
+        [({"role": "leader"}, _SINGLE_FLIGHT_STATS["leaders"]), ({"role": "coalesced"}, _SINGLE_FLIGHT_STATS["coalesced"])],
+    )
+    serie("moonbound_background_tasks", "gauge", "Tareas en segundo plano (resúmenes de follow-ups y lotes).", [({}, len(_TAREAS_FONDO))])
+    return lineas
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    """Métricas en formato de texto de Prometheus."""
+    lineas: List[str] = []
+    for metrica in _METRICAS:
+        lineas.extend(metrica.exponer())
+    lineas.extend(_lineas_estado())
+    return Response(content="\n".join(lineas) + "\n", media_type="text/plain; version=0.0.4")
+
+
+# --- Perfilado bajo demanda (admin) ---
+# Muestreo de pilas con sys._current_frames() desde un hilo que solo existe mientras dura
+# el perfil: sin perfil en curso no hay hooks, hilos ni tracemalloc activos. La salida usa
+# el formato "collapsed" (pila;separada;por;puntos_y_comas N), que aceptan flamegraph.pl,
+# speedscope e inferno.
+_PERFIL_LOCK = threading.Lock()
+# Hojas de pila que solo indican espera (event loop o hilos del pool sin trabajo)
+_HOJAS_OCIOSAS = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"), ("thread.py", "_worker"), ("base_events.py", "_run_once")}
+
+
+def _admins() -> set:
+    """Ids de usuario con permisos de administración (ADMIN_USER_IDS). No se usa el email del
+    token: /register no verifica que el email pertenezca a quien lo registra."""
+    return {i.strip() for i in os.getenv("ADMIN_USER_IDS", "").split(",") if i.strip()}
+
+
+def _requerir_admin(current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
+    ids = _admins()
+    if not ids:
+        raise HTTPException(status_code=403, detail="Endpoints de administración deshabilitados (define ADMIN_USER_IDS)")
+    if current_user["user_id"] not in ids:
+        raise HTTPException(status_code=403, detail="Solo administradores")
+    return current_user
+
+
+def _etiqueta_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class _PerfiladorMuestreo:
+    """Toma una muestra de la pila de cada hilo cada `intervalo` segundos."""
+
+    def __init__(self, intervalo: float, incluir_ociosos: bool = False):
+        self.intervalo = intervalo
+        self.incluir_ociosos = incluir_ociosos
+        self.pilas: Dict[str, int] = {}
+        self.muestras = 0
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, name="perfilador-muestreo", daemon=True)
+
+    def _bucle(self) -> None:
+        propio = threading.get_ident()
+        nombres = {t.ident: t.name for t in threading.enumerate()}
+        while not self._parar.wait(self.intervalo):
+            self.muestras += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == propio:
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if not self.incluir_ociosos and leaf in _HOJAS_OCIOSAS:
+                    continue
+                pila = []
+                while frame is not None:
+                    pila.append(_etiqueta_frame(frame))
+                    frame = frame.f_back
+                if ident not in nombres:
+                    nombres = {t.ident: t.name for t in threading.enumerate()}
+                pila.append(nombres.get(ident, f"thread-{ident}").replace(";", ","))
+                clave = ";".join(reversed(pila))
+                self.pilas[clave] = self.pilas.get(clave, 0) + 1
+
+    def iniciar(self) -> None:
+        self._hilo.start()
+
+    def detener(self) -> None:
+        self._parar.set()
+        self._hilo.join()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{pila} {n}" for pila, n in sorted(self.pilas.items(), key=lambda kv: -kv[1]))
+
+
+def _tamanos_estado() -> Dict[str, int]:
+    """Entradas de las estructuras en memoria que pueden crecer con el tráfico."""
+    import reporte6_BernardoBojalil as r6
+
+    return {
+        "MEM.sessions": len((r6._MEM or {}).get("sessions", [])),
+        "memoria_render_cache": len(r6._MEMORIA_RENDER),
+        "cadenas_llm": len(r6._CADENAS),
+        "interpretation_cache": len(_INTERP_CACHE),
+        "rate_limit_buckets": len(_BUCKETS),
+        "rate_limit_quotas": len(_CUOTAS),
+        "single_flight": len(_EN_VUELO),
+        "background_tasks": len(_TAREAS_FONDO),
+    }
+
+
+def _resumen_tracemalloc(inicio, fin, top: int, desde_arranque: bool) -> Dict[str, Any]:
+    """Si tracemalloc ya estaba activo (PYTHONTRACEMALLOC=1 al arrancar), `top` es la memoria
+    residente por línea desde el inicio del proceso y `growth` lo que creció en la ventana.
+    Si lo activó el propio perfil, solo se ven las asignaciones hechas durante la ventana
+    (`top`); `growth` sería lo mismo y se omite."""
+    def fila(stat) -> Dict[str, Any]:
+        frame = stat.traceback[0]
+        return {"where": f"{frame.filename}:{frame.lineno}", "size_kb": round(stat.size / 1024, 1), "count": stat.count}
+
+    actual, pico = tracemalloc.get_traced_memory()
+    resumen = {
+        "scope": "process" if desde_arranque else "window",
+        "traced_kb": round(actual / 1024, 1),
+        "peak_kb": round(pico / 1024, 1),
+        "top": [fila(s) for s in fin.statistics("lineno")[:top]],
+    }
+    if desde_arranque:
+        resumen["growth"] = [
+            {"where": f"{d.traceback[0].filename}:{d.traceback[0].lineno}", "size_diff_kb": round(d.size_diff / 1024, 1), "count_diff": d.count_diff}
+            for d in fin.compare_to(inicio, "lineno")[:top]
+            if d.size_diff > 0
+        ]
+    return resumen
+
+
+@app.post("/admin/profile", include_in_schema=False)
+async def admin_profile(
+    seconds: float = 10.0,
+    interval_ms: float = 5.0,
+    memory: bool = False,
+    idle: bool = False,
+    top: int = 25,
+    format: str = "json",
+    current_user: Dict[str, Any] = Depends(_requerir_admin),
+) -> Any:
+    """Perfil de CPU por muestreo durante `seconds` (máximo PROFILE_MAX_SECS) y, con
+    memory=true, snapshot de tracemalloc (ver _resumen_tracemalloc: sin PYTHONTRACEMALLOC
+    solo cubre lo asignado durante la ventana) más el número de entradas de MEM y de las
+    cachés (no su tamaño en bytes). format=collapsed devuelve solo el texto para flamegraph.
+    """
+    maximo = _env_int("PROFILE_MAX_SECS", 60)
+    if not (0 < seconds <= maximo):
+        raise HTTPException(status_code=400, detail=f"seconds debe estar entre 0 y {maximo}")
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail="format debe ser json o collapsed")
+    if not _PERFIL_LOCK.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ya hay un perfil en curso")
+    tracemalloc_propio = False
+    try:
+        inicio_mem = None
+        estado_inicial = None
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(_env_int("PROFILE_TRACEMALLOC_FRAMES", 1))
+                tracemalloc_propio = True
+            inicio_mem = tracemalloc.take_snapshot()
+            estado_inicial = await run_in_threadpool(_tamanos_estado)
+        perfilador = _PerfiladorMuestreo(max(0.001, interval_ms / 1000.0), incluir_ociosos=idle)
+        perfilador.iniciar()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await run_in_threadpool(perfilador.detener)
+        resultado: Dict[str, Any] = {
+            "seconds": seconds,
+            "interval_ms": interval_ms,
+            "samples": perfilador.muestras,
+            "stacks": len(perfilador.pilas),
+            "collapsed": perfilador.collapsed(),
+        }
+        if memory:
+            fin_mem = tracemalloc.take_snapshot()
+            resultado["memory"] = _resumen_tracemalloc(inicio_mem, fin_mem, top, desde_arranque=not tracemalloc_propio)
+            resultado["memory"]["structures"] = {"before": estado_inicial, "after": await run_in_threadpool(_tamanos_estado)}
+    finally:
+        if tracemalloc_propio:
+            tracemalloc.stop()
+        _PERFIL_LOCK.release()
+    if format == "collapsed":
+        return Response(content=resultado["collapsed"] + "\n", media_type="text/plain")
+    return resultado
+
+
+# --- Interpretación (ruta async) ---
+def _config_memoria_previa() -> tuple[int, int, int]:
+    """Lee PREVIOUS_N, PREV_FOLLOWUPS_N y el presupuesto de tokens (PREV_TOKENS_MAX)."""
+    try:
+        prev_n = int(os.getenv("PREVIOUS_N", "5"))
+    except ValueError:
+        prev_n = 5
+    try:
+        prev_fu_n = int(os.getenv("PREV_FOLLOWUPS_N", "3"))
+    except ValueError:
+        prev_fu_n = 3
+    return prev_n, prev_fu_n, _presupuesto_memoria()
+
+
+def _log_tokens(tipo: str, user_id: str, payload: Dict[str, Any]) -> None:
+    """Registra los tokens de entrada estimados por campo del prompt (LOG_TOKENS=0 lo desactiva)."""
+    if os.getenv("LOG_TOKENS", "1") == "0":
+        return
+    partes = {k: _estimar_tokens(v) for k, v in payload.items() if isinstance(v, str)}
+    detalle = " ".join(f"{k}={v}" for k, v in partes.items())
+    print(f"[tokens] {tipo} user={user_id} total≈{sum(partes.values())} {detalle}")
+
+
+def _texto_respuesta(res: Any) -> str:
+    """Normaliza la salida de una cadena (str, AIMessage o dict) a texto."""
+    if isinstance(res, str):
+        return res
+    content = getattr(res, "content", None)
+    if isinstance(content, str) and content.strip():
+        return content
+    if isinstance(res, dict) and "text" in res:
+        return str(res.get("text", ""))
+    return str(res)
+
+
+async def _ainvoke_con_timeout(chain, payload: Dict[str, Any]) -> str:
+    """Invoca la cadena de forma nativa async; si excede LLM_TIMEOUT_SECS la llamada
+    se cancela (no queda un hilo huérfano) y se propaga asyncio.TimeoutError.
+    """
+    res = await asyncio.wait_for(chain.ainvoke(payload), timeout=_llm_timeout_secs())
+    return _texto_respuesta(res)
+
+
+async def _astream_con_timeout(chain, payload: Dict[str, Any]):
+    """Itera los fragmentos de texto de `chain.astream`. LLM_TIMEOUT_SECS se aplica
+    a la espera de cada fragmento; al agotarse se cancela el stream y se propaga asyncio.TimeoutError.
+    """
+    timeout = _llm_timeout_secs()
+    it = chain.astream(payload).__aiter__()
+    try:
+        while True:
             try:
-                prev_n = int(getenv("PREVIOUS_N", "5"))
-            except ValueError:
-                prev_n = 5
-            try:
-                prev_fu_n = int(getenv("PREV_FOLLOWUPS_N", "3"))
-            except ValueError:
-                prev_fu_n = 3
-            try:
-                prev_json_max = int(getenv("PREV_JSON_MAX_CHARS", "20000"))
-            except ValueError:
-                prev_json_max = 20000
-            # Usar memoria filtrada por usuario
-            memoria_json = _memoria_json_compacta_user(user_id, prev_n, prev_fu_n, prev_json_max)
-
-            payload = {
-                "texto_sueno": texto,
-                "contexto_emocional": req.contexto_emocional or "",
-                "memoria_json": memoria_json,
-            }
-            try:
-                timeout_secs = int(os.getenv("LLM_TIMEOUT_SECS", "20"))
-            except Exception:
-                timeout_secs = 20
+                trozo = await asyncio.wait_for(it.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                return
+            texto = _texto_respuesta(trozo)
+            if texto:
+                yield texto
+    finally:
+        aclose = getattr(it, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+async def _payload_interprete(texto_sueno: str, contexto: str, user_id: str) -> Dict[str, Any]:
+    prev_n, prev_fu_n, prev_tokens = _config_memoria_previa()
+    # Usar memoria filtrada por usuario (consulta Mongo: fuera del event loop)
+    with _etapa("memoria"):
+        memoria_json = await run_in_threadpool(_memoria_json_compacta_user, user_id, prev_n, prev_fu_n, prev_tokens)
+    payload = {
+        "texto_sueno": texto_sueno,
+        "contexto_emocional": contexto,
+        "memoria_json": memoria_json,
+    }
+    _log_tokens("interpretacion", user_id, payload)
+    return payload
+
+
+# --- Interpretation Cache ---
+# Reintentos, dobles toques o el mismo sueño reenviado no vuelven a llamar a Gemini.
+# Clave: hash (xxhash) de usuario, texto y contexto normalizados y versión del prompt/modelo.
+# La memoria previa no entra en la clave: la primera llamada guarda una sesión y cambia esa
+# memoria, así que un reintento nunca acertaría; el TTL acota cuánto se reutiliza una
+# interpretación hecha con memoria anterior. Nivel 1 en proceso (LRU + TTL); nivel 2
+# opcional compartido entre workers en Mongo (INTERP_CACHE_SHARED=1, con índice TTL).
+class _CacheTTL:
+    """Caché LRU en memoria con expiración por entrada (thread-safe)."""
+
+    def __init__(self, max_items: int, ttl_secs: float):
+        self.max_items = max_items
+        self.ttl_secs = ttl_secs
+        self._datos: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave: str) -> Any:
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira < time.monotonic():
+                del self._datos[clave]
+                return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave: str, valor: Any) -> None:
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + self.ttl_secs, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self) -> int:
+        return len(self._datos)
+
+
+_INTERP_CACHE = _CacheTTL(_env_int("INTERP_CACHE_MAX", 1024), _env_int("INTERP_CACHE_TTL_SECS", 3600))
+_INTERP_CACHE_STATS = {"hits": 0, "shared_hits": 0, "misses": 0}
+_INTERP_CACHE_STATS_LOCK = threading.Lock()
+
+
+def _contar_cache(resultado: str) -> None:
+    # Se llama desde hilos del threadpool
+    with _INTERP_CACHE_STATS_LOCK:
+        _INTERP_CACHE_STATS[resultado] += 1
+
+
+def _cache_interpretacion_habilitada() -> bool:
+    return os.getenv("INTERP_CACHE", "1") != "0"
+
+
+def _cache_compartida():
+    """Colección Mongo de la caché compartida, o None si no está activa."""
+    if os.getenv("INTERP_CACHE_SHARED", "0") != "1":
+        return None
+    db = _get_mongo_db()
+    if db is None:
+        return None
+    return db[os.getenv("INTERP_CACHE_COLLECTION", "interpretation_cache")]
 
-            def _invoke():
-                return chain.invoke(payload)
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_invoke)
-                res = fut.result(timeout=timeout_secs)
-            if isinstance(res, str):
-                interpretacion = res
+def _hash_hex(*partes: str) -> str:
+    try:
+        import xxhash
+
+        h = xxhash.xxh3_128()
+    except Exception:
+        import hashlib
+
+        h = hashlib.blake2b(digest_size=16)
+    for parte in partes:
+        h.update(parte.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _normalizar_texto(texto: str) -> str:
+    import unicodedata
+
+    return unicodedata.normalize("NFC", " ".join((texto or "").split())).casefold()
+
+
+def _version_prompt_interprete() -> str:
+    from reporte6_BernardoBojalil import PROMPT_INTERPRETE, _modelo_texto
+
+    return f"{_modelo_texto()}:{_hash_hex(PROMPT_INTERPRETE)}"
+
+
+def _clave_cache_interpretacion(texto_sueno: str, contexto: str, user_id: str) -> str:
+    # user_id en la clave: la interpretación puede citar sueños previos del usuario
+    return _hash_hex(
+        _version_prompt_interprete(),
+        user_id or "",
+        _normalizar_texto(texto_sueno),
+        _normalizar_texto(contexto),
+    )
+
+
+def _cache_interpretacion_get(clave: str) -> Optional[Dict[str, Any]]:
+    valor = _INTERP_CACHE.get(clave)
+    if valor is not None:
+        _contar_cache("hits")
+        return valor
+    col = _cache_compartida()
+    if col is not None:
+        try:
+            doc = col.find_one({"_id": clave, "expire_at": {"$gt": datetime.utcnow()}}, {"value": 1})
+        except Exception:
+            doc = None
+        if doc and doc.get("value"):
+            _contar_cache("shared_hits")
+            _INTERP_CACHE.set(clave, doc["value"])
+            return doc["value"]
+    _contar_cache("misses")
+    return None
+
+
+def _cache_interpretacion_set(clave: str, valor: Dict[str, Any]) -> None:
+    _INTERP_CACHE.set(clave, valor)
+    col = _cache_compartida()
+    if col is not None:
+        try:
+            expira = datetime.utcnow() + timedelta(seconds=_INTERP_CACHE.ttl_secs)
+            col.update_one({"_id": clave}, {"$set": {"value": valor, "expire_at": expira}}, upsert=True)
+        except Exception:
+            pass
+
+
+def _estado_cache_interpretacion() -> Dict[str, Any]:
+    return {
+        "enabled": _cache_interpretacion_habilitada(),
+        "shared": _cache_compartida() is not None,
+        "size": len(_INTERP_CACHE),
+        **_estadisticas_cache(),
+    }
+
+
+def _estadisticas_cache() -> Dict[str, int]:
+    with _INTERP_CACHE_STATS_LOCK:
+        return dict(_INTERP_CACHE_STATS)
+
+
+async def _interpretar_con_titulo(texto_sueno: str, contexto: str, user_id: str, usar_cache: bool = True) -> tuple[str, Optional[str]]:
+    """Interpreta con Gemini usando la memoria del usuario y genera el título en paralelo.
+    Devuelve (interpretacion, titulo); interpretacion es "" si no hay cadena disponible,
+    si falla o si se agota el tiempo (el llamador aplica el fallback offline).
+    Los resultados correctos se guardan en la caché de interpretaciones; con un acierto
+    no se llama a Gemini ni para la interpretación ni para el título.
+    """
+    chain = construir_cadena_interprete()
+    clave = None
+    if chain is not None and usar_cache and _cache_interpretacion_habilitada():
+        clave = _clave_cache_interpretacion(texto_sueno, contexto, user_id)
+        with _etapa("cache"):
+            cacheado = await run_in_threadpool(_cache_interpretacion_get, clave)
+        if cacheado is not None:
+            return cacheado["interpretacion"], cacheado.get("titulo")
+    titulo_task = asyncio.ensure_future(_agenerar_titulo(texto_sueno))
+    interpretacion = ""
+    try:
+        try:
+            if chain is not None:
+                payload = await _payload_interprete(texto_sueno, contexto, user_id)
+                async with _BREAKER_GEMINI.llamada(), _LIMITES["interpretacion"].slot():
+                    with _medir_llm("interpretacion", _modelo_texto_actual()):
+                        interpretacion = await _ainvoke_con_timeout(chain, payload)
             else:
-                content = getattr(res, "content", None)
-                if isinstance(content, str) and content.strip():
-                    interpretacion = content
-                elif isinstance(res, dict) and "text" in res:
-                    interpretacion = str(res.get("text", ""))
-                else:
-                    interpretacion = str(res)
-        except concurrent.futures.TimeoutError:
+                _fallback("interpretacion", "unavailable")
+        except asyncio.TimeoutError:
             # Exceso de tiempo: usar fallback offline
             interpretacion = ""
+            _fallback("interpretacion", "timeout")
+        except CircuitoAbierto:
+            # Gemini marcado como caído: fallback offline inmediato
+            interpretacion = ""
+            _fallback("interpretacion", "circuit_open")
+        except ServicioSaturado:
+            # Cola llena: responder 503 rápido en vez de degradar a offline
+            raise
         except Exception:
             interpretacion = ""
+            _fallback("interpretacion", "error")
+        with _etapa("espera_titulo"):
+            titulo, _ = await titulo_task
+    finally:
+        if not titulo_task.done():
+            titulo_task.cancel()
+    if clave is not None and interpretacion.strip():
+        with _etapa("cache"):
+            await run_in_threadpool(_cache_interpretacion_set, clave, {"interpretacion": interpretacion, "titulo": titulo})
+    return interpretacion, titulo
+
+
+def _guardar_salida_api(filename: Optional[str], interpretacion: str) -> Optional[str]:
+    """Guarda la interpretación reutilizando la lógica del proyecto (añade _interpretado).
+    Si no se dio filename, usa "sueño_api.txt" como base.
+    """
+    base = filename if (filename and filename.strip()) else "sueño_api.txt"
+    try:
+        from reporte6_BernardoBojalil import guardar_interpretacion
 
-    if not (interpretacion or "").strip():
-        # Fallback offline para no dejar vacío
-        interpretacion = interpretar_offline(texto, req.contexto_emocional or "")
-
-    ruta_salida: Optional[str] = None
-    if req.save:
-        # Para reutilizar la lógica de guardado del proyecto, necesitamos una ruta base.
-        # Si no se dio filename, usamos "sueño_api.txt" como base.
-        base = req.filename if (req.filename and req.filename.strip()) else "sueño_api.txt"
-        try:
-            # Guardar reutilizando la función existente que añade _interpretado
-            from reporte6_BernardoBojalil import guardar_interpretacion
+        return guardar_interpretacion(base, interpretacion)
+    except Exception:
+        return None
 
-            ruta_salida = guardar_interpretacion(base, interpretacion)
-        except Exception:
-            ruta_salida = None
 
-    # Guardado de sesión: preferir Mongo si está disponible; si no, memoria JSON original
+def _persistir_sesion_texto(archivo: str, texto: str, contexto: str, interpretacion: str, ruta_salida: Optional[str], user_id: str, titulo: Optional[str] = None) -> Optional[str]:
+    """Guardado de sesión: preferir Mongo si está disponible; si no, memoria JSON original."""
     sesion_id = None
-    titulo = None
-    
-    # Generar título automáticamente
-    titulo, _ = _generate_dream_title(texto)
-    if not titulo:
-        # Si falla la generación, usar un título por defecto
-        titulo = "Sueño interpretado"
-    
     if _get_mongo_collection() is not None:
-        sesion_id = _mongo_create_session(req.filename or "(API)", texto, req.contexto_emocional or "", interpretacion, ruta_salida, user_id, titulo)
+        sesion_id = _mongo_create_session(archivo, texto, contexto, interpretacion, ruta_salida, user_id, titulo)
     if not sesion_id:
         try:
-            sesion_id = _crear_sesion(req.filename or "(API)", texto, req.contexto_emocional or "", interpretacion, ruta_salida)
+            sesion_id = _crear_sesion(archivo, texto, contexto, interpretacion, ruta_salida, user_id)
         except Exception:
             sesion_id = None
+    return sesion_id
+
+
+@app.post("/interpret-text")
+async def interpret_text(
+    req: InterpretTextRequest,
+    request: Request,
+    response: Response,
+    current_user: Dict[str, Any] = Depends(_limite_uso("interpretacion")),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+) -> Dict[str, Any]:
+    texto = (req.texto_sueno or "").strip()
+    if not texto:
+        raise HTTPException(status_code=400, detail="texto_sueno requerido")
+
+    user_id = current_user["user_id"]
+    clave = _hash_hex(
+        "interpret-text", user_id, _normalizar_texto(texto), _normalizar_texto(req.contexto_emocional or ""),
+        str(req.save), req.filename or "", str(bool(req.offline)), str(req.cache),
+    )
+
+    async def trabajo() -> Dict[str, Any]:
+        # Se cobra aquí: los replays de Idempotency-Key no llegan a ejecutar trabajo()
+        await _cobrar_uso(request, current_user)
+        return await _single_flight(clave, lambda: _interpret_text(req, texto, user_id))
+
+    return await _con_idempotencia(idempotency_key, user_id, "interpret-text", clave, response, trabajo)
+
+
+async def _interpret_text(req: InterpretTextRequest, texto: str, user_id: str) -> Dict[str, Any]:
+    contexto = req.contexto_emocional or ""
+
+    # Modo offline forzado si se solicita o por env
+    if bool(req.offline) or os.getenv("FORCE_OFFLINE", "0") == "1":
+        with _etapa("interpretacion_offline"):
+            interpretacion = interpretar_offline(texto, contexto)
+        ruta_salida: Optional[str] = None
+        if req.save:
+            with _etapa("guardar_archivo"):
+                ruta_salida = await run_in_threadpool(_guardar_salida_api, req.filename, interpretacion)
+        with _etapa("persistir_sesion"):
+            sesion_id = await run_in_threadpool(_persistir_sesion_texto, req.filename or "(API)", texto, contexto, interpretacion, ruta_salida, user_id)
+        return {"interpretacion": interpretacion, "ruta_salida": ruta_salida, "sesion_id": sesion_id}
+
+    # Interpretación y título en paralelo: la latencia es la de la llamada más lenta
+    interpretacion, titulo = await _interpretar_con_titulo(texto, contexto, user_id, req.cache)
+
+    if not (interpretacion or "").strip():
+        # Fallback offline para no dejar vacío
+        with _etapa("interpretacion_offline"):
+            interpretacion = interpretar_offline(texto, contexto)
+
+    ruta_salida: Optional[str] = None
+    if req.save:
+        with _etapa("guardar_archivo"):
+            ruta_salida = await run_in_threadpool(_guardar_salida_api, req.filename, interpretacion)
+
+    if not titulo:
+        # Si falla la generación, usar un título por defecto
+        titulo = TITULO_POR_DEFECTO
+
+    with _etapa("persistir_sesion"):
+        sesion_id = await run_in_threadpool(_persistir_sesion_texto, req.filename or "(API)", texto, contexto, interpretacion, ruta_salida, user_id, titulo)
 
     return {
         "interpretacion": interpretacion,
@@ -709,114 +2641,282 @@ def interpret_text(req: InterpretTextRequest, current_user: Dict[str, Any] = Dep
     }
 
 
-@app.post("/interpret-file")
-def interpret_file(req: InterpretFileRequest, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
-    if not (req.ruta or "").strip():
-        raise HTTPException(status_code=400, detail="ruta requerida")
+# --- Batch (NDJSON) ---
+def _persistir_sesiones_lote(registros: List[Dict[str, Any]], user_id: str) -> int:
+    """Guarda las sesiones del lote: un solo insert_many en Mongo y, para lo que no se
+    haya podido guardar allí, una sola escritura en la memoria JSON. Devuelve cuántas se guardaron."""
+    docs = [
+        _doc_sesion_mongo(r["sesion_id"], r["archivo"], r["texto"], r["contexto"], r["interpretacion"], None, user_id, r["titulo"])
+        for r in registros
+    ]
+    pendientes = _mongo_create_sessions(docs) if _get_mongo_collection() is not None else list(range(len(docs)))
+    if not pendientes:
+        return len(docs)
+    try:
+        _crear_sesiones([
+            {
+                "id": registros[i]["sesion_id"],
+                "ruta_sueno": registros[i]["archivo"],
+                "texto_sueno": registros[i]["texto"],
+                "contexto": registros[i]["contexto"],
+                "interpretacion": registros[i]["interpretacion"],
+                "user_id": user_id,
+            }
+            for i in pendientes
+        ])
+    except Exception as e:
+        print(f"Error guardando lote de sesiones en memoria local: {e}")
+        return len(docs) - len(pendientes)
+    return len(docs)
+
 
+@app.post("/interpret-batch")
+async def interpret_batch(req: InterpretBatchRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("batch"))) -> StreamingResponse:
+    """Interpreta varios sueños con paralelismo acotado (BATCH_CONCURRENCY). Devuelve NDJSON:
+    una línea por sueño en cuanto termina (en orden de finalización, con su `index`) y una
+    línea final con `done: true` y el resumen. Las sesiones se guardan todas juntas al final.
+
+    El lote corre en una tarea de fondo y el stream solo retransmite sus líneas: si el
+    cliente se desconecta, el trabajo (ya cobrado) termina igual y las sesiones cuyo
+    `sesion_id` se llegó a enviar quedan guardadas.
+    """
+    if not req.items:
+        raise HTTPException(status_code=400, detail="items requerido")
+    max_items = _env_int("BATCH_MAX_ITEMS", 500)
+    if len(req.items) > max_items:
+        raise HTTPException(status_code=413, detail=f"Demasiados sueños en el lote (máximo {max_items})")
+    await _cobrar_uso(request, current_user)
+    # Cada sueño es una interpretación: se descuenta del bucket y de la cuota diaria de
+    # "interpretacion" (429 antes de empezar si la cuota restante no alcanza)
+    n_suenos = sum(1 for item in req.items if (item.texto_sueno or "").strip())
+    if n_suenos:
+        await _cobrar_uso(request, current_user, "interpretacion", n_suenos)
     user_id = current_user["user_id"]
-    
-    # Leer archivo
-    from reporte6_BernardoBojalil import leer_sueno, guardar_interpretacion
-    texto_sueno = leer_sueno(req.ruta)
-    if texto_sueno is None:
-        raise HTTPException(status_code=400, detail="No se pudo leer el archivo del sueño")
-    
-    # Interpretar con memoria filtrada por usuario
-    chain = construir_cadena_interprete()
-    interpretacion = ""
-    if chain is not None:
+    forzar_offline = bool(req.offline) or os.getenv("FORCE_OFFLINE", "0") == "1"
+    if not forzar_offline and construir_cadena_interprete() is None:
+        forzar_offline = True
+    sem = asyncio.Semaphore(max(1, _env_int("BATCH_CONCURRENCY", 4)))
+
+    async def procesar(i: int, item: InterpretBatchItem) -> tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        texto = (item.texto_sueno or "").strip()
+        if not texto:
+            return {"index": i, "status": "error", "error": "texto_sueno requerido"}, None
+        contexto = item.contexto_emocional or ""
+        interpretacion, titulo, error = "", None, None
+        if not forzar_offline:
+            async with sem:
+                try:
+                    interpretacion, titulo = await _interpretar_con_titulo(texto, contexto, user_id, req.cache)
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+        estado = "ok"
+        if not (interpretacion or "").strip():
+            # Fallback offline por sueño
+            interpretacion = interpretar_offline(texto, contexto)
+            estado = "offline"
+        titulo = titulo or TITULO_POR_DEFECTO
+        sesion_id = str(uuid4())
+        linea = {"index": i, "status": estado, "sesion_id": sesion_id, "interpretacion": interpretacion, "title": titulo, "titulo": titulo}
+        if error:
+            linea["error"] = error
+        registro = {
+            "index": i, "sesion_id": sesion_id, "archivo": item.filename or "(batch)", "texto": texto,
+            "contexto": contexto, "interpretacion": interpretacion, "titulo": titulo,
+        }
+        return linea, registro
+
+    cola: "asyncio.Queue[Optional[str]]" = asyncio.Queue()  # None = fin del lote
+
+    async def ejecutar() -> None:
+        tareas = [asyncio.ensure_future(procesar(i, item)) for i, item in enumerate(req.items)]
+        registros: List[Dict[str, Any]] = []
+        resumen = {"ok": 0, "offline": 0, "error": 0}
         try:
-            from os import getenv
-            try:
-                prev_n = int(getenv("PREVIOUS_N", "5"))
-            except ValueError:
-                prev_n = 5
-            try:
-                prev_fu_n = int(getenv("PREV_FOLLOWUPS_N", "3"))
-            except ValueError:
-                prev_fu_n = 3
-            try:
-                prev_json_max = int(getenv("PREV_JSON_MAX_CHARS", "20000"))
-            except ValueError:
-                prev_json_max = 20000
-            # Usar memoria filtrada por usuario
-            memoria_json = _memoria_json_compacta_user(user_id, prev_n, prev_fu_n, prev_json_max)
-
-            payload = {
-                "texto_sueno": texto_sueno,
-                "contexto_emocional": req.contexto_emocional or "",
-                "memoria_json": memoria_json,
-            }
-            try:
-                timeout_secs = int(os.getenv("LLM_TIMEOUT_SECS", "20"))
-            except Exception:
-                timeout_secs = 20
+            for siguiente in asyncio.as_completed(tareas):
+                linea, registro = await siguiente
+                resumen[linea["status"]] += 1
+                if registro is not None:
+                    registros.append(registro)
+                cola.put_nowait(json.dumps(linea, ensure_ascii=False) + "\n")
+            registros.sort(key=lambda r: r["index"])
+            guardadas = await run_in_threadpool(_persistir_sesiones_lote, registros, user_id)
+            cola.put_nowait(json.dumps({"done": True, "total": len(req.items), **resumen, "persisted": guardadas}, ensure_ascii=False) + "\n")
+        except Exception as e:
+            print(f"Error procesando lote: {e}")
+        finally:
+            for t in tareas:
+                if not t.done():
+                    t.cancel()
+            cola.put_nowait(None)
 
-            def _invoke():
-                return chain.invoke(payload)
+    tarea = asyncio.ensure_future(ejecutar())
+    _TAREAS_FONDO.add(tarea)
+    tarea.add_done_callback(_TAREAS_FONDO.discard)
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(_invoke)
-                res = fut.result(timeout=timeout_secs)
-            if isinstance(res, str):
-                interpretacion = res
-            else:
-                content = getattr(res, "content", None)
-                if isinstance(content, str) and content.strip():
-                    interpretacion = content
-                elif isinstance(res, dict) and "text" in res:
-                    interpretacion = str(res.get("text", ""))
-                else:
-                    interpretacion = str(res)
-        except concurrent.futures.TimeoutError:
-            interpretacion = ""
-        except Exception:
-            interpretacion = ""
+    async def lineas():
+        while (linea := await cola.get()) is not None:
+            yield linea
 
-    if not (interpretacion or "").strip():
-        interpretacion = interpretar_offline(texto_sueno, req.contexto_emocional or "")
-    
-    if not (interpretacion or "").strip():
-        raise HTTPException(status_code=502, detail="No se pudo generar la interpretación. Revisa tu API key/red.")
-    
-    # Guardar archivo
-    ruta_salida = guardar_interpretacion(req.ruta, interpretacion)
-    
-    # Generar título automáticamente
-    titulo = None
-    try:
-        if texto_sueno:
-            titulo, _ = _generate_dream_title(texto_sueno)
-    except Exception:
-        pass
-    
-    if not titulo:
-        titulo = "Sueño interpretado"
-    
-    # Crear sesión con user_id
+    return StreamingResponse(lineas(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# --- Streaming (Server-Sent Events) ---
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _sse(evento: str, data: Dict[str, Any]) -> str:
+    return f"event: {evento}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/interpret-text/stream")
+async def interpret_text_stream(req: InterpretTextRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("interpretacion"))) -> StreamingResponse:
+    """Variante de /interpret-text que emite la interpretación como SSE.
+    Eventos: `token` ({"text"}) por fragmento, y al final `done` con sesion_id y título
+    (o `error` si el stream se interrumpe). La sesión se persiste solo al completar el
+    stream; si el cliente se desconecta antes, no se guarda nada.
+    """
+    texto = (req.texto_sueno or "").strip()
+    if not texto:
+        raise HTTPException(status_code=400, detail="texto_sueno requerido")
+    await _cobrar_uso(request, current_user)
+
+    user_id = current_user["user_id"]
+    contexto = req.contexto_emocional or ""
+    forzar_offline = bool(req.offline) or os.getenv("FORCE_OFFLINE", "0") == "1"
+    chain = None if forzar_offline else construir_cadena_interprete()
+    if chain is not None:
+        _rechazar_si_saturado("interpretacion")
+
+    async def eventos():
+        partes: List[str] = []
+        clave = None
+        cacheado = None
+        if chain is not None and req.cache and _cache_interpretacion_habilitada():
+            clave = _clave_cache_interpretacion(texto, contexto, user_id)
+            cacheado = await run_in_threadpool(_cache_interpretacion_get, clave)
+        # El título se pide a Gemini solo si no hubo acierto en la caché
+        titulo_task = None if forzar_offline or cacheado is not None else asyncio.ensure_future(_agenerar_titulo(texto))
+        try:
+            if cacheado is not None:
+                partes.append(cacheado["interpretacion"])
+                yield _sse("token", {"text": cacheado["interpretacion"]})
+            elif chain is not None:
+                try:
+                    payload = await _payload_interprete(texto, contexto, user_id)
+                    async with _BREAKER_GEMINI.llamada(), _LIMITES["interpretacion"].slot():
+                        with _medir_llm("interpretacion", _modelo_texto_actual()):
+                            async for trozo in _astream_con_timeout(chain, payload):
+                                partes.append(trozo)
+                                yield _sse("token", {"text": trozo})
+                except ServicioSaturado as e:
+                    yield _sse("error", {"detail": str(e), "retry_after": e.retry_after})
+                    return
+                except Exception as e:
+                    if partes:
+                        # Interpretación a medias: no persistir una sesión incompleta
+                        yield _sse("error", {"detail": "La interpretación se interrumpió; no se guardó la sesión"})
+                        return
+                    motivo = "timeout" if isinstance(e, asyncio.TimeoutError) else "circuit_open" if isinstance(e, CircuitoAbierto) else "error"
+                    _fallback("interpretacion", motivo)
+            interpretacion = "".join(partes)
+            completa = bool(interpretacion.strip())
+            if not completa:
+                # Fallback offline para no dejar vacío
+                interpretacion = interpretar_offline(texto, contexto)
+                yield _sse("token", {"text": interpretacion})
+
+            titulo = None
+            if cacheado is not None:
+                titulo = cacheado.get("titulo") or TITULO_POR_DEFECTO
+            elif titulo_task is not None:
+                titulo, _ = await titulo_task
+                if clave is not None and completa:
+                    await run_in_threadpool(_cache_interpretacion_set, clave, {"interpretacion": interpretacion, "titulo": titulo})
+                titulo = titulo or TITULO_POR_DEFECTO
+
+            ruta_salida: Optional[str] = None
+            if req.save:
+                ruta_salida = await run_in_threadpool(_guardar_salida_api, req.filename, interpretacion)
+            with _etapa("persistir_sesion"):
+                sesion_id = await run_in_threadpool(_persistir_sesion_texto, req.filename or "(API)", texto, contexto, interpretacion, ruta_salida, user_id, titulo)
+            yield _sse("done", {"sesion_id": sesion_id, "ruta_salida": ruta_salida, "title": titulo, "titulo": titulo})
+        finally:
+            if titulo_task is not None and not titulo_task.done():
+                titulo_task.cancel()
+
+    return StreamingResponse(eventos(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def _persistir_sesion_archivo(ruta: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: Optional[str], user_id: str, titulo: Optional[str]) -> Optional[str]:
+    """Crea la sesión de /interpret-file con user_id (Mongo o JSON local)."""
     sesion_id = None
     if _get_mongo_collection() is not None:
         try:
-            mongo_id = _mongo_create_session(req.ruta, texto_sueno, req.contexto_emocional or "", interpretacion, ruta_salida, user_id, titulo)
+            mongo_id = _mongo_create_session(ruta, texto_sueno, contexto, interpretacion, ruta_salida, user_id, titulo)
             if mongo_id:
                 sesion_id = mongo_id
         except Exception:
             pass
     else:
-        # Fallback a JSON local (pero agregar user_id)
+        # Fallback a JSON local (con user_id)
         try:
-            sesion_id = _crear_sesion(req.ruta, texto_sueno, req.contexto_emocional or "", interpretacion, ruta_salida)
-            # Intentar agregar user_id a la sesión creada
-            if sesion_id:
-                from reporte6_BernardoBojalil import MEM
-                for s in MEM.get("sessions", []):
-                    if s.get("id") == sesion_id:
-                        s["user_id"] = user_id
-                        break
+            sesion_id = _crear_sesion(ruta, texto_sueno, contexto, interpretacion, ruta_salida, user_id)
         except Exception:
             pass
-    
+    return sesion_id
+
+
+@app.post("/interpret-file")
+async def interpret_file(
+    req: InterpretFileRequest,
+    request: Request,
+    response: Response,
+    current_user: Dict[str, Any] = Depends(_limite_uso("interpretacion")),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+) -> Dict[str, Any]:
+    if not (req.ruta or "").strip():
+        raise HTTPException(status_code=400, detail="ruta requerida")
+
+    user_id = current_user["user_id"]
+    huella = _hash_hex("interpret-file", req.ruta, _normalizar_texto(req.contexto_emocional or ""))
+
+    async def trabajo() -> Dict[str, Any]:
+        await _cobrar_uso(request, current_user)
+        return await _interpret_file(req, user_id)
+
+    return await _con_idempotencia(idempotency_key, user_id, "interpret-file", huella, response, trabajo)
+
+
+async def _interpret_file(req: InterpretFileRequest, user_id: str) -> Dict[str, Any]:
+    contexto = req.contexto_emocional or ""
+
+    # Leer archivo
+    from reporte6_BernardoBojalil import leer_sueno, guardar_interpretacion
+    texto_sueno = await run_in_threadpool(leer_sueno, req.ruta)
+    if texto_sueno is None:
+        raise HTTPException(status_code=400, detail="No se pudo leer el archivo del sueño")
+
+    # Interpretar con memoria filtrada por usuario; el título se genera en paralelo
+    interpretacion, titulo = await _interpretar_con_titulo(texto_sueno, contexto, user_id)
+
+    if not (interpretacion or "").strip():
+        with _etapa("interpretacion_offline"):
+            interpretacion = interpretar_offline(texto_sueno, contexto)
+
+    if not (interpretacion or "").strip():
+        raise HTTPException(status_code=502, detail="No se pudo generar la interpretación. Revisa tu API key/red.")
+
+    # Guardar archivo
+    with _etapa("guardar_archivo"):
+        ruta_salida = await run_in_threadpool(guardar_interpretacion, req.ruta, interpretacion)
+
+    if not titulo:
+        titulo = TITULO_POR_DEFECTO
+
+    # Crear sesión con user_id
+    with _etapa("persistir_sesion"):
+        sesion_id = await run_in_threadpool(_persistir_sesion_archivo, req.ruta, texto_sueno, contexto, interpretacion, ruta_salida, user_id, titulo)
+
     return {
         "interpretacion": interpretacion,
         "ruta_salida": ruta_salida,
@@ -867,6 +2967,7 @@ def delete_session(sesion_id: str, current_user: Dict[str, Any] = Depends(get_cu
             result = col.delete_one({"id": sesion_id, "user_id": user_id})
             
             if result.deleted_count > 0:
+                _invalidar_memoria(user_id)
                 return {
                     "message": "Sesión eliminada exitosamente",
                     "sesion_id": sesion_id,
@@ -880,39 +2981,17 @@ def delete_session(sesion_id: str, current_user: Dict[str, Any] = Depends(get_cu
             print(f"Error eliminando sesión de MongoDB: {e}")
             raise HTTPException(status_code=500, detail="Error al eliminar la sesión")
     
-    # Si no hay MongoDB, intentar eliminar del archivo JSON local
+    # Si no hay MongoDB, eliminar de la memoria JSON local (queda registrado en el journal)
     try:
-        import json
-        memoria_path = "memoria_agente.json"
-        
-        if not os.path.exists(memoria_path):
+        s = _buscar_sesion(sesion_id)
+        if not s:
             raise HTTPException(status_code=404, detail="Sesión no encontrada")
-        
-        with open(memoria_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        
-        sesiones = data.get("sesiones", [])
-        sesion_encontrada = False
-        nuevas_sesiones = []
-        
-        for s in sesiones:
-            if s.get("id") == sesion_id:
-                # Verificar que pertenezca al usuario
-                if s.get("user_id") and s.get("user_id") != user_id:
-                    raise HTTPException(status_code=403, detail="No tienes permiso para eliminar esta sesión")
-                sesion_encontrada = True
-                # No añadir esta sesión a nuevas_sesiones (eliminarla)
-            else:
-                nuevas_sesiones.append(s)
-        
-        if not sesion_encontrada:
+        # Verificar que pertenezca al usuario
+        if s.get("user_id") and s.get("user_id") != user_id:
+            raise HTTPException(status_code=403, detail="No tienes permiso para eliminar esta sesión")
+        if not _eliminar_sesion(sesion_id):
             raise HTTPException(status_code=404, detail="Sesión no encontrada")
         
-        # Guardar el archivo actualizado
-        data["sesiones"] = nuevas_sesiones
-        with open(memoria_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
         return {
             "message": "Sesión eliminada exitosamente",
             "sesion_id": sesion_id,
@@ -925,12 +3004,93 @@ def delete_session(sesion_id: str, current_user: Dict[str, Any] = Depends(get_cu
         raise HTTPException(status_code=500, detail="Error al eliminar la sesión")
 
 
-@app.post("/sessions/{sesion_id}/followup")
-def followup_handler(sesion_id: str, req: FollowupRequest, current_user: Dict[str, Any] = Depends(get_current_user)) -> Dict[str, Any]:
-    user_id = current_user["user_id"]
+def _cargar_sesion_usuario(sesion_id: str, user_id: str) -> Optional[Dict[str, Any]]:
     s = _mongo_get_session(sesion_id, user_id) if _get_mongo_collection() is not None else None
     if not s:
         s = _buscar_sesion(sesion_id)
+    return s
+
+
+def _persistir_followup(sesion_id: str, pregunta: str, respuesta: str) -> None:
+    """Persistir follow-up según backend disponible."""
+    if _get_mongo_collection() is not None:
+        ok = _mongo_add_followup(sesion_id, pregunta, respuesta)
+        if not ok:
+            # Intentar también en memoria JSON para no perder datos
+            try:
+                _agregar_followup(sesion_id, pregunta, respuesta)
+            except Exception:
+                pass
+    else:
+        try:
+            _agregar_followup(sesion_id, pregunta, respuesta)
+        except Exception:
+            pass
+
+
+# --- Resumen de follow-ups (en segundo plano) ---
+# Los follow-ups antiguos se condensan en `followups_resumen` y el prompt solo lleva ese
+# resumen más los últimos FOLLOWUP_RECENT_N Q/A. El resumen se actualiza después de
+# responder, sin bloquear la respuesta al usuario.
+_RESUMENES_EN_CURSO: set = set()
+_TAREAS_FONDO: set = set()
+
+
+def _guardar_resumen_followups(sesion_id: str, campos: Dict[str, Any]) -> None:
+    col = _get_mongo_collection()
+    if col is not None:
+        try:
+            if col.update_one({"id": sesion_id}, {"$set": campos}).matched_count:
+                return
+        except Exception as e:
+            print(f"Error guardando resumen de follow-ups en MongoDB: {e}")
+    _actualizar_sesion(sesion_id, campos)
+
+
+async def _refrescar_resumen_followups(sesion_id: str, user_id: str) -> None:
+    try:
+        s = await run_in_threadpool(_cargar_sesion_usuario, sesion_id, user_id)
+        if not s:
+            return
+        pendientes, hasta = _followups_por_resumir(s)
+        if not pendientes:
+            return
+        resumen = ""
+        chain = construir_cadena_resumen()
+        if chain is not None:
+            try:
+                async with _BREAKER_GEMINI.llamada(), _LIMITES["followup"].slot():
+                    with _medir_llm("resumen", _modelo_texto_actual()):
+                        resumen = await _ainvoke_con_timeout(chain, _payload_resumen(s, pendientes))
+            except Exception:
+                resumen = ""  # se usa el resumen extractivo
+                _fallback("resumen", "error")
+        await run_in_threadpool(_guardar_resumen_followups, sesion_id, _campos_resumen(s, pendientes, hasta, resumen))
+    except Exception as e:
+        print(f"Aviso: no se pudo actualizar el resumen de follow-ups: {e}")
+    finally:
+        _RESUMENES_EN_CURSO.discard(sesion_id)
+
+
+def _programar_resumen_followups(sesion_id: str, user_id: str, s: Dict[str, Any]) -> None:
+    """Lanza la actualización del resumen si, con el follow-up recién agregado,
+    quedan Q/A antiguos sin resumir. `s` es la sesión leída antes de responder."""
+    total = len(s.get("followups") or []) + 1
+    if total - _followups_recientes() <= int(s.get("followups_resumidos") or 0):
+        return
+    if sesion_id in _RESUMENES_EN_CURSO:
+        return
+    _RESUMENES_EN_CURSO.add(sesion_id)
+    tarea = asyncio.ensure_future(_refrescar_resumen_followups(sesion_id, user_id))
+    _TAREAS_FONDO.add(tarea)
+    tarea.add_done_callback(_TAREAS_FONDO.discard)
+
+
+@app.post("/sessions/{sesion_id}/followup")
+async def followup_handler(sesion_id: str, req: FollowupRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("followup"))) -> Dict[str, Any]:
+    user_id = current_user["user_id"]
+    with _etapa("cargar_sesion"):
+        s = await run_in_threadpool(_cargar_sesion_usuario, sesion_id, user_id)
     if not s:
         raise HTTPException(status_code=404, detail="Sesión no encontrada")
     # Verificar que la sesión pertenezca al usuario (si tiene user_id)
@@ -939,10 +3099,12 @@ def followup_handler(sesion_id: str, req: FollowupRequest, current_user: Dict[st
     pregunta = (req.pregunta or "").strip()
     if not pregunta:
         raise HTTPException(status_code=400, detail="pregunta requerida")
+    await _cobrar_uso(request, current_user)
 
     chain_fu = construir_cadena_followup()
     if chain_fu is None:
         raise HTTPException(status_code=503, detail="Cadena de follow-up no disponible (revisa API/red)")
+    _BREAKER_GEMINI.rechazar_si_abierto()
 
     try:
         historial_txt = ""
@@ -961,43 +3123,87 @@ def followup_handler(sesion_id: str, req: FollowupRequest, current_user: Dict[st
             "pregunta": pregunta,
             "historial": historial_txt,
         }
-        try:
-            timeout_secs = int(os.getenv("LLM_TIMEOUT_SECS", "20"))
-        except Exception:
-            timeout_secs = 20
-
-        def _invoke_fu():
-            return chain_fu.invoke(payload_fu)
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as ex:
-            fut = ex.submit(_invoke_fu)
-            resp = fut.result(timeout=timeout_secs)
-        if not isinstance(resp, str):
-            resp = getattr(resp, "content", None) or str(resp)
-        respuesta = str(resp)
-    except concurrent.futures.TimeoutError as e:
+        _log_tokens("followup", user_id, payload_fu)
+        async with _BREAKER_GEMINI.llamada(), _LIMITES["followup"].slot():
+            with _medir_llm("followup", _modelo_texto_actual()):
+                respuesta = await _ainvoke_con_timeout(chain_fu, payload_fu)
+    except asyncio.TimeoutError:
         raise HTTPException(status_code=504, detail="Tiempo de espera agotado para follow-up")
+    except (ServicioSaturado, CircuitoAbierto):
+        raise
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"No fue posible responder el seguimiento: {e}")
 
-    # Persistir follow-up según backend disponible
-    if _get_mongo_collection() is not None:
-        ok = _mongo_add_followup(sesion_id, pregunta, respuesta)
-        if not ok:
-            # Intentar también en memoria JSON para no perder datos
-            try:
-                _agregar_followup(sesion_id, pregunta, respuesta)
-            except Exception:
-                pass
-    else:
-        try:
-            _agregar_followup(sesion_id, pregunta, respuesta)
-        except Exception:
-            pass
+    with _etapa("persistir_followup"):
+        await run_in_threadpool(_persistir_followup, sesion_id, pregunta, respuesta)
+    _programar_resumen_followups(sesion_id, user_id, s)
 
     return {"respuesta": respuesta}
 
 
+@app.post("/sessions/{sesion_id}/followup/stream")
+async def followup_stream(sesion_id: str, req: FollowupRequest, request: Request, current_user: Dict[str, Any] = Depends(_limite_uso("followup"))) -> StreamingResponse:
+    """Variante SSE de /sessions/{id}/followup: eventos `token` y al final `done`
+    (con sesion_id y la respuesta completa) o `error`. El follow-up se guarda solo al completar.
+    """
+    user_id = current_user["user_id"]
+    s = await run_in_threadpool(_cargar_sesion_usuario, sesion_id, user_id)
+    if not s:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada")
+    if s.get("user_id") and s.get("user_id") != user_id:
+        raise HTTPException(status_code=403, detail="No tienes permiso para acceder a esta sesión")
+    pregunta = (req.pregunta or "").strip()
+    if not pregunta:
+        raise HTTPException(status_code=400, detail="pregunta requerida")
+    await _cobrar_uso(request, current_user)
+
+    chain_fu = construir_cadena_followup()
+    if chain_fu is None:
+        raise HTTPException(status_code=503, detail="Cadena de follow-up no disponible (revisa API/red)")
+    _BREAKER_GEMINI.rechazar_si_abierto()
+    _rechazar_si_saturado("followup")
+
+    from reporte6_BernardoBojalil import _historial_followup_texto
+
+    payload_fu = {
+        "texto_sueno": s.get("texto_sueno", ""),
+        "contexto_emocional": s.get("contexto_emocional", ""),
+        "interpretacion_previa": s.get("interpretacion", ""),
+        "pregunta": pregunta,
+        "historial": _historial_followup_texto(s),
+    }
+    _log_tokens("followup", user_id, payload_fu)
+
+    async def eventos():
+        partes: List[str] = []
+        try:
+            async with _BREAKER_GEMINI.llamada(), _LIMITES["followup"].slot():
+                with _medir_llm("followup", _modelo_texto_actual()):
+                    async for trozo in _astream_con_timeout(chain_fu, payload_fu):
+                        partes.append(trozo)
+                        yield _sse("token", {"text": trozo})
+        except (ServicioSaturado, CircuitoAbierto) as e:
+            yield _sse("error", {"detail": str(e), "retry_after": e.retry_after})
+            return
+        except asyncio.TimeoutError:
+            yield _sse("error", {"detail": "Tiempo de espera agotado para follow-up"})
+            return
+        except Exception as e:
+            yield _sse("error", {"detail": f"No fue posible responder el seguimiento: {e}"})
+            return
+        respuesta = "".join(partes)
+        if not respuesta.strip():
+            # Stream terminado sin contenido: no guardar un follow-up vacío
+            yield _sse("error", {"detail": "El modelo no devolvió respuesta; no se guardó el seguimiento"})
+            return
+        with _etapa("persistir_followup"):
+            await run_in_threadpool(_persistir_followup, sesion_id, pregunta, respuesta)
+        _programar_resumen_followups(sesion_id, user_id, s)
+        yield _sse("done", {"sesion_id": sesion_id, "respuesta": respuesta})
+
+    return StreamingResponse(eventos(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 # Convenience root
 @app.get("/")
 def root() -> Dict[str, Any]:
@@ -0,0 +1,222 @@
+"""
+======================================================
+ Benchmark de la API (sin consumir cuota de Gemini)
+======================================================
+Ejecuta la app FastAPI en proceso (httpx + ASGITransport) con los sustitutos locales de
+llm_fake.py (o con respuestas grabadas de Gemini: --backend replay, ver llm_cassette.py) y mide, por escenario y nivel de concurrencia: latencia p50/p95/p99, peticiones
+por segundo, errores y memoria (RSS y, opcionalmente, pico de tracemalloc).
+
+Escenarios: interpret (POST /interpret-text), sessions (GET /sessions),
+followup (POST /sessions/{id}/followup) e image (POST /generate-image).
+Almacenes: json (memoria_agente.json + journal en un directorio temporal) y mongo
+(mongomock como sustituto local de MongoDB; requiere `pip install mongomock`).
+
+Uso:
+    python bench/bench_api.py --concurrency 1,8,32 --requests 200
+    python bench/bench_api.py --scenarios interpret,followup --stores json --llm-latency lognormal:0.8:0.4
+    python bench/bench_api.py --json resultados.json
+    python bench/bench_api.py --backend replay --cassette cassettes/gemini.jsonl.zst --timing fast
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ESCENARIOS = ("interpret", "sessions", "followup", "image")
+
+
+def _args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Benchmark de la API con LLM e imágenes simulados")
+    p.add_argument("--scenarios", default=",".join(ESCENARIOS))
+    p.add_argument("--stores", default="json,mongo")
+    p.add_argument("--concurrency", default="1,8,32", help="niveles de concurrencia separados por coma")
+    p.add_argument("--requests", type=int, default=200, help="peticiones por escenario y nivel")
+    p.add_argument("--users", type=int, default=20, help="usuarios distintos entre los que se reparten las peticiones")
+    p.add_argument("--backend", choices=("fake", "replay"), default="fake", help="replay: respuestas grabadas en el cassette (LLM_CASSETTE)")
+    p.add_argument("--cassette", default=None, help="ruta del cassette para --backend replay")
+    p.add_argument("--timing", choices=("original", "fast"), default="original", help="ritmo del replay")
+    p.add_argument("--llm-latency", default="lognormal:0.05:0.3", help="ver FAKE_LLM_LATENCY en llm_fake.py")
+    p.add_argument("--image-latency", default="uniform:0.05:0.15")
+    p.add_argument("--error-rate", type=float, default=0.0, help="tasa de error del LLM simulado")
+    p.add_argument("--token-delay", type=float, default=0.0)
+    p.add_argument("--tracemalloc", action="store_true", help="mide el pico de memoria Python por escenario (más lento)")
+    p.add_argument("--json", default=None, help="guarda los resultados en este archivo")
+    return p.parse_args()
+
+
+def _configurar_entorno(args: argparse.Namespace, directorio: str) -> None:
+    """Debe ejecutarse antes de importar app (la configuración se lee al importar)."""
+    os.environ.update({
+        "LLM_BACKEND": args.backend,
+        "IMAGE_BACKEND": args.backend,
+        "LLM_CASSETTE_TIMING": args.timing,
+        "FAKE_LLM_LATENCY": args.llm_latency,
+        "FAKE_IMAGE_LATENCY": args.image_latency,
+        "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "FAKE_LLM_TOKEN_DELAY": str(args.token_delay),
+        "MEMORY_PATH": os.path.join(directorio, "memoria_bench.json"),
+        "IMAGE_STORE": "local",
+        "IMAGE_STORE_DIR": os.path.join(directorio, "imagenes"),
+        "RATE_LIMIT": "0",
+        "LOG_TOKENS": "0",
+        "LOG_REQUESTS": "0",
+        "INTERP_CACHE": "0",
+    })
+    for clase in ("INTERPRETE", "FOLLOWUP", "TITULO", "IMAGEN"):
+        os.environ.setdefault(f"LLM_MAX_CONCURRENCY_{clase}", "1024")
+        os.environ.setdefault(f"LLM_MAX_QUEUE_{clase}", "4096")
+    if args.cassette:
+        os.environ["LLM_CASSETTE"] = os.path.abspath(args.cassette)
+    os.environ.pop("MONGODB_URI", None)
+    sys.path.insert(0, RAIZ)
+
+
+def _rss_mb() -> float:
+    """RSS actual en MB (Linux: /proc/self/statm; si no, pico de getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            paginas = int(f.read().split()[1])
+        return paginas * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except Exception:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _percentil(valores: list, p: int) -> float:
+    if len(valores) < 2:
+        return valores[0] if valores else 0.0
+    return statistics.quantiles(valores, n=100, method="inclusive")[p - 1]
+
+
+async def _correr(cliente, peticion, n: int, concurrencia: int) -> dict:
+    latencias: list = []
+    errores = 0
+    pendientes = iter(range(n))
+
+    async def worker():
+        nonlocal errores
+        for i in pendientes:
+            t0 = time.perf_counter()
+            try:
+                r = await peticion(cliente, i)
+                if r.status_code >= 400:
+                    errores += 1
+            except Exception:
+                errores += 1
+            latencias.append(time.perf_counter() - t0)
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrencia)))
+    total = time.perf_counter() - inicio
+    return {
+        "requests": n,
+        "errors": errores,
+        "rps": round(n / total, 1) if total > 0 else 0.0,
+        "p50_ms": round(1000 * _percentil(latencias, 50), 1),
+        "p95_ms": round(1000 * _percentil(latencias, 95), 1),
+        "p99_ms": round(1000 * _percentil(latencias, 99), 1),
+    }
+
+
+async def _main(args: argparse.Namespace) -> list:
+    import httpx
+    import app as A
+
+    usuarios = [f"bench-{i}" for i in range(max(1, args.users))]
+    tokens = {u: {"Authorization": "Bearer " + A.create_access_token({"sub": u, "email": f"{u}@bench.local"})} for u in usuarios}
+    escenarios = [e for e in args.scenarios.split(",") if e in ESCENARIOS]
+    niveles = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    resultados: list = []
+
+    await A.app.router.startup()
+    try:
+        for store in [s for s in args.stores.split(",") if s in ("json", "mongo")]:
+            if store == "mongo":
+                try:
+                    import mongomock
+                except ImportError:
+                    print("mongomock no está instalado; se omite el almacén mongo")
+                    continue
+                A._MONGO_CLIENT = mongomock.MongoClient()
+                os.environ["MONGODB_URI"] = "mongodb://bench.local"
+                A._asegurar_indices_mongo()
+            else:
+                A._MONGO_CLIENT = None
+                os.environ.pop("MONGODB_URI", None)
+
+            transport = httpx.ASGITransport(app=A.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as cliente:
+                # Una sesión por usuario para el escenario de follow-up
+                sesiones = {}
+                for u in usuarios:
+                    r = await cliente.post("/interpret-text", json={"texto_sueno": f"Sueño base de {u}: caminaba por una casa con agua"}, headers=tokens[u])
+                    sesiones[u] = r.json().get("sesion_id")
+
+                def usuario(i: int) -> str:
+                    return usuarios[i % len(usuarios)]
+
+                peticiones = {
+                    "interpret": lambda c, i: c.post(
+                        "/interpret-text",
+                        json={"texto_sueno": f"Sueño {i}: volaba sobre una ciudad inundada y buscaba una puerta", "contexto_emocional": "inquietud"},
+                        headers=tokens[usuario(i)],
+                    ),
+                    "sessions": lambda c, i: c.get("/sessions?limit=5", headers=tokens[usuario(i)]),
+                    "followup": lambda c, i: c.post(
+                        f"/sessions/{sesiones[usuario(i)]}/followup",
+                        json={"pregunta": f"¿Qué significa el agua en la pregunta {i}?"},
+                        headers=tokens[usuario(i)],
+                    ),
+                    "image": lambda c, i: c.post(
+                        "/generate-image",
+                        json={"descripcion_sueno": f"Sueño {i}: un bosque de relojes", "size": "1024x1024"},
+                        headers=tokens[usuario(i)],
+                    ),
+                }
+
+                for escenario in escenarios:
+                    for conc in niveles:
+                        if args.tracemalloc:
+                            import tracemalloc
+
+                            tracemalloc.start()
+                        rss_antes = _rss_mb()
+                        res = await _correr(cliente, peticiones[escenario], args.requests, conc)
+                        res.update({"store": store, "scenario": escenario, "concurrency": conc, "rss_mb": round(_rss_mb(), 1), "rss_delta_mb": round(_rss_mb() - rss_antes, 1)})
+                        if args.tracemalloc:
+                            res["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+                            tracemalloc.stop()
+                        resultados.append(res)
+                        print(
+                            f"{store:5} {escenario:9} c={conc:<4} rps={res['rps']:<8} p50={res['p50_ms']:<8} "
+                            f"p95={res['p95_ms']:<8} p99={res['p99_ms']:<8} err={res['errors']:<4} rss={res['rss_mb']} MB"
+                        )
+    finally:
+        await A.app.router.shutdown()
+    if args.backend == "replay":
+        from llm_cassette import obtener_cassette
+
+        print(f"Cassette: {obtener_cassette().stats}")
+    return resultados
+
+
+def main() -> None:
+    args = _args()
+    with tempfile.TemporaryDirectory(prefix="bench_api_") as directorio:
+        _configurar_entorno(args, directorio)
+        resultados = asyncio.run(_main(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+======================================================
+ Benchmark de arranque en frío (tiempo de importación)
+======================================================
+Importa app.py y reporte6_BernardoBojalil.py en procesos nuevos (sin caché de módulos) y
+mide cuánto tarda el `import`. Además comprueba que los SDK pesados (LangChain, Gemini,
+pymongo, passlib, colorama) NO se cargan al importar: deben cargarse en el warm-up en
+segundo plano o en la primera petición que los necesite.
+
+Sale con código 1 si algún módulo prohibido aparece tras el import o si la mediana supera
+--max-ms, para poder usarlo como comprobación en CI.
+
+Uso:
+    python bench/bench_import.py
+    python bench/bench_import.py --runs 10 --max-ms 800
+    python bench/bench_import.py --importtime 15     # top de módulos según -X importtime
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULOS = ("app", "reporte6_BernardoBojalil")
+PROHIBIDOS = ("langchain_google_genai", "langchain_core", "google.genai", "pymongo", "passlib", "colorama")
+
+_SONDA = """
+import sys, time, json
+t0 = time.perf_counter()
+import {modulo}
+ms = 1000 * (time.perf_counter() - t0)
+print(json.dumps({{"ms": ms, "cargados": [m for m in {prohibidos!r} if m in sys.modules]}}))
+"""
+
+
+def _args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Tiempo de importación y módulos cargados al arrancar")
+    p.add_argument("--modules", default=",".join(MODULOS))
+    p.add_argument("--runs", type=int, default=5, help="procesos nuevos por módulo")
+    p.add_argument("--max-ms", type=float, default=0.0, help="falla si la mediana supera este valor (0 = sin límite)")
+    p.add_argument("--importtime", type=int, default=0, help="muestra los N módulos más lentos según -X importtime")
+    return p.parse_args()
+
+
+def _entorno(directorio: str) -> dict:
+    env = dict(os.environ)
+    env["MEMORY_PATH"] = os.path.join(directorio, "memoria_bench.json")
+    for var in ("MONGODB_URI", "PYTHONDONTWRITEBYTECODE"):
+        env.pop(var, None)
+    return env
+
+
+def _medir(modulo: str, env: dict) -> dict:
+    sonda = _SONDA.format(modulo=modulo, prohibidos=PROHIBIDOS)
+    r = subprocess.run([sys.executable, "-c", sonda], cwd=RAIZ, env=env, capture_output=True, text=True)
+    if r.returncode != 0:
+        raise RuntimeError(f"import {modulo} falló:\n{r.stderr}")
+    return json.loads(r.stdout.strip().splitlines()[-1])
+
+
+def _top_importtime(modulo: str, env: dict, n: int) -> list:
+    """Módulos con mayor tiempo acumulado según `python -X importtime` (en ms)."""
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {modulo}"], cwd=RAIZ, env=env, capture_output=True, text=True)
+    filas = []
+    for linea in r.stderr.splitlines():
+        if not linea.startswith("import time:") or "|" not in linea:
+            continue
+        partes = linea[len("import time:"):].split("|")
+        try:
+            filas.append((int(partes[1]) / 1000, partes[2].strip()))
+        except ValueError:
+            continue  # cabecera
+    filas.sort(reverse=True)
+    return filas[:n]
+
+
+def main() -> None:
+    args = _args()
+    fallos = []
+    with tempfile.TemporaryDirectory(prefix="bench_import_") as directorio:
+        env = _entorno(directorio)
+        for modulo in [m.strip() for m in args.modules.split(",") if m.strip()]:
+            _medir(modulo, env)  # calienta la caché de bytecode (.pyc) para no medir la compilación
+            muestras = [_medir(modulo, env) for _ in range(max(1, args.runs))]
+            tiempos = [m["ms"] for m in muestras]
+            cargados = sorted({c for m in muestras for c in m["cargados"]})
+            mediana = statistics.median(tiempos)
+            print(f"{modulo:26} mediana={mediana:7.1f} ms  mejor={min(tiempos):7.1f} ms  runs={len(tiempos)}")
+            if cargados:
+                fallos.append(f"{modulo}: módulos pesados cargados al importar: {', '.join(cargados)}")
+            if args.max_ms and mediana > args.max_ms:
+                fallos.append(f"{modulo}: mediana {mediana:.1f} ms > {args.max_ms:.1f} ms")
+            if args.importtime:
+                for ms, nombre in _top_importtime(modulo, env, args.importtime):
+                    print(f"    {ms:8.1f} ms  {nombre}")
+    for f in fallos:
+        print(f"FALLO {f}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == "__main__":
+    main()
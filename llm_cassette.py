@@ -0,0 +1,409 @@
+"""
+======================================================
+ Cassettes de llamadas a Gemini (grabar / reproducir)
+======================================================
+Graba pares petición/respuesta reales de Gemini (interpretación, follow-up, título, resumen
+e imagen) en un archivo comprimido con zstandard y los reproduce sin red, de forma
+determinista, para medir regresiones de la API con tamaños de payload reales.
+
+- LLM_BACKEND=record: llama a Gemini normalmente y guarda cada respuesta (con sus tiempos).
+- LLM_BACKEND=replay: no llama a Gemini; responde desde el cassette.
+  IMAGE_BACKEND sigue el valor de LLM_BACKEND salvo que se indique otro.
+
+Configuración:
+
+- LLM_CASSETTE: ruta del archivo (por defecto "cassettes/gemini.jsonl.zst").
+- LLM_CASSETTE_TIMING: "original" (por defecto; respeta la latencia y el ritmo de streaming
+  grabados) o "fast" (responde de inmediato).
+- LLM_CASSETTE_STRICT=1: en replay, un prompt que no está en el cassette es un error. Por
+  defecto se usa una respuesta grabada del mismo tipo de llamada (los prompts incluyen la
+  memoria del usuario, que cambia entre corridas).
+- LLM_CASSETTE_LEVEL: nivel de compresión zstd (por defecto 10).
+
+Formato: cada entrada es una línea JSON en su propio frame zstd, así que grabar es un
+append y un archivo cortado a mitad de escritura conserva todas las entradas completas.
+La clave es el SHA-256 de modelo + prompt.
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import zstandard as zstd
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from llm_fake import _texto_prompt, tipo_llamada
+
+
+class CassetteSinEntrada(LookupError):
+    """No hay ninguna respuesta grabada utilizable para el prompt (replay)."""
+
+
+class ErrorGrabado(RuntimeError):
+    """Reproduce un error que Gemini devolvió durante la grabación."""
+
+
+def clave_prompt(modelo: str, prompt: str) -> str:
+    return hashlib.sha256(f"{modelo}\x00{prompt}".encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Archivo de entradas grabadas; seguro entre hilos."""
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._por_clave: Dict[str, List[dict]] = {}
+        self._por_tipo: Dict[str, List[dict]] = {}
+        self._turnos: Dict[str, int] = {}
+        self._compresor = None
+        self.stats = {"recorded": 0, "hits": 0, "fallbacks": 0, "misses": 0}
+        self._cargar()
+
+    # --- Lectura ---
+    def _cargar(self) -> None:
+        if not os.path.exists(self.ruta):
+            return
+        with open(self.ruta, "rb") as f:
+            lector = zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            texto = io.TextIOWrapper(lector, encoding="utf-8")
+            try:
+                for linea in texto:
+                    try:
+                        self._indexar(json.loads(linea))
+                    except ValueError:
+                        continue
+            except zstd.ZstdError:
+                # Último frame incompleto (grabación interrumpida): se conservan los anteriores
+                pass
+
+    def _indexar(self, entrada: dict) -> None:
+        self._por_clave.setdefault(entrada["key"], []).append(entrada)
+        self._por_tipo.setdefault(entrada["kind"], []).append(entrada)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._por_clave.values())
+
+    def buscar(self, tipo: str, clave: str) -> dict:
+        """Entrada para la clave (rotando si el prompt se grabó varias veces); si no existe,
+        una del mismo tipo elegida de forma determinista por la clave."""
+        with self._lock:
+            entradas = self._por_clave.get(clave)
+            if entradas:
+                turno = self._turnos.get(clave, 0)
+                self._turnos[clave] = turno + 1
+                self.stats["hits"] += 1
+                return entradas[turno % len(entradas)]
+            candidatas = self._por_tipo.get(tipo)
+            if candidatas and os.getenv("LLM_CASSETTE_STRICT", "0") != "1":
+                self.stats["fallbacks"] += 1
+                return candidatas[int(clave[:12], 16) % len(candidatas)]
+            self.stats["misses"] += 1
+        raise CassetteSinEntrada(f"Sin respuesta grabada para {tipo} ({clave[:12]}) en {self.ruta}")
+
+    # --- Escritura ---
+    def grabar(self, entrada: dict) -> None:
+        linea = (json.dumps(entrada, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._compresor is None:
+                try:
+                    nivel = int(os.getenv("LLM_CASSETTE_LEVEL", "10"))
+                except ValueError:
+                    nivel = 10
+                self._compresor = zstd.ZstdCompressor(level=nivel)
+                os.makedirs(os.path.dirname(self.ruta) or ".", exist_ok=True)
+            with open(self.ruta, "ab") as f:
+                f.write(self._compresor.compress(linea))
+            self._indexar(entrada)
+            self.stats["recorded"] += 1
+
+
+_CASSETTES: Dict[str, Cassette] = {}
+_CASSETTES_LOCK = threading.Lock()
+
+
+def obtener_cassette(ruta: Optional[str] = None) -> Cassette:
+    """Cassette compartido por ruta (LLM_CASSETTE); se carga una sola vez por proceso."""
+    ruta = os.path.abspath(ruta or os.getenv("LLM_CASSETTE", os.path.join("cassettes", "gemini.jsonl.zst")))
+    with _CASSETTES_LOCK:
+        if ruta not in _CASSETTES:
+            _CASSETTES[ruta] = Cassette(ruta)
+        return _CASSETTES[ruta]
+
+
+def _texto(content: Any) -> str:
+    """Texto de un mensaje (string o lista de bloques de contenido)."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(b if isinstance(b, str) else str(b.get("text", "")) for b in content if isinstance(b, (str, dict)))
+    return str(content)
+
+
+def _tiempos_originales() -> bool:
+    return os.getenv("LLM_CASSETTE_TIMING", "original").strip().lower() != "fast"
+
+
+# ==================== Texto ====================
+class RecordingChatModel(BaseChatModel):
+    """Envuelve el chat model real y graba cada respuesta (texto, latencia y fragmentos)."""
+
+    inner: Any
+    model: str = "gemini"
+
+    @property
+    def _llm_type(self) -> str:
+        return "gemini-record"
+
+    def _grabar(self, prompt: str, inicio: float, texto: str = "", fragmentos: Optional[list] = None, error: Optional[Exception] = None) -> None:
+        entrada = {
+            "kind": tipo_llamada(prompt),
+            "key": clave_prompt(self.model, prompt),
+            "model": self.model,
+            "prompt_chars": len(prompt),
+            "latency": round(time.monotonic() - inicio, 4),
+            "text": texto,
+        }
+        if fragmentos is not None:
+            entrada["chunks"] = fragmentos
+        if error is not None:
+            entrada["error"] = f"{type(error).__name__}: {error}"
+        try:
+            obtener_cassette().grabar(entrada)
+        except Exception as e:
+            print(f"Advertencia: no se pudo grabar en el cassette: {e}")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        prompt, inicio = _texto_prompt(messages), time.monotonic()
+        try:
+            msg = self.inner.invoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._grabar(prompt, inicio, error=e)
+            raise
+        self._grabar(prompt, inicio, _texto(msg.content))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=msg.content))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        prompt, inicio = _texto_prompt(messages), time.monotonic()
+        try:
+            msg = await self.inner.ainvoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._grabar(prompt, inicio, error=e)
+            raise
+        self._grabar(prompt, inicio, _texto(msg.content))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=msg.content))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        prompt, inicio = _texto_prompt(messages), time.monotonic()
+        fragmentos: list = []
+        try:
+            for chunk in self.inner.stream(messages, stop=stop, **kwargs):
+                trozo = _texto(chunk.content)
+                fragmentos.append([round(time.monotonic() - inicio, 4), trozo])
+                yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+        except Exception as e:
+            self._grabar(prompt, inicio, "".join(t for _, t in fragmentos), fragmentos, e)
+            raise
+        self._grabar(prompt, inicio, "".join(t for _, t in fragmentos), fragmentos)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        prompt, inicio = _texto_prompt(messages), time.monotonic()
+        fragmentos: list = []
+        try:
+            async for chunk in self.inner.astream(messages, stop=stop, **kwargs):
+                trozo = _texto(chunk.content)
+                fragmentos.append([round(time.monotonic() - inicio, 4), trozo])
+                yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+        except Exception as e:
+            self._grabar(prompt, inicio, "".join(t for _, t in fragmentos), fragmentos, e)
+            raise
+        self._grabar(prompt, inicio, "".join(t for _, t in fragmentos), fragmentos)
+
+
+def _plan_fragmentos(entrada: dict) -> List[tuple]:
+    """[(espera_antes, texto), ...] según los tiempos grabados (o sin esperas en modo fast).
+    Una respuesta grabada sin streaming se entrega en un solo fragmento tras su latencia."""
+    originales = _tiempos_originales()
+    fragmentos = entrada.get("chunks") or [[entrada.get("latency", 0.0), entrada.get("text", "")]]
+    plan, previo = [], 0.0
+    for instante, texto in fragmentos:
+        plan.append((max(0.0, instante - previo) if originales else 0.0, texto))
+        previo = instante
+    return plan
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model que responde desde el cassette, sin red."""
+
+    model: str = "gemini"
+
+    @property
+    def _llm_type(self) -> str:
+        return "gemini-replay"
+
+    def _entrada(self, messages: List[BaseMessage]) -> dict:
+        prompt = _texto_prompt(messages)
+        return obtener_cassette().buscar(tipo_llamada(prompt), clave_prompt(self.model, prompt))
+
+    def _espera_total(self, entrada: dict) -> float:
+        return float(entrada.get("latency", 0.0)) if _tiempos_originales() else 0.0
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        entrada = self._entrada(messages)
+        time.sleep(self._espera_total(entrada))
+        if entrada.get("error"):
+            raise ErrorGrabado(entrada["error"])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=entrada.get("text", "")))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        entrada = self._entrada(messages)
+        await asyncio.sleep(self._espera_total(entrada))
+        if entrada.get("error"):
+            raise ErrorGrabado(entrada["error"])
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=entrada.get("text", "")))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        entrada = self._entrada(messages)
+        for espera, trozo in _plan_fragmentos(entrada):
+            time.sleep(espera)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+        if entrada.get("error"):
+            raise ErrorGrabado(entrada["error"])
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        entrada = self._entrada(messages)
+        for espera, trozo in _plan_fragmentos(entrada):
+            await asyncio.sleep(espera)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+        if entrada.get("error"):
+            raise ErrorGrabado(entrada["error"])
+
+
+# ==================== Imágenes ====================
+def _respuesta_imagen(mime_type: str, data: bytes) -> Any:
+    parte = SimpleNamespace(inline_data=SimpleNamespace(mime_type=mime_type, data=data))
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[parte]))])
+
+
+def _prompt_imagen(contents: Any) -> str:
+    return "\n".join(str(c) for c in contents) if isinstance(contents, (list, tuple)) else str(contents)
+
+
+class _ModelsGrabando:
+    def __init__(self, inner: Any):
+        self._inner = inner
+
+    def generate_content(self, model: str, contents: Any, **kwargs: Any) -> Any:
+        prompt, inicio = _prompt_imagen(contents), time.monotonic()
+        entrada = {"kind": "imagen", "key": clave_prompt(model, prompt), "model": model, "prompt_chars": len(prompt)}
+        try:
+            response = self._inner.generate_content(model=model, contents=contents, **kwargs)
+        except Exception as e:
+            entrada.update(latency=round(time.monotonic() - inicio, 4), error=f"{type(e).__name__}: {e}")
+            try:
+                obtener_cassette().grabar(entrada)
+            except Exception as err:
+                print(f"Advertencia: no se pudo grabar en el cassette: {err}")
+            raise
+        entrada["latency"] = round(time.monotonic() - inicio, 4)
+        for candidate in getattr(response, "candidates", None) or []:
+            for part in getattr(getattr(candidate, "content", None), "parts", None) or []:
+                datos = getattr(part, "inline_data", None)
+                if datos is not None and datos.data:
+                    entrada["mime_type"] = datos.mime_type or "image/png"
+                    entrada["data"] = base64.b64encode(datos.data).decode("ascii")
+                    break
+            if "data" in entrada:
+                break
+        try:
+            obtener_cassette().grabar(entrada)
+        except Exception as e:
+            print(f"Advertencia: no se pudo grabar la imagen en el cassette: {e}")
+        return response
+
+
+class RecordingGenaiClient:
+    """Envuelve `google.genai.Client` y graba cada imagen generada."""
+
+    def __init__(self, api_key: Optional[str] = None):
+        from google import genai
+
+        self.models = _ModelsGrabando(genai.Client(api_key=api_key).models)
+
+
+class _ModelsReproduciendo:
+    def generate_content(self, model: str, contents: Any, **kwargs: Any) -> Any:
+        prompt = _prompt_imagen(contents)
+        entrada = obtener_cassette().buscar("imagen", clave_prompt(model, prompt))
+        if _tiempos_originales():
+            time.sleep(float(entrada.get("latency", 0.0)))
+        if entrada.get("error"):
+            raise ErrorGrabado(entrada["error"])
+        if not entrada.get("data"):
+            return SimpleNamespace(candidates=[])
+        return _respuesta_imagen(entrada.get("mime_type", "image/png"), base64.b64decode(entrada["data"]))
+
+
+class ReplayGenaiClient:
+    """Imita `google.genai.Client` respondiendo con las imágenes del cassette."""
+
+    def __init__(self, api_key: Optional[str] = None):
+        self.models = _ModelsReproduciendo()
@@ -0,0 +1,259 @@
+"""
+======================================================
+ Sustitutos locales de Gemini (pruebas de carga)
+======================================================
+Permiten ejercitar la API completa sin consumir cuota de Gemini:
+
+- FakeChatModel: chat model de LangChain (reemplaza a ChatGoogleGenerativeAI) con latencia
+  configurable, streaming por fragmentos y tasa de error.
+- FakeGenaiClient: imita `genai.Client(...).models.generate_content` para imágenes.
+
+Se activan con LLM_BACKEND=fake (texto) e IMAGE_BACKEND=fake (imágenes; por defecto toma
+el valor de LLM_BACKEND). Configuración por variables de entorno:
+
+- FAKE_LLM_LATENCY: latencia hasta el primer fragmento, p. ej. "0.5", "uniform:0.2:1.5",
+  "normal:0.8:0.2" o "lognormal:0.8:0.5" (mediana y sigma del logaritmo). Por defecto 0.
+- FAKE_LLM_TOKEN_DELAY: segundos entre fragmentos al hacer streaming (por defecto 0.02).
+- FAKE_LLM_ERROR_RATE: probabilidad (0..1) de que una llamada falle.
+- FAKE_LLM_CHARS: longitud aproximada de una interpretación (por defecto 1800).
+- FAKE_IMAGE_LATENCY, FAKE_IMAGE_ERROR_RATE, FAKE_IMAGE_SIZE (lado en px, por defecto 1024).
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class ErrorSimulado(RuntimeError):
+    """Error inyectado por los sustitutos (equivale a un 5xx/timeout de Gemini)."""
+
+
+def _env_float(nombre: str, defecto: float) -> float:
+    try:
+        return float(os.getenv(nombre, str(defecto)))
+    except ValueError:
+        return defecto
+
+
+def muestrear_latencia(spec: str, rng: Optional[random.Random] = None) -> float:
+    """Devuelve una latencia en segundos según la especificación:
+    "<s>" o "fixed:<s>", "uniform:<min>:<max>", "normal:<media>:<desv>", "lognormal:<mediana>:<sigma>".
+    """
+    rng = rng or random
+    partes = (spec or "0").strip().lower().split(":")
+    try:
+        if len(partes) == 1:
+            return max(0.0, float(partes[0]))
+        tipo, a = partes[0], float(partes[1])
+        b = float(partes[2]) if len(partes) > 2 else 0.0
+    except ValueError:
+        return 0.0
+    if tipo == "uniform":
+        return rng.uniform(a, b)
+    if tipo == "normal":
+        return max(0.0, rng.gauss(a, b))
+    if tipo == "lognormal":
+        import math
+
+        return rng.lognormvariate(math.log(a), b) if a > 0 else 0.0
+    return max(0.0, a)
+
+
+def _semilla(texto: str) -> int:
+    return int.from_bytes(hashlib.blake2b(texto.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+_PALABRAS = (
+    "el agua simboliza emociones profundas que buscan cauce mientras la casa representa la identidad "
+    "y sus habitaciones los aspectos aún no explorados del yo la sombra aparece como figura que "
+    "persigue lo que evitamos mirar y el vuelo sugiere deseo de libertad frente a exigencias cotidianas"
+).split()
+
+
+def _relleno(rng: random.Random, n_chars: int) -> str:
+    palabras: List[str] = []
+    total = 0
+    while total < n_chars:
+        p = rng.choice(_PALABRAS)
+        palabras.append(p)
+        total += len(p) + 1
+    return " ".join(palabras).capitalize() + "."
+
+
+def tipo_llamada(prompt: str) -> str:
+    """Clasifica un prompt de la app: "titulo", "resumen", "followup" o "interpretacion"."""
+    bajo = prompt.lower()
+    if "título" in bajo and "máximo 6 palabras" in bajo:
+        return "titulo"
+    if "resumen actualizado" in bajo:
+        return "resumen"
+    if "pregunta de seguimiento" in bajo:
+        return "followup"
+    return "interpretacion"
+
+
+def respuesta_simulada(prompt: str, longitud: int = 1800) -> str:
+    """Texto determinista (mismo prompt, misma respuesta) con la forma de cada tipo de llamada."""
+    rng = random.Random(_semilla(prompt))
+    tipo = tipo_llamada(prompt)
+    if tipo == "titulo":
+        return " ".join(rng.choice(_PALABRAS) for _ in range(4)).capitalize()
+    if tipo == "resumen":
+        return _relleno(rng, 400)
+    if tipo == "followup":
+        return _relleno(rng, 450)
+    cuarto = max(80, longitud // 4)
+    return (
+        f"Resumen simbólico:\n{_relleno(rng, cuarto)}\n\n"
+        f"Análisis psicológico:\n{_relleno(rng, cuarto)}\n\n"
+        f"Interpretación general:\n{_relleno(rng, cuarto)}\n\n"
+        f"Consejo:\n{_relleno(rng, cuarto)}"
+    )
+
+
+def _texto_prompt(messages: List[BaseMessage]) -> str:
+    return "\n".join(m.content if isinstance(m.content, str) else str(m.content) for m in messages)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model local que responde con texto simulado tras una latencia aleatoria."""
+
+    model: str = "fake-gemini"
+    latencia: str = "0"
+    retardo_token: float = 0.02
+    tasa_error: float = 0.0
+    longitud: int = 1800
+    tam_fragmento: int = 24
+
+    @classmethod
+    def desde_entorno(cls, modelo: str = "fake-gemini") -> "FakeChatModel":
+        return cls(
+            model=modelo,
+            latencia=os.getenv("FAKE_LLM_LATENCY", "0"),
+            retardo_token=_env_float("FAKE_LLM_TOKEN_DELAY", 0.02),
+            tasa_error=_env_float("FAKE_LLM_ERROR_RATE", 0.0),
+            longitud=int(_env_float("FAKE_LLM_CHARS", 1800)),
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _preparar(self, messages: List[BaseMessage]) -> tuple[float, str]:
+        if self.tasa_error > 0 and random.random() < self.tasa_error:
+            raise ErrorSimulado("Error simulado del modelo (FAKE_LLM_ERROR_RATE)")
+        return muestrear_latencia(self.latencia), respuesta_simulada(_texto_prompt(messages), self.longitud)
+
+    def _fragmentos(self, texto: str) -> List[str]:
+        n = max(1, self.tam_fragmento)
+        return [texto[i : i + n] for i in range(0, len(texto), n)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        espera, texto = self._preparar(messages)
+        time.sleep(espera)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=texto))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        espera, texto = self._preparar(messages)
+        await asyncio.sleep(espera)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=texto))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        espera, texto = self._preparar(messages)
+        time.sleep(espera)
+        for i, trozo in enumerate(self._fragmentos(texto)):
+            if i and self.retardo_token:
+                time.sleep(self.retardo_token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        espera, texto = self._preparar(messages)
+        await asyncio.sleep(espera)
+        for i, trozo in enumerate(self._fragmentos(texto)):
+            if i and self.retardo_token:
+                await asyncio.sleep(self.retardo_token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=trozo))
+
+
+# ==================== Imágenes ====================
+_PNG_CACHE: dict = {}
+
+
+def _png_simulado(lado: int, variante: int) -> bytes:
+    """PNG de `lado`x`lado` (degradado); se cachean unas pocas variantes para que el costo
+    medido sea el de la API y no el de fabricar la imagen."""
+    clave = (lado, variante)
+    if clave not in _PNG_CACHE:
+        try:
+            from PIL import Image
+
+            img = Image.linear_gradient("L").resize((lado, lado)).convert("RGB")
+            img = Image.merge("RGB", (img.getchannel(0), img.getchannel(0).rotate(90 * variante), img.getchannel(0).rotate(45)))
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+            _PNG_CACHE[clave] = buf.getvalue()
+        except Exception:
+            # PNG 1x1 mínimo si Pillow no está disponible
+            _PNG_CACHE[clave] = bytes.fromhex(
+                "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                "1f15c4890000000d49444154789c6360f8cfc0f01f0005000201a5f6b0b30000000049454e44ae426082"
+            )
+    return _PNG_CACHE[clave]
+
+
+class _FakeModels:
+    def __init__(self, cliente: "FakeGenaiClient"):
+        self._cliente = cliente
+
+    def generate_content(self, model: str, contents: Any, **kwargs: Any) -> Any:
+        c = self._cliente
+        if c.tasa_error > 0 and random.random() < c.tasa_error:
+            raise ErrorSimulado("Error simulado de generación de imagen (FAKE_IMAGE_ERROR_RATE)")
+        time.sleep(muestrear_latencia(c.latencia))
+        data = _png_simulado(c.lado, _semilla(str(contents)) % 4)
+        parte = SimpleNamespace(inline_data=SimpleNamespace(mime_type="image/png", data=data))
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[parte]))])
+
+
+class FakeGenaiClient:
+    """Imita la parte de `google.genai.Client` que usa la API (models.generate_content)."""
+
+    def __init__(self, api_key: Optional[str] = None, latencia: Optional[str] = None, tasa_error: Optional[float] = None, lado: Optional[int] = None):
+        self.latencia = latencia if latencia is not None else os.getenv("FAKE_IMAGE_LATENCY", "0")
+        self.tasa_error = tasa_error if tasa_error is not None else _env_float("FAKE_IMAGE_ERROR_RATE", 0.0)
+        self.lado = lado or int(_env_float("FAKE_IMAGE_SIZE", 1024))
+        self.models = _FakeModels(self)
@@ -11,55 +11,100 @@ Otoño 2025
 
 import os
 import json
+import shutil
 import warnings
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from uuid import uuid4
 from datetime import datetime
 from contextlib import redirect_stderr
+from importlib.util import find_spec
 from dotenv import load_dotenv
 
-# Colores en consola (opcional)
-HAVE_COLORAMA = True
-try:
-    from colorama import init as colorama_init, Fore, Style
-    colorama_init(autoreset=True)
-except Exception:
-    HAVE_COLORAMA = False
+# Colores en consola (opcional). colorama se importa e inicializa en el primer print con
+# color: importar el módulo (p. ej. desde la API) no envuelve stdout.
+HAVE_COLORAMA = find_spec("colorama") is not None
+_COLORAMA: dict = {}
+
+
+class _ColoresDiferidos:
+    """Sustituto de colorama.Fore / colorama.Style que lo importa en el primer uso."""
+
+    def __init__(self, nombre: str):
+        self._nombre = nombre
+
+    def __getattr__(self, atributo: str) -> str:
+        if not _COLORAMA:
+            try:
+                import colorama
+
+                colorama.init(autoreset=True)
+                _COLORAMA.update(Fore=colorama.Fore, Style=colorama.Style)
+            except Exception:
+                _COLORAMA.update(Fore=None, Style=None)
+        return getattr(_COLORAMA[self._nombre], atributo, "")
+
+
+Fore = _ColoresDiferidos("Fore")
+Style = _ColoresDiferidos("Style")
 
 # Reducir verbosidad gRPC/absl antes de importar clientes que puedan loguear en stderr
 os.environ.setdefault("GRPC_VERBOSITY", "NONE")  # NONE/ERROR/INFO
 os.environ.setdefault("GRPC_TRACE", "")
 
-# LangChain/Google imports (tolerantes a ausencia de librería)
-LANGCHAIN_OK = True
+# LangChain/Google imports (tolerantes a ausencia de librería). Se importan en el primer
+# uso (_cargar_langchain), no al importar el módulo: langchain_google_genai arrastra gRPC y
+# el SDK de Google, que dominan el arranque en frío. Con LLM_BACKEND=fake/replay no se
+# importa nunca.
+LANGCHAIN_OK = True  # False si alguna importación falló
 ChatGoogleGenerativeAI = None
 PromptTemplate = None
 StrOutputParser = None
+_LANGCHAIN_CARGADO = {"core": False, "gemini": False}
+_LANGCHAIN_LOCK = threading.Lock()
+
+
+def _cargar_langchain(gemini: bool = True) -> bool:
+    """Importa PromptTemplate/StrOutputParser y, si `gemini`, ChatGoogleGenerativeAI.
+    Idempotente y seguro entre hilos; devuelve LANGCHAIN_OK."""
+    global LANGCHAIN_OK, ChatGoogleGenerativeAI, PromptTemplate, StrOutputParser
+    if _LANGCHAIN_CARGADO["core"] and (_LANGCHAIN_CARGADO["gemini"] or not gemini):
+        return LANGCHAIN_OK
+    with _LANGCHAIN_LOCK:
+        if not _LANGCHAIN_CARGADO["core"]:
+            try:
+                # PromptTemplate: intentar core primero, luego fallback
+                try:
+                    from langchain_core.prompts import PromptTemplate as _PromptTemplate
+                except Exception:
+                    from langchain.prompts import PromptTemplate as _PromptTemplate
+                PromptTemplate = _PromptTemplate
 
-try:
-    # Evita que mensajes de bajo nivel contaminen la consola durante el import
-    with open(os.devnull, "w") as _devnull:
-        with redirect_stderr(_devnull):
-            from langchain_google_genai import ChatGoogleGenerativeAI as _ChatGG
-    ChatGoogleGenerativeAI = _ChatGG
-
-    # PromptTemplate: intentar core primero, luego fallback
-    try:
-        from langchain_core.prompts import PromptTemplate as _PromptTemplate
-    except Exception:
-        from langchain.prompts import PromptTemplate as _PromptTemplate
-    PromptTemplate = _PromptTemplate
-
-    # Output parser a string: core primero, luego fallback
-    try:
-        from langchain_core.output_parsers import StrOutputParser as _StrOutputParser
-    except Exception:
-        try:
-            from langchain.output_parsers import StrOutputParser as _StrOutputParser
-        except Exception:
-            _StrOutputParser = None
-    StrOutputParser = _StrOutputParser
-except Exception:
-    LANGCHAIN_OK = False
+                # Output parser a string: core primero, luego fallback
+                try:
+                    from langchain_core.output_parsers import StrOutputParser as _StrOutputParser
+                except Exception:
+                    try:
+                        from langchain.output_parsers import StrOutputParser as _StrOutputParser
+                    except Exception:
+                        _StrOutputParser = None
+                StrOutputParser = _StrOutputParser
+            except Exception:
+                LANGCHAIN_OK = False
+            _LANGCHAIN_CARGADO["core"] = True
+        if gemini and not _LANGCHAIN_CARGADO["gemini"]:
+            try:
+                # Evita que mensajes de bajo nivel contaminen la consola durante el import
+                with open(os.devnull, "w") as _devnull:
+                    with redirect_stderr(_devnull):
+                        from langchain_google_genai import ChatGoogleGenerativeAI as _ChatGG
+                ChatGoogleGenerativeAI = _ChatGG
+            except Exception:
+                LANGCHAIN_OK = False
+            _LANGCHAIN_CARGADO["gemini"] = True
+    return LANGCHAIN_OK
 
 # 1) Cargar variables de entorno
 load_dotenv()
@@ -73,39 +118,328 @@ if not google_key and gemini_key:
     google_key = gemini_key
 
 # ==================== Memoria persistente ====================
+# `MEMORY_PATH` es un snapshot completo; cada cambio se agrega como una línea JSON
+# al journal (`MEMORY_JOURNAL_PATH`), así el costo de escritura no crece con el historial.
+# Cada `MEMORY_COMPACT_EVERY` operaciones se compacta en un hilo aparte: el journal se
+# aparta (`.compactando`) y se escribe un snapshot nuevo en un temporal + rename atómico.
+# Al iniciar se carga el snapshot y se reaplican las operaciones de ambos journals con
+# `seq` mayor al del snapshot.
 MEMORY_PATH = os.getenv("MEMORY_PATH", "memoria_agente.json")
+MEMORY_JOURNAL_PATH = os.getenv("MEMORY_JOURNAL_PATH", MEMORY_PATH + ".journal")
+try:
+    MEMORY_COMPACT_EVERY = max(1, int(os.getenv("MEMORY_COMPACT_EVERY", "1000")))
+except ValueError:
+    MEMORY_COMPACT_EVERY = 1000
+MEMORY_FSYNC = os.getenv("MEMORY_FSYNC", "0") == "1"
+
+_MEM_LOCK = threading.RLock()
+_JOURNAL_SEQ = 0  # última operación registrada (incluida en snapshot o journal)
+_JOURNAL_PENDIENTES = 0  # operaciones en el journal desde la última compactación
+_COMPACTAR_LOCK = threading.Lock()  # una compactación a la vez
+_COMPACTACION_PROGRAMADA = False
+# id() de sesiones borradas que siguen en MEM["sessions"]; se filtran al compactar para no
+# copiar la lista en cada borrado (ya salieron del índice y del journal).
+_BORRADAS: set = set()
 
 def _now_iso() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
+def _aplicar_op(mem: dict, op: dict, por_id: dict, borradas: set) -> None:
+    """Aplica una operación del journal sobre `mem` (por_id: índice id -> sesión).
+    Los borrados solo se anotan en `borradas` (id() de la sesión); quien reaplica filtra
+    `mem["sessions"]` una sola vez al final."""
+    tipo = op.get("op")
+    if tipo == "session":
+        ses = op.get("data") or {}
+        mem["sessions"].append(ses)
+        por_id[ses.get("id")] = ses
+    elif tipo == "sessions":
+        for ses in op.get("data") or []:
+            mem["sessions"].append(ses)
+            por_id[ses.get("id")] = ses
+    elif tipo == "followup":
+        ses = por_id.get(op.get("id"))
+        if ses is not None:
+            ses.setdefault("followups", []).append(op.get("item") or {})
+    elif tipo == "update":
+        ses = por_id.get(op.get("id"))
+        if ses is not None:
+            ses.update(op.get("fields") or {})
+    elif tipo == "delete":
+        ses = por_id.pop(op.get("id"), None)
+        if ses is not None:
+            borradas.add(id(ses))
+    elif tipo == "idem":
+        mem.setdefault("idempotency", {})[op.get("key")] = op.get("data") or {}
+
+def _ruta_journal_rotado() -> str:
+    """Journal apartado por una compactación en curso (o interrumpida)."""
+    return MEMORY_JOURNAL_PATH + ".compactando"
+
+def _reaplicar_journal(ruta: str, data: dict, por_id: dict, borradas: set, seq: int) -> tuple:
+    """Reaplica las operaciones de `ruta` con seq mayor a `seq`. Devuelve (seq, aplicadas)."""
+    aplicadas = 0
+    fin_valido = 0  # offset tras la última línea completa
+    reparar = None
+    with open(ruta, "rb") as f:
+        for linea in f:
+            completa = linea.endswith(b"\n")
+            try:
+                op = json.loads(linea.decode("utf-8"))
+            except ValueError:
+                if completa:
+                    fin_valido += len(linea)
+                else:
+                    reparar = "truncar"
+                continue
+            fin_valido += len(linea)
+            if not completa:
+                reparar = "salto"
+            op_seq = int(op.get("seq", 0) or 0)
+            if op_seq <= seq:
+                # Ya incluida en el snapshot (caída entre rename y truncado)
+                continue
+            _aplicar_op(data, op, por_id, borradas)
+            seq = op_seq
+            aplicadas += 1
+    if reparar == "truncar":
+        with open(ruta, "r+b") as f:
+            f.truncate(fin_valido)
+    elif reparar == "salto":
+        # La línea llegó entera pero sin el salto final
+        with open(ruta, "ab") as f:
+            f.write(b"\n")
+    return seq, aplicadas
+
+def _rotar_journal() -> None:
+    """Aparta el journal actual para la compactación. Si quedó un journal apartado por una
+    compactación que no terminó, se le agrega el actual en vez de pisarlo (las operaciones
+    repetidas se ignoran al reaplicar por su seq)."""
+    rotado = _ruta_journal_rotado()
+    if not os.path.exists(MEMORY_JOURNAL_PATH):
+        return
+    if os.path.exists(rotado):
+        with open(MEMORY_JOURNAL_PATH, "rb") as src, open(rotado, "ab") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(MEMORY_JOURNAL_PATH)
+    else:
+        os.replace(MEMORY_JOURNAL_PATH, rotado)
+
 def cargar_memoria() -> dict:
+    """Carga el snapshot y reaplica el journal (primero el apartado por una compactación
+    interrumpida, si existe). Una última línea truncada (caída a mitad de escritura) se
+    descarta y se recorta del archivo, para que la siguiente operación no quede pegada a ella."""
+    global _JOURNAL_SEQ, _JOURNAL_PENDIENTES
+    data = {"sessions": []}
     try:
         if os.path.exists(MEMORY_PATH):
             with open(MEMORY_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    data.setdefault("sessions", [])
-                    return data
-        return {"sessions": []}
+                snap = json.load(f)
+                if isinstance(snap, dict):
+                    snap.setdefault("sessions", [])
+                    data = snap
     except Exception:
         # En caso de corrupción del archivo, iniciar limpio
-        return {"sessions": []}
-
-def guardar_memoria(mem: dict) -> None:
+        data = {"sessions": []}
+    seq = int(data.pop("journal_seq", 0) or 0)
+    pendientes = 0
     try:
-        with open(MEMORY_PATH, "w", encoding="utf-8") as f:
-            json.dump(mem, f, ensure_ascii=False, indent=2)
+        por_id = {s.get("id"): s for s in data["sessions"]}
+        borradas: set = set()
+        rotado = _ruta_journal_rotado()
+        for ruta in (rotado, MEMORY_JOURNAL_PATH):
+            if os.path.exists(ruta):
+                seq, aplicadas = _reaplicar_journal(ruta, data, por_id, borradas, seq)
+                pendientes += aplicadas
+        if borradas:
+            data["sessions"] = [s for s in data["sessions"] if id(s) not in borradas]
+        if os.path.exists(rotado):
+            # Se vuelve a un único journal; la próxima compactación lo incluye completo
+            if os.path.exists(MEMORY_JOURNAL_PATH):
+                with open(MEMORY_JOURNAL_PATH, "rb") as src, open(rotado, "ab") as dst:
+                    shutil.copyfileobj(src, dst)
+            os.replace(rotado, MEMORY_JOURNAL_PATH)
     except Exception as e:
-        msg = f"No se pudo guardar la memoria persistente: {e}"
+        msg = f"No se pudo reaplicar el journal de memoria: {e}"
         print((Fore.YELLOW + msg + Style.RESET_ALL) if HAVE_COLORAMA else msg)
+    _JOURNAL_SEQ = seq
+    _JOURNAL_PENDIENTES = pendientes
+    return data
 
-MEM = cargar_memoria()
+def guardar_memoria(mem: dict) -> None:
+    """Compacta: snapshot completo (JSON compacto) escrito de forma atómica.
+    Bajo _MEM_LOCK solo se serializa y se aparta el journal; la escritura y el fsync del
+    snapshot ocurren sin el lock, así que los demás escritores no esperan al disco."""
+    global _JOURNAL_PENDIENTES, _COMPACTACION_PROGRAMADA
+    with _COMPACTAR_LOCK:
+        try:
+            with _MEM_LOCK:
+                _purgar_idempotencia(mem)
+                if _BORRADAS:
+                    mem["sessions"] = [s for s in mem["sessions"] if id(s) not in _BORRADAS]
+                    _BORRADAS.clear()
+                texto = json.dumps({**mem, "journal_seq": _JOURNAL_SEQ}, ensure_ascii=False, separators=(",", ":"))
+                _rotar_journal()
+                _JOURNAL_PENDIENTES = 0
+            tmp = MEMORY_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(texto)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, MEMORY_PATH)
+            if os.path.exists(_ruta_journal_rotado()):
+                os.remove(_ruta_journal_rotado())
+        except Exception as e:
+            msg = f"No se pudo guardar la memoria persistente: {e}"
+            print((Fore.YELLOW + msg + Style.RESET_ALL) if HAVE_COLORAMA else msg)
+        finally:
+            _COMPACTACION_PROGRAMADA = False
+
+def _registrar_op(op: dict) -> None:
+    """Agrega una operación al journal (O(1)). Cada MEMORY_COMPACT_EVERY operaciones lanza
+    la compactación en un hilo aparte, fuera del camino de la petición."""
+    global _JOURNAL_SEQ, _JOURNAL_PENDIENTES, _COMPACTACION_PROGRAMADA
+    with _MEM_LOCK:
+        _JOURNAL_SEQ += 1
+        op["seq"] = _JOURNAL_SEQ
+        try:
+            with open(MEMORY_JOURNAL_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, ensure_ascii=False, separators=(",", ":")) + "\n")
+                if MEMORY_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception as e:
+            msg = f"No se pudo guardar la memoria persistente: {e}"
+            print((Fore.YELLOW + msg + Style.RESET_ALL) if HAVE_COLORAMA else msg)
+            return
+        _JOURNAL_PENDIENTES += 1
+        if _JOURNAL_PENDIENTES >= MEMORY_COMPACT_EVERY and not _COMPACTACION_PROGRAMADA:
+            _COMPACTACION_PROGRAMADA = True
+            threading.Thread(target=guardar_memoria, args=(_memoria(),), name="compactar-memoria", daemon=True).start()
+
+# Caché del bloque memoria_json ya renderizado, por usuario (None = memoria global del CLI).
+# Cada escritura sube la generación del usuario (y la global); una entrada solo es válida si
+# se construyó con la generación vigente y no ha vencido MEMORY_CACHE_TTL_SECS (cota de
+# desfase cuando otro worker escribe en Mongo).
+_MEMORIA_RENDER: "OrderedDict[tuple, tuple[int, float, str]]" = OrderedDict()
+_MEMORIA_GEN: dict = {}
+_MEMORIA_RENDER_LOCK = threading.Lock()
+_MEMORIA_RENDER_MAX = 2048
+
+def _memoria_cache_ttl() -> float:
+    try:
+        return float(os.getenv("MEMORY_CACHE_TTL_SECS", "60"))
+    except ValueError:
+        return 60.0
+
+def _generacion_memoria(user_id: str | None) -> int:
+    return _MEMORIA_GEN.get(user_id, 0)
+
+def _invalidar_memoria(user_id: str | None = None) -> None:
+    """Marca como obsoleto el memoria_json cacheado del usuario (y el global)."""
+    with _MEMORIA_RENDER_LOCK:
+        _MEMORIA_GEN[None] = _MEMORIA_GEN.get(None, 0) + 1
+        if user_id is not None:
+            _MEMORIA_GEN[user_id] = _MEMORIA_GEN.get(user_id, 0) + 1
+
+def _memoria_cache_get(clave: tuple) -> str | None:
+    with _MEMORIA_RENDER_LOCK:
+        item = _MEMORIA_RENDER.get(clave)
+        if item is None:
+            return None
+        gen, expira, texto = item
+        if gen != _MEMORIA_GEN.get(clave[0], 0) or time.monotonic() >= expira:
+            del _MEMORIA_RENDER[clave]
+            return None
+        _MEMORIA_RENDER.move_to_end(clave)
+        return texto
 
-def _crear_sesion(ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: str | None) -> str:
-    ses_id = str(uuid4())
+def _memoria_cache_set(clave: tuple, gen: int, texto: str) -> None:
+    """Guarda el render solo si nadie escribió mientras se construía (misma generación)."""
+    with _MEMORIA_RENDER_LOCK:
+        if gen != _MEMORIA_GEN.get(clave[0], 0):
+            return
+        _MEMORIA_RENDER[clave] = (gen, time.monotonic() + _memoria_cache_ttl(), texto)
+        _MEMORIA_RENDER.move_to_end(clave)
+        while len(_MEMORIA_RENDER) > _MEMORIA_RENDER_MAX:
+            _MEMORIA_RENDER.popitem(last=False)
+
+def _clave_orden(s: dict) -> str:
+    return s.get("created_at") or ""
+
+class _IndiceSesiones:
+    """Índices en memoria sobre MEM["sessions"]: id -> sesión, user_id -> sesiones y un
+    orden por `created_at` que se mantiene al insertar (no se reordena en cada consulta).
+    """
+
+    def __init__(self, sesiones: list[dict] | None = None):
+        self.reconstruir(sesiones or [])
+
+    def reconstruir(self, sesiones: list[dict]) -> None:
+        self.por_id: dict[str, dict] = {}
+        self.orden: list[dict] = []
+        self.por_usuario: dict[str | None, list[dict]] = {}
+        for s in sorted(sesiones, key=_clave_orden):
+            self.agregar(s)
+
+    def agregar(self, s: dict) -> None:
+        self.por_id[s.get("id")] = s
+        # Las sesiones nuevas suelen ser las más recientes: insort termina en O(1) amortizado
+        insort(self.orden, s, key=_clave_orden)
+        insort(self.por_usuario.setdefault(s.get("user_id"), []), s, key=_clave_orden)
+
+    def quitar(self, s: dict) -> None:
+        self.por_id.pop(s.get("id"), None)
+        self._quitar_de(self.orden, s)
+        lista = self.por_usuario.get(s.get("user_id"))
+        if lista is not None:
+            self._quitar_de(lista, s)
+
+    @staticmethod
+    def _quitar_de(lista: list[dict], s: dict) -> None:
+        # bisect hasta la primera sesión con el mismo created_at y se recorren solo los empates
+        clave = _clave_orden(s)
+        i = bisect_left(lista, clave, key=_clave_orden)
+        while i < len(lista) and _clave_orden(lista[i]) == clave:
+            if lista[i] is s:
+                del lista[i]
+                return
+            i += 1
+
+    def obtener(self, sesion_id: str) -> dict | None:
+        return self.por_id.get(sesion_id)
+
+    def ultimas(self, n: int, user_id: str | None = None) -> list[dict]:
+        """Últimas n sesiones (más recientes primero); si se da user_id, solo las suyas. O(n)."""
+        lista = self.orden if user_id is None else self.por_usuario.get(user_id, [])
+        if n <= 0:
+            return []
+        return lista[-n:][::-1]
+
+# La memoria (snapshot + journal) se carga en el primer uso, no al importar el módulo.
+# `MEM` sigue disponible como atributo del módulo (ver __getattr__ al final del archivo).
+_MEM: dict | None = None
+_INDICE: _IndiceSesiones | None = None
+
+def _memoria() -> dict:
+    global _MEM, _INDICE
+    if _MEM is None:
+        with _MEM_LOCK:
+            if _MEM is None:
+                mem = cargar_memoria()
+                _BORRADAS.clear()
+                _INDICE = _IndiceSesiones(mem["sessions"])
+                _MEM = mem
+    return _MEM
+
+def _indice() -> _IndiceSesiones:
+    _memoria()
+    return _INDICE
+
+def _nueva_sesion(ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: str | None, user_id: str | None = None, ses_id: str | None = None) -> dict:
     resumen_interpretacion = extraer_bloque_por_titulo(interpretacion, "Interpretación general") or resumen_corto(interpretacion, 240)
     ses = {
-        "id": ses_id,
+        "id": ses_id or str(uuid4()),
         "created_at": _now_iso(),
         "archivo": ruta_sueno,
         "output_file": ruta_salida,
@@ -115,42 +449,230 @@ def _crear_sesion(ruta_sueno: str, texto_sueno: str, contexto: str, interpretaci
         "interpretacion_resumen": resumen_interpretacion,
         "followups": [],
     }
-    MEM["sessions"].append(ses)
-    guardar_memoria(MEM)
-    return ses_id
+    if user_id:
+        ses["user_id"] = user_id
+    return ses
+
+def _crear_sesion(ruta_sueno: str, texto_sueno: str, contexto: str, interpretacion: str, ruta_salida: str | None, user_id: str | None = None) -> str:
+    ses = _nueva_sesion(ruta_sueno, texto_sueno, contexto, interpretacion, ruta_salida, user_id)
+    with _MEM_LOCK:
+        _memoria()["sessions"].append(ses)
+        _indice().agregar(ses)
+        _registrar_op({"op": "session", "data": ses})
+    _invalidar_memoria(user_id)
+    return ses["id"]
+
+def _crear_sesiones(items: list[dict]) -> list[str]:
+    """Crea varias sesiones con una sola entrada en el journal (modo lote).
+    Cada item trae los argumentos de _crear_sesion por nombre y, opcionalmente, "id"."""
+    sesiones = [
+        _nueva_sesion(
+            it.get("ruta_sueno", ""), it.get("texto_sueno", ""), it.get("contexto", ""), it.get("interpretacion", ""),
+            it.get("ruta_salida"), it.get("user_id"), it.get("id"),
+        )
+        for it in items
+    ]
+    if not sesiones:
+        return []
+    with _MEM_LOCK:
+        mem, indice = _memoria(), _indice()
+        for ses in sesiones:
+            mem["sessions"].append(ses)
+            indice.agregar(ses)
+        _registrar_op({"op": "sessions", "data": sesiones})
+    for user_id in {ses.get("user_id") for ses in sesiones}:
+        _invalidar_memoria(user_id)
+    return [ses["id"] for ses in sesiones]
 
 def _buscar_sesion(sesion_id: str) -> dict | None:
-    for s in MEM.get("sessions", []):
-        if s.get("id") == sesion_id:
-            return s
-    return None
+    return _indice().obtener(sesion_id)
+
+def _ultimas_sesiones(n: int, user_id: str | None = None) -> list[dict]:
+    """Últimas n sesiones locales (más recientes primero); si se da user_id, solo las suyas."""
+    return _indice().ultimas(n, user_id)
 
 def _agregar_followup(sesion_id: str, pregunta: str, respuesta: str) -> None:
-    s = _buscar_sesion(sesion_id)
-    if not s:
-        return
-    s.setdefault("followups", []).append({
-        "at": _now_iso(),
-        "question": pregunta,
-        "answer": respuesta,
-    })
-    guardar_memoria(MEM)
-
-def _historial_followup_texto(s: dict, max_items: int = 5) -> str:
-    fl = s.get("followups", [])[-max_items:]
-    if not fl:
+    with _MEM_LOCK:
+        s = _buscar_sesion(sesion_id)
+        if not s:
+            return
+        item = {
+            "at": _now_iso(),
+            "question": pregunta,
+            "answer": respuesta,
+        }
+        s.setdefault("followups", []).append(item)
+        _registrar_op({"op": "followup", "id": sesion_id, "item": item})
+    _invalidar_memoria(s.get("user_id"))
+
+def _actualizar_sesion(sesion_id: str, campos: dict) -> bool:
+    """Actualiza campos de una sesión local (p. ej. referencia a imagen). Devuelve True si existía."""
+    with _MEM_LOCK:
+        s = _buscar_sesion(sesion_id)
+        if not s:
+            return False
+        s.update(campos)
+        _registrar_op({"op": "update", "id": sesion_id, "fields": campos})
+    return True
+
+def _purgar_idempotencia(mem: dict) -> None:
+    ahora = time.time()
+    registros = mem.get("idempotency")
+    if registros:
+        mem["idempotency"] = {k: v for k, v in registros.items() if v.get("expire_at", 0) > ahora}
+
+def _buscar_idempotencia(clave: str) -> dict | None:
+    """Registro de Idempotency-Key vigente (respuesta original) o None."""
+    reg = _memoria().get("idempotency", {}).get(clave)
+    if reg is None or reg.get("expire_at", 0) <= time.time():
+        return None
+    return reg
+
+def _guardar_idempotencia(clave: str, registro: dict) -> None:
+    """Guarda un registro de Idempotency-Key (debe incluir expire_at en epoch segundos)."""
+    with _MEM_LOCK:
+        _memoria().setdefault("idempotency", {})[clave] = registro
+        _registrar_op({"op": "idem", "key": clave, "data": registro})
+
+def _eliminar_sesion(sesion_id: str) -> bool:
+    """Elimina una sesión de la memoria local. Devuelve True si existía."""
+    with _MEM_LOCK:
+        s = _buscar_sesion(sesion_id)
+        if not s:
+            return False
+        _indice().quitar(s)
+        _BORRADAS.add(id(s))
+        _registrar_op({"op": "delete", "id": sesion_id})
+    _invalidar_memoria(s.get("user_id"))
+    return True
+
+def _followups_recientes() -> int:
+    """Q/A recientes que se envían tal cual en el prompt de follow-up (FOLLOWUP_RECENT_N;
+    por defecto 5, los mismos que se enviaban antes del resumen acumulado)."""
+    try:
+        return max(1, int(os.getenv("FOLLOWUP_RECENT_N", "5")))
+    except ValueError:
+        return 5
+
+def _historial_followup_texto(s: dict, max_items: int | None = None) -> str:
+    """Historial para el prompt de follow-up: el resumen acumulado de los follow-ups
+    antiguos (si existe) más los últimos Q/A aún sin resumir. Tamaño acotado aunque la
+    conversación sea larga."""
+    if max_items is None:
+        max_items = _followups_recientes()
+    fl = s.get("followups", []) or []
+    resumidos = min(int(s.get("followups_resumidos") or 0), len(fl))
+    recientes = fl[resumidos:][-max_items:]
+    resumen = (s.get("followups_resumen") or "").strip()
+    if not recientes and not resumen:
         return "(sin historial)"
     partes = []
-    for item in fl:
+    if resumen:
+        partes.append(f"Resumen de la conversación anterior: {resumen}")
+    for item in recientes:
         partes.append(f"Q: {item.get('question','')}\nA: {item.get('answer','')}")
     return "\n".join(partes)
 
+def _followups_por_resumir(s: dict) -> tuple[list, int]:
+    """Follow-ups antiguos que aún no entran en el resumen y el nuevo total resumido."""
+    fl = s.get("followups", []) or []
+    resumidos = min(int(s.get("followups_resumidos") or 0), len(fl))
+    hasta = len(fl) - _followups_recientes()
+    if hasta <= resumidos:
+        return [], resumidos
+    return fl[resumidos:hasta], hasta
+
+def _resumen_max_chars() -> int:
+    try:
+        return max(200, int(os.getenv("FOLLOWUP_SUMMARY_MAX_CHARS", "1200")))
+    except ValueError:
+        return 1200
+
+def _resumen_followups_offline(previo: str, pendientes: list) -> str:
+    """Resumen extractivo (sin LLM): preguntas y un extracto de cada respuesta; si excede
+    el máximo se conservan los puntos más recientes."""
+    puntos = [f"P: {it.get('question','')} R: {resumen_corto(it.get('answer',''), 160)}" for it in pendientes]
+    texto = " ".join(([previo.strip()] if previo.strip() else []) + puntos)
+    maximo = _resumen_max_chars()
+    if len(texto) > maximo:
+        texto = "…" + texto[-(maximo - 1):].lstrip()
+    return texto
+
+def _formatear_followups(pendientes: list) -> str:
+    return "\n".join(f"Q: {it.get('question','')}\nA: {it.get('answer','')}" for it in pendientes)
+
+def _payload_resumen(s: dict, pendientes: list) -> dict:
+    return {"resumen_previo": s.get("followups_resumen") or "(vacío)", "nuevos": _formatear_followups(pendientes)}
+
+def _campos_resumen(s: dict, pendientes: list, hasta: int, resumen_llm: str) -> dict:
+    """Campos a guardar en la sesión; si el LLM no devolvió nada se usa el resumen extractivo."""
+    resumen = (resumen_llm or "").strip() or _resumen_followups_offline(s.get("followups_resumen") or "", pendientes)
+    return {"followups_resumen": resumen_corto(resumen, _resumen_max_chars()), "followups_resumidos": hasta}
+
+def _llm_timeout_secs() -> float:
+    """Límite por llamada a Gemini (LLM_TIMEOUT_SECS); lo usan el CLI y la API."""
+    try:
+        return float(os.getenv("LLM_TIMEOUT_SECS", "20"))
+    except ValueError:
+        return 20.0
+
+# Pool acotado para las llamadas síncronas con límite de tiempo (resumen de follow-ups del
+# CLI); se crea en el primer uso.
+_POOL_LLM = None
+_POOL_LLM_LOCK = threading.Lock()
+
+def _pool_llm():
+    global _POOL_LLM
+    if _POOL_LLM is None:
+        with _POOL_LLM_LOCK:
+            if _POOL_LLM is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                try:
+                    hilos = max(1, int(os.getenv("LLM_SYNC_WORKERS", "2")))
+                except ValueError:
+                    hilos = 2
+                _POOL_LLM = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="llm")
+    return _POOL_LLM
+
+def _invocar_con_timeout(chain, payload: dict, timeout: float | None):
+    """chain.invoke con límite de tiempo (TimeoutError si se excede). Corre en el pool
+    acotado: al vencer se cancela si aún no empezó; si ya está en curso, su hilo queda
+    ocupado hasta que responda la red (no escribe nada; al salir, Python espera a que
+    termine) y no se crean hilos nuevos."""
+    if not timeout:
+        return chain.invoke(payload)
+    from concurrent.futures import TimeoutError as FuturoVencido
+
+    futuro = _pool_llm().submit(chain.invoke, payload)
+    try:
+        return futuro.result(timeout)
+    except FuturoVencido:
+        futuro.cancel()
+        raise TimeoutError(f"sin respuesta en {timeout:g} s") from None
+
+def resumir_followups(s: dict, timeout: float | None = None) -> dict | None:
+    """Calcula los campos actualizados del resumen de follow-ups de la sesión
+    (followups_resumen, followups_resumidos), o None si no hay nada nuevo que resumir.
+    Usa Gemini si está disponible (como mucho `timeout` segundos); si falla, un resumen
+    extractivo."""
+    pendientes, hasta = _followups_por_resumir(s)
+    if not pendientes:
+        return None
+    resumen = ""
+    chain = construir_cadena_resumen()
+    if chain is not None:
+        try:
+            res = _invocar_con_timeout(chain, _payload_resumen(s, pendientes), timeout)
+            resumen = res if isinstance(res, str) else (getattr(res, "content", None) or str(res))
+        except Exception:
+            resumen = ""
+    return _campos_resumen(s, pendientes, hasta, resumen)
+
 def _resumen_ultimas_sesiones(n: int = 5) -> list[dict]:
     """Devuelve un arreglo con resumen de las últimas n sesiones (más recientes primero)."""
-    sesiones = MEM.get("sessions", [])
-    ordenadas = sorted(sesiones, key=lambda x: x.get("created_at", ""), reverse=True)
     res = []
-    for s in ordenadas[: max(0, n)]:
+    for s in _ultimas_sesiones(n):
         item = {
             "id": s.get("id"),
             "created_at": s.get("created_at"),
@@ -158,6 +680,8 @@ def _resumen_ultimas_sesiones(n: int = 5) -> list[dict]:
             "interpretacion_resumen": (s.get("interpretacion_resumen") or "").strip(),
             "output_file": s.get("output_file"),
         }
+        if s.get("thumbnail_url"):
+            item["thumbnail_url"] = s.get("thumbnail_url")
         res.append(item)
     return res
 
@@ -179,56 +703,177 @@ def _mostrar_resumen_ultimos(n: int = 5) -> None:
         linea = f"{i}. [{fecha}] {archivo}\n   → {ig}"
         print(Fore.WHITE + linea + Style.RESET_ALL if HAVE_COLORAMA else linea)
 
-def _memoria_json_compacta(max_sessions: int = 5, max_followups: int = 3, max_chars: int = 20000) -> str:
-    """Devuelve un JSON compacto con las últimas sesiones para usar como contexto.
-    Limita cantidad de sesiones, follow-ups y tamaño total para evitar prompts excesivos.
-    Controlable vía env vars: PREVIOUS_N, PREV_FOLLOWUPS_N, PREV_JSON_MAX_CHARS.
+def _estimar_tokens(texto: str) -> int:
+    """Estimación barata de tokens (~4 caracteres por token con el tokenizador de Gemini)."""
+    return (len(texto) + 3) // 4
+
+def _presupuesto_memoria() -> int:
+    """Presupuesto en tokens del bloque memoria_json (PREV_TOKENS_MAX, por defecto 1500).
+    Si solo está definido el antiguo PREV_JSON_MAX_CHARS se convierte a tokens."""
+    valor = os.getenv("PREV_TOKENS_MAX")
+    if valor is None and os.getenv("PREV_JSON_MAX_CHARS"):
+        try:
+            return max(1, int(os.getenv("PREV_JSON_MAX_CHARS", "")) // 4)
+        except ValueError:
+            pass
+    try:
+        return max(1, int(valor or "1500"))
+    except ValueError:
+        return 1500
+
+def _compacto(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _ajustar_memoria(sesiones: list[dict], max_followups: int, max_tokens: int) -> tuple[str, dict]:
+    """Construye el JSON compacto de memoria dentro de un presupuesto de tokens.
+    Las sesiones (más recientes primero) entran completas o no entran; después se agregan
+    sus follow-ups, del más reciente al más antiguo, mientras quede presupuesto. No se corta
+    texto a la mitad: el resultado siempre es JSON válido. Devuelve (json, estadísticas).
     """
+    usados = _estimar_tokens(_compacto({"sessions": []}))
+    incluidas: list[tuple[dict, list]] = []
+    for s in sesiones:
+        item = {k: s.get(k) for k in ("id", "created_at", "archivo", "contexto_emocional", "interpretacion_resumen") if s.get(k)}
+        costo = _estimar_tokens(_compacto(item)) + 1
+        if usados + costo > max_tokens:
+            continue  # se descarta la sesión completa; una más corta aún podría caber
+        usados += costo
+        fu = s.get("followups", []) or []
+        if max_followups > 0:
+            fu = fu[-max_followups:]
+        incluidas.append((item, fu))
+
+    candidatos = sorted(
+        ((f.get("at") or "", n, f) for n, (_, fu) in enumerate(incluidas) for f in fu),
+        key=lambda c: c[0],
+        reverse=True,
+    )
+    elegidos: dict[int, list] = {}
+    for _, n, f in candidatos:
+        fu_item = {k: f.get(k) for k in ("at", "question", "answer") if f.get(k)}
+        costo = _estimar_tokens(_compacto(fu_item)) + 1 + (0 if n in elegidos else _estimar_tokens('"followups":[],'))
+        if usados + costo > max_tokens:
+            continue
+        usados += costo
+        elegidos.setdefault(n, []).append(fu_item)
+
+    salida = []
+    for n, (item, _) in enumerate(incluidas):
+        if n in elegidos:
+            item = {**item, "followups": sorted(elegidos[n], key=lambda f: f.get("at") or "")}
+        salida.append(item)
+    texto = _compacto({"sessions": salida})
+    stats = {
+        "sessions": len(salida),
+        "sessions_dropped": len(sesiones) - len(salida),
+        "followups": sum(len(v) for v in elegidos.values()),
+        "followups_dropped": len(candidatos) - sum(len(v) for v in elegidos.values()),
+        "tokens": _estimar_tokens(texto),
+    }
+    return texto, stats
+
+def _memoria_json_compacta(max_sessions: int = 5, max_followups: int = 3, max_tokens: int = 1500) -> str:
+    """Devuelve un JSON compacto con las últimas sesiones para usar como contexto,
+    ajustado a un presupuesto de tokens (ver _ajustar_memoria).
+    Controlable vía env vars: PREVIOUS_N, PREV_FOLLOWUPS_N, PREV_TOKENS_MAX.
+    """
+    clave = (None, max_sessions, max_followups, max_tokens)
+    cacheado = _memoria_cache_get(clave)
+    if cacheado is not None:
+        return cacheado
+    gen = _generacion_memoria(None)
     try:
-        sesiones = MEM.get("sessions", [])
-        ordenadas = sorted(sesiones, key=lambda x: x.get("created_at", ""), reverse=True)[: max(0, max_sessions)]
-        recortadas = []
-        for s in ordenadas:
-            fu = s.get("followups", []) or []
-            if max_followups > 0:
-                fu = fu[-max_followups:]
-            recortadas.append({
-                "id": s.get("id"),
-                "created_at": s.get("created_at"),
-                "archivo": s.get("archivo"),
-                "contexto_emocional": s.get("contexto_emocional"),
-                "interpretacion_resumen": s.get("interpretacion_resumen"),
-                "followups": fu,
-            })
-        data = {"sessions": recortadas}
-        texto = json.dumps(data, ensure_ascii=False, indent=2)
-        if len(texto) > max_chars:
-            # Compactar y, si aún es largo, truncar con marca
-            texto_comp = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
-            if len(texto_comp) > max_chars:
-                return texto_comp[: max_chars - 1].rstrip() + "…"
-            return texto_comp
+        texto, _ = _ajustar_memoria(_ultimas_sesiones(max_sessions), max_followups, max_tokens)
+        _memoria_cache_set(clave, gen, texto)
         return texto
     except Exception as e:
         return f"{{\"error\": \"no se pudo construir memoria json: {str(e)}\"}}"
     
-def construir_cadena_interprete():
-    """Crea y devuelve una cadena (Runnable) de interpretación si LangChain y la clave están disponibles."""
-    if not LANGCHAIN_OK or not google_key or ChatGoogleGenerativeAI is None or PromptTemplate is None:
-        return None
+# ==================== Registro de cadenas (cache por proceso) ====================
+# Construir ChatGoogleGenerativeAI + PromptTemplate en cada petición abre un canal
+# gRPC nuevo; las cadenas se construyen una vez por configuración y se reutilizan
+# entre hilos. La clave incluye modelo, temperatura y API key: si cambia la
+# configuración en el entorno, la entrada anterior se descarta y se reconstruye.
+_CADENAS: dict[tuple, object] = {}
+_CADENAS_LOCK = threading.Lock()
 
-    # 3) Configuración del modelo Gemini
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0.8,  # alto grado de creatividad interpretativa
-        google_api_key=google_key,
-    )
+INTERPRETE_TEMPERATURE = 0.8  # alto grado de creatividad interpretativa
+FOLLOWUP_TEMPERATURE = 0.5  # tono más estable para follow-ups
+RESUMEN_TEMPERATURE = 0.2  # resúmenes fieles, sin adornos
 
-    # 4) Prompt para el traductor de sueños
-    prompt_template = PromptTemplate(
-        input_variables=["texto_sueno", "contexto_emocional", "memoria_json"],
-        template=(
-            """
+
+def _backend_llm() -> str:
+    """"gemini" (por defecto), "fake" (sustituto local de llm_fake.py para pruebas de carga),
+    "record" (Gemini grabando en el cassette) o "replay" (respuestas del cassette; ver llm_cassette.py)."""
+    return os.getenv("LLM_BACKEND", "gemini").strip().lower() or "gemini"
+
+
+def _clave_api_actual() -> str | None:
+    """Devuelve la API key vigente (GOOGLE_API_KEY con alias GEMINI_API_KEY)."""
+    clave = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY") or google_key
+    if not clave and _backend_llm() in ("fake", "replay"):
+        return _backend_llm()
+    return clave
+
+
+def _chat_disponible() -> bool:
+    if _backend_llm() in ("fake", "replay"):
+        _cargar_langchain(gemini=False)
+        return PromptTemplate is not None
+    _cargar_langchain()
+    return LANGCHAIN_OK and ChatGoogleGenerativeAI is not None and PromptTemplate is not None
+
+
+def _nuevo_llm(modelo: str, temperatura: float, api_key: str):
+    """Instancia el chat model del backend configurado (LLM_BACKEND)."""
+    if _backend_llm() == "fake":
+        from llm_fake import FakeChatModel
+
+        return FakeChatModel.desde_entorno(modelo)
+    if _backend_llm() == "replay":
+        from llm_cassette import ReplayChatModel
+
+        return ReplayChatModel(model=modelo)
+    llm = ChatGoogleGenerativeAI(model=modelo, temperature=temperatura, google_api_key=api_key)
+    if _backend_llm() == "record":
+        from llm_cassette import RecordingChatModel
+
+        return RecordingChatModel(inner=llm, model=modelo)
+    return llm
+
+
+def _modelo_texto() -> str:
+    return os.getenv("GEMINI_TEXT_MODEL", "gemini-2.5-flash")
+
+
+def _obtener_cadena(nombre: str, modelo: str, temperatura: float, api_key: str, fabrica):
+    """Devuelve la cadena registrada para (nombre, modelo, temperatura, api_key, backend),
+    construyéndola con `fabrica()` solo si no existe todavía.
+    """
+    clave = (nombre, modelo, temperatura, api_key, _backend_llm())
+    chain = _CADENAS.get(clave)
+    if chain is not None:
+        return chain
+    with _CADENAS_LOCK:
+        chain = _CADENAS.get(clave)
+        if chain is None:
+            chain = fabrica()
+            # Config distinta para el mismo nombre: descartar las entradas obsoletas
+            for k in [k for k in _CADENAS if k[0] == nombre]:
+                del _CADENAS[k]
+            _CADENAS[clave] = chain
+    return chain
+
+
+def invalidar_cadenas() -> None:
+    """Vacía el registro de cadenas; la siguiente llamada las reconstruye.
+    Útil tras cambiar variables de entorno (API key, modelo) en caliente.
+    """
+    with _CADENAS_LOCK:
+        _CADENAS.clear()
+
+
+PROMPT_INTERPRETE = """
 Eres un analista onírico con conocimientos en psicología simbólica, arquetipos jungianos,
 análisis de sueños freudiano y narrativa terapéutica contemporánea. Tu tarea es interpretar el sueño que
 te proporciona el usuario, identificando símbolos, emociones, arquetipos y posibles mensajes del inconsciente.
@@ -259,33 +904,8 @@ Tu respuesta debe incluir:
 Puedes mencionar brevemente coincidencias o patrones con sueños previos solo cuando aporten claridad (máximo 2–3 oraciones sobre esto).
 ---
 """
-        ),
-    )
-
-    # 5) Pipeline Runnable: prompt -> llm -> str
-    chain = prompt_template | llm
-    if StrOutputParser is not None:
-        chain = chain | StrOutputParser()
-    return chain
-
-
-def construir_cadena_followup():
-    """Crea y devuelve una cadena (Runnable) para responder preguntas de seguimiento
-    basadas en el sueño y la interpretación previa.
-    """
-    if not LANGCHAIN_OK or not google_key or ChatGoogleGenerativeAI is None or PromptTemplate is None:
-        return None
 
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        temperature=0.5,  # tono más estable para follow-ups
-        google_api_key=google_key,
-    )
-
-    prompt_template = PromptTemplate(
-        input_variables=["texto_sueno", "contexto_emocional", "interpretacion_previa", "pregunta", "historial"],
-        template=(
-            """
+PROMPT_FOLLOWUP = """
 Eres un analista onírico. Responde de forma breve (máximo 3–5 frases) y concreta a la pregunta
 de seguimiento del usuario. Basa tu respuesta en el sueño, el contexto emocional y la interpretación previa.
 No inventes detalles no soportados; si algo no está claro en el material, dilo explícitamente y sugiere cómo
@@ -309,7 +929,90 @@ PREGUNTA DE SEGUIMIENTO:
 ---
 Respuesta breve y directa:
 """
-        ),
+
+
+PROMPT_RESUMEN_FOLLOWUPS = """
+Mantienes un resumen breve de una conversación de seguimiento sobre la interpretación de un sueño.
+Integra los nuevos intercambios al resumen previo en un solo párrafo (máximo 120 palabras).
+Conserva las preguntas del usuario, las conclusiones y cualquier dato personal relevante que haya
+aportado; omite saludos y repeticiones. No inventes nada.
+
+---
+RESUMEN PREVIO:
+{resumen_previo}
+
+NUEVOS INTERCAMBIOS (Q/A):
+{nuevos}
+---
+Resumen actualizado:
+"""
+
+
+def _crear_cadena_interprete(modelo: str, temperatura: float, api_key: str):
+    # 3) Configuración del modelo Gemini
+    llm = _nuevo_llm(modelo, temperatura, api_key)
+
+    # 4) Prompt para el traductor de sueños
+    prompt_template = PromptTemplate(
+        input_variables=["texto_sueno", "contexto_emocional", "memoria_json"],
+        template=PROMPT_INTERPRETE,
+    )
+
+    # 5) Pipeline Runnable: prompt -> llm -> str
+    chain = prompt_template | llm
+    if StrOutputParser is not None:
+        chain = chain | StrOutputParser()
+    return chain
+
+
+def construir_cadena_interprete():
+    """Devuelve la cadena (Runnable) de interpretación si LangChain y la clave están disponibles.
+    La cadena se construye una sola vez por configuración y se reutiliza (ver registro de cadenas).
+    """
+    api_key = _clave_api_actual()
+    if not api_key or not _chat_disponible():
+        return None
+    modelo = _modelo_texto()
+    return _obtener_cadena(
+        "interprete", modelo, INTERPRETE_TEMPERATURE, api_key,
+        lambda: _crear_cadena_interprete(modelo, INTERPRETE_TEMPERATURE, api_key),
+    )
+
+
+def _crear_cadena_followup(modelo: str, temperatura: float, api_key: str):
+    llm = _nuevo_llm(modelo, temperatura, api_key)
+
+    prompt_template = PromptTemplate(
+        input_variables=["texto_sueno", "contexto_emocional", "interpretacion_previa", "pregunta", "historial"],
+        template=PROMPT_FOLLOWUP,
+    )
+
+    chain = prompt_template | llm
+    if StrOutputParser is not None:
+        chain = chain | StrOutputParser()
+    return chain
+
+
+def construir_cadena_followup():
+    """Devuelve la cadena (Runnable) para responder preguntas de seguimiento
+    basadas en el sueño y la interpretación previa. Reutiliza la instancia registrada.
+    """
+    api_key = _clave_api_actual()
+    if not api_key or not _chat_disponible():
+        return None
+    modelo = _modelo_texto()
+    return _obtener_cadena(
+        "followup", modelo, FOLLOWUP_TEMPERATURE, api_key,
+        lambda: _crear_cadena_followup(modelo, FOLLOWUP_TEMPERATURE, api_key),
+    )
+
+
+def _crear_cadena_resumen(modelo: str, temperatura: float, api_key: str):
+    llm = _nuevo_llm(modelo, temperatura, api_key)
+
+    prompt_template = PromptTemplate(
+        input_variables=["resumen_previo", "nuevos"],
+        template=PROMPT_RESUMEN_FOLLOWUPS,
     )
 
     chain = prompt_template | llm
@@ -318,6 +1021,35 @@ Respuesta breve y directa:
     return chain
 
 
+def construir_cadena_resumen():
+    """Devuelve la cadena (Runnable) que actualiza el resumen acumulado de follow-ups."""
+    api_key = _clave_api_actual()
+    if not api_key or not _chat_disponible():
+        return None
+    modelo = _modelo_texto()
+    return _obtener_cadena(
+        "resumen_followups", modelo, RESUMEN_TEMPERATURE, api_key,
+        lambda: _crear_cadena_resumen(modelo, RESUMEN_TEMPERATURE, api_key),
+    )
+
+
+TITULO_TEMPERATURE = 0.7
+
+
+def construir_llm_titulo(api_key: str | None = None):
+    """Devuelve el LLM (registrado) usado para generar títulos breves de sueños.
+    `api_key` permite usar una clave distinta (p. ej. GEMINI_TEXT_API_KEY).
+    """
+    api_key = api_key or _clave_api_actual()
+    if not api_key or not _chat_disponible():
+        return None
+    modelo = _modelo_texto()
+    return _obtener_cadena(
+        "titulo", modelo, TITULO_TEMPERATURE, api_key,
+        lambda: _nuevo_llm(modelo, TITULO_TEMPERATURE, api_key),
+    )
+
+
 def leer_sueno(ruta_archivo: str):
     """Lee el contenido del archivo del sueño en UTF-8."""
     try:
@@ -439,6 +1171,41 @@ def extraer_bloque_por_titulo(texto: str, titulo: str) -> str | None:
     return bloque or None
 
 
+def _memoria_previa_json() -> str:
+    """memoria_json para el prompt según PREVIOUS_N, PREV_FOLLOWUPS_N y PREV_TOKENS_MAX."""
+    try:
+        prev_n = int(os.getenv("PREVIOUS_N", "5"))
+    except ValueError:
+        prev_n = 5
+    try:
+        prev_fu_n = int(os.getenv("PREV_FOLLOWUPS_N", "3"))
+    except ValueError:
+        prev_fu_n = 3
+    return _memoria_json_compacta(prev_n, prev_fu_n, _presupuesto_memoria())
+
+def _invocar_interprete(chain, texto_sueno: str, contexto_emocional: str, memoria_json: str) -> str:
+    """Invoca la cadena de interpretación y normaliza la respuesta a texto."""
+    try:
+        res = chain.invoke({
+            "texto_sueno": texto_sueno,
+            "contexto_emocional": contexto_emocional,
+            "memoria_json": memoria_json,
+        })
+    except AttributeError:
+        # Si no existe invoke (versiones antiguas), intentar run
+        return chain.run({
+            "texto_sueno": texto_sueno,
+            "contexto_emocional": contexto_emocional,
+        })
+    if isinstance(res, str):
+        return res
+    content = getattr(res, "content", None)
+    if isinstance(content, str) and content.strip():
+        return content
+    if isinstance(res, dict) and "text" in res:
+        return str(res.get("text", ""))
+    return str(res)
+
 def interpretar_y_guardar(ruta_sueno: str, contexto_emocional: str) -> tuple[None | str, str, str | None]:
     """Ejecuta la interpretación con el LLM, guarda el archivo y
     devuelve (ruta_salida, interpretacion, sesion_id). Si falla, retorna (None, "", None).
@@ -454,43 +1221,7 @@ def interpretar_y_guardar(ruta_sueno: str, contexto_emocional: str) -> tuple[Non
     chain = construir_cadena_interprete()
     if chain is not None:
         try:
-            # Usar invoke/run según implementación actual
-            try:
-                # Config desde env
-                try:
-                    prev_n = int(os.getenv("PREVIOUS_N", "5"))
-                except ValueError:
-                    prev_n = 5
-                try:
-                    prev_fu_n = int(os.getenv("PREV_FOLLOWUPS_N", "3"))
-                except ValueError:
-                    prev_fu_n = 3
-                try:
-                    prev_json_max = int(os.getenv("PREV_JSON_MAX_CHARS", "20000"))
-                except ValueError:
-                    prev_json_max = 20000
-                memoria_json = _memoria_json_compacta(prev_n, prev_fu_n, prev_json_max)
-                res = chain.invoke({
-                    "texto_sueno": texto_sueno,
-                    "contexto_emocional": contexto_emocional,
-                    "memoria_json": memoria_json,
-                })
-                if isinstance(res, str):
-                    interpretacion = res
-                else:
-                    content = getattr(res, "content", None)
-                    if isinstance(content, str) and content.strip():
-                        interpretacion = content
-                    elif isinstance(res, dict) and "text" in res:
-                        interpretacion = str(res.get("text", ""))
-                    else:
-                        interpretacion = str(res)
-            except AttributeError:
-                # Si no existe invoke (versiones antiguas), intentar run
-                interpretacion = chain.run({
-                    "texto_sueno": texto_sueno,
-                    "contexto_emocional": contexto_emocional,
-                })
+            interpretacion = _invocar_interprete(chain, texto_sueno, contexto_emocional, _memoria_previa_json())
         except Exception as e:
             aviso = f"Aviso: no se pudo usar Gemini ({e}). No se generará interpretación."
             print((Fore.YELLOW + aviso + Style.RESET_ALL) if HAVE_COLORAMA else aviso)
@@ -505,9 +1236,127 @@ def interpretar_y_guardar(ruta_sueno: str, contexto_emocional: str) -> tuple[Non
     return ruta_salida, interpretacion, sesion_id
 
 
+# ==================== Modo lote (directorio o glob) ====================
+def _rutas_lote(entrada: str) -> list[str]:
+    """Archivos a procesar: todos los .txt de un directorio o los que coincidan con un glob.
+    Se omiten las salidas previas (*_interpretado*)."""
+    import glob
+
+    patron = os.path.join(entrada, "*.txt") if os.path.isdir(entrada) else entrada
+    rutas = sorted(p for p in glob.glob(patron) if os.path.isfile(p))
+    return [p for p in rutas if "_interpretado" not in os.path.basename(p)]
+
+def interpretar_lote(rutas: list[str], contexto_emocional: str = "", workers: int = 4) -> dict:
+    """Interpreta varios archivos en paralelo (hilos; las llamadas al LLM son de E/S),
+    guarda cada `_interpretado` con guardar_interpretacion y registra todas las sesiones
+    con una sola escritura en memoria. Devuelve un resumen con conteos y tiempos.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    chain = construir_cadena_interprete()
+    if chain is None:
+        msg = "No hay cadena de interpretación disponible (verifica tu API key y conexión)."
+        print((Fore.YELLOW + msg + Style.RESET_ALL) if HAVE_COLORAMA else msg)
+        return {"total": len(rutas), "ok": 0, "errores": len(rutas), "segundos": 0.0, "por_segundo": 0.0}
+    # Mismo contexto de memoria para todo el lote: los sueños del lote no se ven entre sí
+    memoria_json = _memoria_previa_json()
+
+    def trabajo(ruta: str) -> dict:
+        t0 = time.perf_counter()
+        texto = leer_sueno(ruta)
+        if texto is None:
+            return {"ruta": ruta, "error": "no se pudo leer"}
+        try:
+            interpretacion = _invocar_interprete(chain, texto, contexto_emocional, memoria_json)
+        except Exception as e:
+            return {"ruta": ruta, "error": str(e)}
+        if not (interpretacion or "").strip():
+            return {"ruta": ruta, "error": "interpretación vacía"}
+        return {
+            "ruta": ruta,
+            "texto": texto,
+            "interpretacion": interpretacion,
+            "ruta_salida": guardar_interpretacion(ruta, interpretacion),
+            "segundos": time.perf_counter() - t0,
+        }
+
+    inicio = time.perf_counter()
+    resultados: list[dict] = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futuros = [pool.submit(trabajo, ruta) for ruta in rutas]
+        for i, fut in enumerate(as_completed(futuros), 1):
+            r = fut.result()
+            resultados.append(r)
+            estado = f"error: {r['error']}" if "error" in r else f"{r['segundos']:.1f} s"
+            print(f"[{i}/{len(rutas)}] {r['ruta']} ({estado})")
+
+    orden = {ruta: i for i, ruta in enumerate(rutas)}
+    correctos = sorted((r for r in resultados if "error" not in r), key=lambda r: orden[r["ruta"]])
+    _crear_sesiones([
+        {
+            "ruta_sueno": r["ruta"],
+            "texto_sueno": r["texto"],
+            "contexto": contexto_emocional,
+            "interpretacion": r["interpretacion"],
+            "ruta_salida": r["ruta_salida"],
+        }
+        for r in correctos
+    ])
+    total = time.perf_counter() - inicio
+    latencias = [r["segundos"] for r in correctos]
+    return {
+        "total": len(rutas),
+        "ok": len(correctos),
+        "errores": len(rutas) - len(correctos),
+        "segundos": round(total, 2),
+        "por_segundo": round(len(rutas) / total, 2) if total > 0 else 0.0,
+        "latencia_media": round(sum(latencias) / len(latencias), 2) if latencias else 0.0,
+    }
+
+
 # (sin fallback offline de follow-up)
 
 
+# Refrescos del resumen de follow-ups en curso en el CLI: como mucho uno por sesión. Antes de
+# salir se esperan, para no cortar a medias una escritura del journal.
+_RESUMENES_CLI: dict = {}
+_RESUMENES_CLI_LOCK = threading.Lock()
+
+
+def _refrescar_resumen_en_segundo_plano(sesion_id: str) -> None:
+    """Actualiza en un hilo aparte el resumen de follow-ups antiguos de una sesión local.
+    Si ya hay un refresco en curso para la sesión no se lanza otro (el siguiente follow-up
+    recogerá lo pendiente)."""
+    def trabajo():
+        try:
+            ses = _buscar_sesion(sesion_id)
+            campos = resumir_followups(ses, timeout=_llm_timeout_secs()) if ses else None
+            if campos:
+                _actualizar_sesion(sesion_id, campos)
+        except Exception as e:
+            msg = f"No se pudo actualizar el resumen de follow-ups: {e}"
+            print((Fore.YELLOW + msg + Style.RESET_ALL) if HAVE_COLORAMA else msg)
+        finally:
+            with _RESUMENES_CLI_LOCK:
+                _RESUMENES_CLI.pop(sesion_id, None)
+
+    with _RESUMENES_CLI_LOCK:
+        if sesion_id in _RESUMENES_CLI:
+            return
+        hilo = threading.Thread(target=trabajo, daemon=True)
+        _RESUMENES_CLI[sesion_id] = hilo
+    hilo.start()
+
+
+def _esperar_resumenes_pendientes() -> None:
+    """Espera los refrescos en curso (acotados por LLM_TIMEOUT_SECS más un margen para guardar)."""
+    with _RESUMENES_CLI_LOCK:
+        hilos = list(_RESUMENES_CLI.values())
+    limite = time.monotonic() + _llm_timeout_secs() + 5
+    for hilo in hilos:
+        hilo.join(max(0.0, limite - time.monotonic()))
+
+
 def ejecuta_tarea():
     titulo = " --- 💤 Traductor de Sueños (Gemini AI) --- "
     subtitulo = "Convierte tus sueños en lenguaje simbólico y reflexión.\n"
@@ -518,6 +1367,26 @@ def ejecuta_tarea():
         print(titulo)
         print(subtitulo)
 
+    # Modo lote: BULK_INPUT=<directorio o glob>, sin interacción
+    entrada_lote = os.getenv("BULK_INPUT", "").strip()
+    if entrada_lote:
+        rutas = _rutas_lote(entrada_lote)
+        try:
+            workers = int(os.getenv("BULK_WORKERS", "4"))
+        except ValueError:
+            workers = 4
+        if not rutas:
+            print(f"No se encontraron archivos para '{entrada_lote}'.")
+            return
+        print(f"Procesando {len(rutas)} archivos con {workers} workers...\n")
+        res = interpretar_lote(rutas, os.getenv("BULK_CONTEXT", ""), workers)
+        resumen = (
+            f"\n--- Lote terminado: {res['ok']}/{res['total']} interpretados, {res['errores']} con error, "
+            f"{res['segundos']} s ({res['por_segundo']} archivos/s, {res.get('latencia_media', 0.0)} s por archivo) ---\n"
+        )
+        print((Fore.GREEN + resumen + Style.RESET_ALL) if HAVE_COLORAMA else resumen)
+        return
+
     # Fast-path: modo automático (una sola interpretación y salir)
     if os.getenv("AUTO_RUN") == "1":
         auto_msg = "(AUTO_RUN=1) Usando archivo por defecto 'sueño.txt' y contexto vacío.\n"
@@ -613,6 +1482,7 @@ def ejecuta_tarea():
                 # guardar en memoria persistente
                 if sesion_id:
                     _agregar_followup(sesion_id, q, str(resp))
+                    _refrescar_resumen_en_segundo_plano(sesion_id)
                 print(Fore.WHITE + str(resp) + Style.RESET_ALL if HAVE_COLORAMA else str(resp))
             except Exception as e:
                 msg = f"No fue posible responder el seguimiento: {e}"
@@ -626,8 +1496,16 @@ def ejecuta_tarea():
 
         otra = input("\n¿Interpretar otro sueño? (s/n): ").strip().lower()
         if otra not in {"s", "si", "sí"}:
+            # No cortar un refresco del resumen a mitad de su escritura en el journal
+            _esperar_resumenes_pendientes()
             print("Hasta luego 👋")
             break
 
+def __getattr__(nombre: str):
+    # Acceso externo a `MEM` (p. ej. reporte6_BernardoBojalil.MEM): carga la memoria si hace falta
+    if nombre == "MEM":
+        return _memoria()
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
+
 if __name__ == "__main__":
     ejecuta_tarea()
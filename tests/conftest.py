@@ -0,0 +1,15 @@
+"""Fixtures compartidas: memoria JSON en un directorio temporal y sin MongoDB."""
+
+import pytest
+
+import reporte6_BernardoBojalil as r6
+
+
+@pytest.fixture
+def memoria_tmp(monkeypatch, tmp_path):
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    monkeypatch.setattr(r6, "MEMORY_PATH", str(tmp_path / "memoria.json"))
+    monkeypatch.setattr(r6, "MEMORY_JOURNAL_PATH", str(tmp_path / "memoria.json.journal"))
+    monkeypatch.setattr(r6, "_MEM", None)
+    monkeypatch.setattr(r6, "_INDICE", None)
+    return tmp_path
@@ -0,0 +1,82 @@
+"""Admission control: concurrencia acotada, cola acotada y espera máxima hacia Gemini."""
+
+import asyncio
+
+import pytest
+
+import app
+
+
+def test_respeta_el_maximo_de_concurrentes():
+    maximo = 0
+
+    async def llamada(limite):
+        nonlocal maximo
+        async with limite.slot():
+            maximo = max(maximo, limite.en_curso)
+            await asyncio.sleep(0.02)
+
+    async def main():
+        limite = app._LimiteConcurrencia("prueba", 2, 10)
+        await asyncio.gather(*(llamada(limite) for _ in range(6)))
+        return limite
+
+    limite = asyncio.run(main())
+    assert maximo == 2
+    assert (limite.en_curso, limite.en_cola, limite.rechazadas) == (0, 0, 0)
+    assert limite.esperas == 6
+
+
+def test_cola_llena_rechaza_de_inmediato():
+    async def ocupar(limite, soltar):
+        async with limite.slot():
+            await soltar.wait()
+
+    async def main():
+        limite = app._LimiteConcurrencia("prueba", 1, 1)
+        soltar = asyncio.Event()
+        en_curso = asyncio.ensure_future(ocupar(limite, soltar))
+        en_cola = asyncio.ensure_future(ocupar(limite, soltar))
+        await asyncio.sleep(0.01)
+        assert (limite.en_curso, limite.en_cola) == (1, 1)
+        with pytest.raises(app.ServicioSaturado) as exc:
+            async with limite.slot():
+                pass
+        soltar.set()
+        await asyncio.gather(en_curso, en_cola)
+        return limite, exc.value
+
+    limite, error = asyncio.run(main())
+    assert error.retry_after >= 1
+    assert limite.rechazadas == 1
+    assert (limite.en_curso, limite.en_cola) == (0, 0)
+
+
+def test_espera_vencida_no_pierde_el_permiso(monkeypatch):
+    monkeypatch.setenv("LLM_QUEUE_TIMEOUT_SECS", "1")
+
+    async def main():
+        limite = app._LimiteConcurrencia("prueba-timeout", 1, 5)
+        soltar = asyncio.Event()
+
+        async def ocupar():
+            async with limite.slot():
+                await soltar.wait()
+
+        tarea = asyncio.ensure_future(ocupar())
+        await asyncio.sleep(0.01)
+        with pytest.raises(app.ServicioSaturado):
+            async with limite.slot():
+                pass
+        soltar.set()
+        await tarea
+        # El permiso volvió al semáforo: la siguiente llamada entra sin esperar
+        async with limite.slot():
+            assert limite.en_curso == 1
+        return limite
+
+    limite = asyncio.run(main())
+    assert limite.rechazadas == 1
+    assert (limite.en_curso, limite.en_cola) == (0, 0)
+    assert limite.espera_max >= 1.0
+    assert any('class="prueba-timeout"' in linea for linea in app._M_ADMISION.exponer())
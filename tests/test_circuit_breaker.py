@@ -0,0 +1,88 @@
+"""Circuit breaker de Gemini: closed -> open -> half_open -> closed/open."""
+
+import asyncio
+
+import pytest
+
+import app
+
+
+async def _llamar(breaker, falla: bool = False, excepcion: type = RuntimeError):
+    async with breaker.llamada():
+        if falla:
+            raise excepcion("fallo")
+
+
+def _fallar(breaker, n: int) -> None:
+    for _ in range(n):
+        with pytest.raises(RuntimeError):
+            asyncio.run(_llamar(breaker, falla=True))
+
+
+def test_abre_al_superar_el_ratio_y_rechaza_sin_llamar():
+    breaker = app._CircuitBreaker(ventana=4, min_llamadas=4, ratio_fallo=0.5, segundos_abierto=60)
+    asyncio.run(_llamar(breaker))
+    asyncio.run(_llamar(breaker))
+    _fallar(breaker, 1)
+    assert breaker.estado == "closed"  # menos de min_llamadas
+    _fallar(breaker, 1)
+    assert breaker.estado == "open" and breaker.aperturas == 1
+
+    with pytest.raises(app.CircuitoAbierto) as exc:
+        asyncio.run(_llamar(breaker))
+    assert exc.value.retry_after >= 59
+    with pytest.raises(app.CircuitoAbierto):
+        breaker.rechazar_si_abierto()
+    assert breaker.rechazadas == 2
+    assert breaker.metricas()["state"] == "open"
+
+
+def test_half_open_admite_una_sola_sonda_y_cierra_si_funciona():
+    breaker = app._CircuitBreaker(ventana=2, min_llamadas=2, ratio_fallo=0.5, segundos_abierto=60)
+    _fallar(breaker, 2)
+    assert breaker.estado == "open"
+    breaker._abierto_hasta = 0.0  # vence el plazo
+    assert breaker.metricas()["state"] == "half_open"
+
+    async def main():
+        soltar = asyncio.Event()
+
+        async def sonda():
+            async with breaker.llamada():
+                await soltar.wait()
+
+        tarea = asyncio.ensure_future(sonda())
+        await asyncio.sleep(0)
+        assert breaker.estado == "half_open"
+        with pytest.raises(app.CircuitoAbierto):
+            await _llamar(breaker)  # solo una llamada de prueba a la vez
+        soltar.set()
+        await tarea
+
+    asyncio.run(main())
+    assert breaker.estado == "closed"
+    assert breaker.metricas()["window_calls"] == 0
+
+
+def test_sonda_fallida_vuelve_a_abrir():
+    breaker = app._CircuitBreaker(ventana=2, min_llamadas=2, ratio_fallo=0.5, segundos_abierto=60)
+    _fallar(breaker, 2)
+    breaker._abierto_hasta = 0.0
+    _fallar(breaker, 1)
+    assert breaker.estado == "open" and breaker.aperturas == 2
+
+
+def test_saturacion_local_y_cancelacion_no_cuentan_como_fallo():
+    breaker = app._CircuitBreaker(ventana=2, min_llamadas=2, ratio_fallo=0.5, segundos_abierto=60)
+
+    async def cancelada():
+        async with breaker.llamada():
+            raise asyncio.CancelledError()
+
+    for _ in range(3):
+        with pytest.raises(app.ServicioSaturado):
+            asyncio.run(_llamar(breaker, falla=True, excepcion=lambda _m: app.ServicioSaturado("interpretacion", 1)))
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(cancelada())
+    assert breaker.estado == "closed"
+    assert breaker.metricas()["window_calls"] == 0
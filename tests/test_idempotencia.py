@@ -0,0 +1,153 @@
+"""Idempotency-Key: single-flight dentro del proceso y replay desde la memoria JSON."""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Response
+
+import app
+
+
+def test_misma_clave_con_otro_cuerpo_en_vuelo_da_422(memoria_tmp, monkeypatch):
+    monkeypatch.setattr(app, "_MONGO_CLIENT", None)
+    llamadas = []
+
+    def fabrica(valor):
+        async def _f():
+            llamadas.append(valor)
+            await asyncio.sleep(0.05)
+            return {"valor": valor}
+        return _f
+
+    async def main():
+        r1, r2 = Response(), Response()
+        return r1, r2, await asyncio.gather(
+            app._con_idempotencia("k", "u1", "/interpret-text", "huella-a", r1, fabrica("a")),
+            app._con_idempotencia("k", "u1", "/interpret-text", "huella-b", r2, fabrica("b")),
+            return_exceptions=True,
+        )
+
+    r1, _r2, (primero, segundo) = asyncio.run(main())
+    assert primero == {"valor": "a"}
+    assert isinstance(segundo, HTTPException) and segundo.status_code == 422
+    assert llamadas == ["a"]
+    assert "Idempotent-Replayed" not in r1.headers
+
+
+def test_misma_clave_y_cuerpo_se_une_y_marca_replay(memoria_tmp, monkeypatch):
+    monkeypatch.setattr(app, "_MONGO_CLIENT", None)
+    llamadas = []
+
+    async def fabrica():
+        llamadas.append(1)
+        await asyncio.sleep(0.05)
+        return {"valor": 1}
+
+    async def main():
+        r1, r2 = Response(), Response()
+        res = await asyncio.gather(
+            app._con_idempotencia("k", "u1", "/interpret-text", "h", r1, fabrica),
+            app._con_idempotencia("k", "u1", "/interpret-text", "h", r2, fabrica),
+        )
+        r3 = Response()
+        res.append(await app._con_idempotencia("k", "u1", "/interpret-text", "h", r3, fabrica))
+        return (r1, r2, r3), res
+
+    (r1, r2, r3), res = asyncio.run(main())
+    assert res == [{"valor": 1}] * 3
+    assert llamadas == [1]
+    assert "Idempotent-Replayed" not in r1.headers
+    assert r2.headers["Idempotent-Replayed"] == "true"
+    assert r3.headers["Idempotent-Replayed"] == "true"
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(app._con_idempotencia("k", "u1", "/interpret-text", "otra", Response(), fabrica))
+    assert exc.value.status_code == 422
+
+
+def test_single_flight_con_huella_distinta_no_se_une():
+    async def fabrica():
+        await asyncio.sleep(0.02)
+        return "a"
+
+    async def main():
+        lider = asyncio.ensure_future(app._single_flight("k", fabrica, huella="a"))
+        await asyncio.sleep(0)
+        with pytest.raises(app.HuellaDistinta):
+            await app._single_flight("k", fabrica, huella="b")
+        return await lider
+
+    assert asyncio.run(main()) == "a"
+
+
+def test_fallo_no_se_guarda_y_el_reintento_ejecuta(memoria_tmp, monkeypatch):
+    monkeypatch.setattr(app, "_MONGO_CLIENT", None)
+    intentos = []
+
+    async def fabrica():
+        intentos.append(1)
+        if len(intentos) == 1:
+            raise RuntimeError("falla")
+        return {"valor": 2}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(app._ejecutar_idempotente("id-1", "h", fabrica))
+    assert asyncio.run(app._ejecutar_idempotente("id-1", "h", fabrica)) == ({"valor": 2}, False)
+    assert asyncio.run(app._ejecutar_idempotente("id-1", "h", fabrica)) == ({"valor": 2}, True)
+    assert len(intentos) == 2
+
+
+@pytest.fixture
+def idem_mongo(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    pytest.importorskip("pymongo")
+    monkeypatch.setattr(app, "_MONGO_CLIENT", mongomock.MongoClient())
+    return app._idempotencia_col()
+
+
+def test_reclamo_vigente_no_se_toma_y_el_vencido_si(idem_mongo):
+    col = idem_mongo
+    assert app._idem_reclamar_mongo(col, "id-1", "h", "worker-a") is None
+    otro = app._idem_reclamar_mongo(col, "id-1", "h", "worker-b")
+    assert otro["status"] == "pending" and otro["owner"] == "worker-a"
+
+    # Sin renovaciones (worker caído) el reclamo vence y otro worker lo toma
+    col.update_one({"_id": "id-1"}, {"$set": {"expire_at": app.datetime.utcnow() - app.timedelta(seconds=1)}})
+    assert app._idem_reclamar_mongo(col, "id-1", "h", "worker-b") is None
+    assert col.find_one({"_id": "id-1"})["owner"] == "worker-b"
+
+
+def test_mongo_guarda_respuesta_y_libera_la_clave_si_falla(idem_mongo):
+    col = idem_mongo
+
+    async def falla():
+        raise RuntimeError("falla")
+
+    async def bien():
+        return {"valor": 1}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(app._ejecutar_idempotente("id-2", "h", falla))
+    assert col.find_one({"_id": "id-2"}) is None
+
+    assert asyncio.run(app._ejecutar_idempotente("id-2", "h", bien)) == ({"valor": 1}, False)
+    assert col.find_one({"_id": "id-2"})["status"] == "done"
+    assert asyncio.run(app._ejecutar_idempotente("id-2", "h", falla)) == ({"valor": 1}, True)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(app._ejecutar_idempotente("id-2", "otra", bien))
+    assert exc.value.status_code == 422
+
+
+def test_latido_renueva_el_reclamo_mientras_corre(idem_mongo, monkeypatch):
+    col = idem_mongo
+    monkeypatch.setattr(app, "_idem_lease_secs", lambda: 0.15)
+    vencimientos = []
+
+    async def fabrica():
+        for _ in range(3):
+            await asyncio.sleep(0.08)
+            vencimientos.append(col.find_one({"_id": "id-3"})["expire_at"])
+        return {"valor": 3}
+
+    assert asyncio.run(app._ejecutar_idempotente("id-3", "h", fabrica)) == ({"valor": 3}, False)
+    assert vencimientos[-1] > vencimientos[0]
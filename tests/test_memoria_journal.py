@@ -0,0 +1,97 @@
+"""Recuperación del journal de memoria tras una escritura interrumpida."""
+
+import json
+
+import reporte6_BernardoBojalil as r6
+
+
+def _usar_rutas(monkeypatch, tmp_path):
+    monkeypatch.setattr(r6, "MEMORY_PATH", str(tmp_path / "memoria.json"))
+    monkeypatch.setattr(r6, "MEMORY_JOURNAL_PATH", str(tmp_path / "memoria.json.journal"))
+    monkeypatch.setattr(r6, "_MEM", None)
+    monkeypatch.setattr(r6, "_INDICE", None)
+
+
+def _op_sesion(seq: int, ses_id: str) -> str:
+    return json.dumps({"op": "session", "seq": seq, "data": {"id": ses_id, "followups": []}}) + "\n"
+
+
+def test_linea_truncada_no_corrompe_la_siguiente_operacion(monkeypatch, tmp_path):
+    _usar_rutas(monkeypatch, tmp_path)
+    journal = tmp_path / "memoria.json.journal"
+    # Dos operaciones completas y una tercera cortada a mitad de escritura
+    journal.write_text(_op_sesion(1, "a") + _op_sesion(2, "b") + _op_sesion(3, "c")[:25], encoding="utf-8")
+
+    mem = r6.cargar_memoria()
+    assert [s["id"] for s in mem["sessions"]] == ["a", "b"]
+    assert journal.read_text(encoding="utf-8").endswith("\n")
+
+    monkeypatch.setattr(r6, "_MEM", mem)
+    r6._registrar_op({"op": "session", "data": {"id": "d", "followups": []}})
+
+    recargada = r6.cargar_memoria()
+    assert [s["id"] for s in recargada["sessions"]] == ["a", "b", "d"]
+
+
+def test_linea_completa_sin_salto_final(monkeypatch, tmp_path):
+    _usar_rutas(monkeypatch, tmp_path)
+    journal = tmp_path / "memoria.json.journal"
+    journal.write_text(_op_sesion(1, "a").rstrip("\n"), encoding="utf-8")
+
+    mem = r6.cargar_memoria()
+    monkeypatch.setattr(r6, "_MEM", mem)
+    r6._registrar_op({"op": "session", "data": {"id": "b", "followups": []}})
+
+    assert [s["id"] for s in r6.cargar_memoria()["sessions"]] == ["a", "b"]
+
+
+def test_borrados_del_journal(monkeypatch, tmp_path):
+    _usar_rutas(monkeypatch, tmp_path)
+    journal = tmp_path / "memoria.json.journal"
+    lineas = [_op_sesion(i + 1, f"s{i}") for i in range(6)]
+    lineas += [json.dumps({"op": "delete", "seq": 7 + i, "id": f"s{i}"}) + "\n" for i in (1, 3, 4)]
+    journal.write_text("".join(lineas), encoding="utf-8")
+
+    assert [s["id"] for s in r6.cargar_memoria()["sessions"]] == ["s0", "s2", "s5"]
+
+
+def test_compactacion_interrumpida_se_recupera(monkeypatch, tmp_path):
+    _usar_rutas(monkeypatch, tmp_path)
+    # Snapshot viejo, journal apartado por una compactación que no terminó y journal nuevo
+    (tmp_path / "memoria.json").write_text(
+        json.dumps({"sessions": [{"id": "a", "followups": []}], "journal_seq": 1}), encoding="utf-8"
+    )
+    (tmp_path / "memoria.json.journal.compactando").write_text(_op_sesion(1, "a") + _op_sesion(2, "b"), encoding="utf-8")
+    (tmp_path / "memoria.json.journal").write_text(_op_sesion(3, "c"), encoding="utf-8")
+
+    mem = r6.cargar_memoria()
+    assert [s["id"] for s in mem["sessions"]] == ["a", "b", "c"]
+    assert not (tmp_path / "memoria.json.journal.compactando").exists()
+
+    monkeypatch.setattr(r6, "_MEM", mem)
+    r6.guardar_memoria(mem)
+    snap = json.loads((tmp_path / "memoria.json").read_text(encoding="utf-8"))
+    assert [s["id"] for s in snap["sessions"]] == ["a", "b", "c"]
+    assert snap["journal_seq"] == 3
+    assert not (tmp_path / "memoria.json.journal").exists()
+    assert [s["id"] for s in r6.cargar_memoria()["sessions"]] == ["a", "b", "c"]
+
+
+def test_eliminar_sesion_con_created_at_repetido(monkeypatch, tmp_path):
+    _usar_rutas(monkeypatch, tmp_path)
+    monkeypatch.setattr(r6, "_BORRADAS", set())
+    r6._memoria()
+    for ses_id in ("a", "b", "c"):
+        ses = {"id": ses_id, "created_at": "2024-01-01T00:00:00", "user_id": "u", "followups": []}
+        r6._memoria()["sessions"].append(ses)
+        r6._indice().agregar(ses)
+        r6._registrar_op({"op": "session", "data": ses})
+
+    assert r6._eliminar_sesion("b")
+    assert [s["id"] for s in r6._indice().ultimas(10, "u")] == ["c", "a"]
+    assert [s["id"] for s in r6.cargar_memoria()["sessions"]] == ["a", "c"]
+
+    r6.guardar_memoria(r6._memoria())
+    assert [s["id"] for s in r6._memoria()["sessions"]] == ["a", "c"]
+    snap = json.loads((tmp_path / "memoria.json").read_text(encoding="utf-8"))
+    assert [s["id"] for s in snap["sessions"]] == ["a", "c"]
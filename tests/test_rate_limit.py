@@ -0,0 +1,73 @@
+"""Rate limiting local: token bucket con deuda permitida y cuota diaria."""
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    ahora = [1000.0]
+    monkeypatch.setattr(app, "_BUCKETS", {})
+    monkeypatch.setattr(app, "_CUOTAS", {})
+    monkeypatch.setattr(app.time, "monotonic", lambda: ahora[0])
+    monkeypatch.setenv("RATE_IMAGEN_PER_MIN", "6")  # un token cada 10 s
+    monkeypatch.setenv("RATE_IMAGEN_BURST", "3")
+    monkeypatch.setenv("QUOTA_IMAGEN_DAILY", "0")
+    return ahora
+
+
+def test_rafaga_y_reposicion(reloj):
+    for restantes in (2, 1, 0):
+        uso = app._consumir_local("u1", "imagen")
+        assert uso["permitido"] and uso["restantes"] == restantes
+    uso = app._consumir_local("u1", "imagen")
+    assert not uso["permitido"] and not uso["sin_cuota"]
+    assert uso["espera"] == 10 and uso["reset"] == 30
+
+    reloj[0] += 10
+    assert app._consumir_local("u1", "imagen")["permitido"]
+    # Cada usuario tiene su propio bucket
+    assert app._consumir_local("u2", "imagen")["restantes"] == 2
+
+
+def test_lote_deja_deuda_que_se_repone_a_la_tasa_normal(reloj):
+    uso = app._consumir_local("u1", "imagen", 5)
+    assert uso["permitido"] and uso["restantes"] == 0
+    assert app._BUCKETS[("u1", "imagen")][0] == -2.0
+    reloj[0] += 20  # -2 + 2 tokens = 0: aún sin token completo
+    assert not app._consumir_local("u1", "imagen")["permitido"]
+    reloj[0] += 10
+    assert app._consumir_local("u1", "imagen")["permitido"]
+
+
+def test_consultar_no_consume(reloj):
+    for _ in range(3):
+        uso = app._consumir_local("u1", "imagen", 0)
+        assert uso["permitido"] and uso["restantes"] == 3
+    assert app._consumir_local("u1", "imagen")["restantes"] == 2
+
+
+def test_cuota_diaria_nunca_se_supera(reloj, monkeypatch):
+    monkeypatch.setenv("RATE_IMAGEN_BURST", "100")
+    monkeypatch.setenv("QUOTA_IMAGEN_DAILY", "4")
+    assert app._consumir_local("u1", "imagen", 3)["cuota_usada"] == 3
+    # Quedan 1 y se piden 2: se rechaza sin cobrar nada
+    uso = app._consumir_local("u1", "imagen", 2)
+    assert not uso["permitido"] and uso["sin_cuota"] and uso["cuota_usada"] == 3
+    assert app._consumir_local("u1", "imagen")["cuota_usada"] == 4
+    uso = app._consumir_local("u1", "imagen")
+    assert not uso["permitido"] and uso["sin_cuota"]
+    headers = app._headers_uso(uso)
+    assert headers["X-Quota-Limit"] == "4" and headers["X-Quota-Remaining"] == "0"
+    assert app._headers_uso(uso, "-Imagen")["X-Quota-Remaining-Imagen"] == "0"
+
+
+def test_cuota_se_reinicia_al_cambiar_el_dia(reloj, monkeypatch):
+    monkeypatch.setenv("QUOTA_IMAGEN_DAILY", "1")
+    assert app._consumir_local("u1", "imagen")["permitido"]
+    assert not app._consumir_local("u1", "imagen")["permitido"]
+    app._CUOTAS[("u1", "imagen")][0] = "2000-01-01"
+    reloj[0] += 60
+    uso = app._consumir_local("u1", "imagen")
+    assert uso["permitido"] and uso["cuota_usada"] == 1
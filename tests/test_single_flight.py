@@ -0,0 +1,70 @@
+"""Single-flight: peticiones idénticas concurrentes comparten una sola ejecución."""
+
+import asyncio
+
+import app
+
+
+def test_peticiones_concurrentes_comparten_una_ejecucion():
+    llamadas = []
+
+    async def fabrica():
+        llamadas.append(1)
+        await asyncio.sleep(0.05)
+        return {"interpretacion": "x"}
+
+    async def main():
+        return await asyncio.gather(*(app._single_flight("k", fabrica) for _ in range(5)))
+
+    antes = dict(app._SINGLE_FLIGHT_STATS)
+    res = asyncio.run(main())
+    assert llamadas == [1]
+    assert res == [{"interpretacion": "x"}] * 5
+    # Cada petición recibe su propia copia
+    res[0]["interpretacion"] = "otra"
+    assert res[1]["interpretacion"] == "x"
+    assert app._SINGLE_FLIGHT_STATS["leaders"] - antes["leaders"] == 1
+    assert app._SINGLE_FLIGHT_STATS["coalesced"] - antes["coalesced"] == 4
+    assert "k" not in app._EN_VUELO
+
+
+def test_cancelar_al_lider_no_cancela_a_los_demas():
+    async def fabrica():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def main():
+        lider = asyncio.ensure_future(app._single_flight("k", fabrica))
+        await asyncio.sleep(0)
+        seguidor = asyncio.ensure_future(app._single_flight("k", fabrica))
+        await asyncio.sleep(0)
+        lider.cancel()
+        return await seguidor, lider.cancelled()
+
+    assert asyncio.run(main()) == ("ok", True)
+
+
+def test_error_llega_a_todos_y_libera_la_clave():
+    llamadas = []
+
+    async def fabrica():
+        llamadas.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("gemini caído")
+
+    async def main():
+        res = await asyncio.gather(app._single_flight("k", fabrica), app._single_flight("k", fabrica), return_exceptions=True)
+        await asyncio.sleep(0)
+        return res
+
+    res = asyncio.run(main())
+    assert llamadas == [1]
+    assert all(isinstance(e, RuntimeError) for e in res)
+    assert "k" not in app._EN_VUELO
+
+    async def bien():
+        return "ok"
+
+    # Con la clave libre, el siguiente intento vuelve a ejecutar
+    assert asyncio.run(app._single_flight("k", bien)) == "ok"
+